@@ -2,7 +2,7 @@
 from . import meta
 from .afm_group import AFMGroup
 from .afm_qmap import AFMQMap
-from .formats import find_data, load_data
+from .formats import find_data, iter_data, iter_find_data, load_data
 from .formats import supported_extensions
 from .logging_setup import DEFAULT_LOG_PATH, configure_logging
 from .mod_creep_compliance import AFMCreepCompliance
@@ -8,10 +8,12 @@ import h5py
 import numpy as np
 
 from ._version import version
+from .afm_segment import AFMSegment
 from .meta import MetaData
 
 
-__all__ = ["AFMData", "column_dtypes", "column_units", "known_columns"]
+__all__ = ["AFMData", "column_dtypes", "column_units", "known_columns",
+           "get_global_data_revision"]
 
 
 class AFMData(abc.ABC):
@@ -27,7 +29,8 @@ class AFMData(abc.ABC):
         metadata: dict
             Metadata
         diskcache: bool
-            TODO
+            Not used; caching of decoded data on disk is done in
+            :func:`afmformats.formats.load_data`
         """
         # convert meta data
         metadata_i = MetaData(metadata)
@@ -40,7 +43,9 @@ class AFMData(abc.ABC):
         self._enum = metadata_i["enum"]
         # raw data will not be touched
         self._raw_data = data
-        self._data = {}
+        # user-modified data (keeps track of all modifications)
+        self._data = _RevisionDict()
+        self._zero_copy = False
 
     def __contains__(self, key):
         return self._data.__contains__(key) or self._raw_data.__contains__(key)
@@ -48,8 +53,13 @@ class AFMData(abc.ABC):
     def __getitem__(self, key):
         if key in self._data:
             data = self._data[key]
+            if self._zero_copy:
+                data = _readonly_view(data)
         elif key in self._raw_data:
-            data = self._raw_data[key].copy()
+            if self._zero_copy:
+                data = _readonly_view(self._raw_data[key])
+            else:
+                data = self._raw_data[key].copy()
         elif key == "index":
             return np.arange(len(self))
         else:
@@ -102,6 +112,18 @@ class AFMData(abc.ABC):
         """Data columns available only in the original data file"""
         return sorted(self._raw_data.keys())
 
+    @property
+    def data_revision(self):
+        """Revision counter of the data
+
+        The counter is incremented whenever column data are set
+        (also via segments, e.g. `self.appr`) or reset with
+        :func:`reset_data`. It can be used to invalidate values
+        derived from the data (see e.g.
+        :class:`afmformats.afm_qmap.FeatureCache`).
+        """
+        return self._data.revision
+
     @property
     def enum(self):
         """Unique index of `self` in `self.path`
@@ -125,6 +147,28 @@ class AFMData(abc.ABC):
         """Path to the measurement file"""
         return self._path
 
+    @property
+    def zero_copy(self):
+        """Whether column access returns read-only views
+
+        By default, accessing a column returns a copy of the raw
+        data, such that modifying the returned array has no effect.
+        If `zero_copy` is set to True, read-only views are returned
+        instead, which avoids allocating memory on every access
+        (e.g. in fitting routines). Columns can still be modified via
+        :func:`__setitem__`, which stores the new data separately
+        and leaves the raw data untouched.
+        """
+        return self._zero_copy
+
+    @zero_copy.setter
+    def zero_copy(self, value):
+        self._zero_copy = bool(value)
+        # also apply to the segments (e.g. `self.appr`)
+        for obj in self.__dict__.values():
+            if isinstance(obj, AFMSegment):
+                obj.zero_copy = self._zero_copy
+
     def _export_hdf5(self, h5group, metadata_dict=None):
         """Export data to the HDF5 file format
 
@@ -174,7 +218,7 @@ class AFMData(abc.ABC):
             else:
                 subgroup.attrs[kk] = metadata_dict[kk]
 
-    def _export_tab(self, fd, metadata_dict=None):
+    def _export_tab(self, fd, metadata_dict=None, chunk_size=10000):
         """Export data to a tab separated values file
 
         Parameters
@@ -184,6 +228,8 @@ class AFMData(abc.ABC):
         metadata_dict: dict
             Key-value pairs for the metadata that should be exported
             (will be stored in the group attributes)
+        chunk_size: int
+            Number of rows that are formatted and written at once
         """
         if metadata_dict is None:
             metadata_dict = {}
@@ -198,18 +244,16 @@ class AFMData(abc.ABC):
                 fd.write("# " + dl + "\r\n")
             fd.write("# END METADATA\r\n")
             fd.write("#\r\n")
-        # get all data (faster than doing it every time for every row)
-        data = {}
-        for cc in self.columns:
-            data[cc] = self[cc]
+        columns = self.columns
         # header
-        fd.write("# " + "\t".join(self.columns) + "\r\n")
-        # rows
-        for ii in range(len(self)):
-            items = []
-            for cc in self.columns:
-                items.append("{:.8g}".format(data[cc][ii]))
-            fd.write("\t".join(items) + "\r\n")
+        fd.write("# " + "\t".join(columns) + "\r\n")
+        # rows (formatted in chunks with one format string per chunk)
+        data = np.column_stack([np.asarray(self[cc], dtype=float)
+                                for cc in columns])
+        row_fmt = "\t".join(["%.8g"] * len(columns)) + "\r\n"
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            fd.write((row_fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
 
     def export(self, *args, **kwargs):
         warnings.warn("Pleas use `export_data` for data export!",
@@ -274,6 +318,9 @@ class AFMData(abc.ABC):
                 fd.close()
         elif fmt in ["hdf5", "h5"]:
             if isinstance(out, (pathlib.Path, str)):
+                # make sure the file is not open for reading
+                from .formats.fmt_hdf5 import H5Cache
+                H5Cache.close(out)
                 # overrides always
                 h5 = h5py.File(out, "w")
                 close = True
@@ -299,6 +346,59 @@ class AFMData(abc.ABC):
         self._data.clear()
 
 
+def get_global_data_revision():
+    """Return the number of data modifications of all AFMData instances
+
+    This counter is incremented whenever the :func:`AFMData.data_revision`
+    of any curve is incremented. If it did not change, then the data
+    of no curve were modified, which allows to validate values derived
+    from many curves without checking each curve.
+    """
+    return _RevisionDict.global_revision
+
+
+class _RevisionDict(dict):
+    """Dictionary that counts modifications in `self.revision`"""
+    #: Modifications of all instances (see `get_global_data_revision`)
+    global_revision = 0
+
+    def __init__(self, *args, **kwargs):
+        super(_RevisionDict, self).__init__(*args, **kwargs)
+        self.revision = 0
+
+    def _increment(self):
+        self.revision += 1
+        _RevisionDict.global_revision += 1
+
+    def __delitem__(self, key):
+        super(_RevisionDict, self).__delitem__(key)
+        self._increment()
+
+    def __setitem__(self, key, value):
+        super(_RevisionDict, self).__setitem__(key, value)
+        self._increment()
+
+    def clear(self):
+        super(_RevisionDict, self).clear()
+        self._increment()
+
+    def pop(self, *args):
+        value = super(_RevisionDict, self).pop(*args)
+        self._increment()
+        return value
+
+    def update(self, *args, **kwargs):
+        super(_RevisionDict, self).update(*args, **kwargs)
+        self._increment()
+
+
+def _readonly_view(array):
+    """Return a non-writeable view of `array`"""
+    view = np.asarray(array).view()
+    view.flags.writeable = False
+    return view
+
+
 def json_path_serializer(obj):
     """Used to convert pathlib.Path to str in metadata"""
     if isinstance(obj, pathlib.Path):
@@ -1,16 +1,30 @@
 import pathlib
 
-from .afm_data import AFMData
+import h5py
+import numpy as np
+
+from ._version import version
+from .afm_data import AFMData, column_dtypes, column_units
+from .afm_segment import get_segment_indices
 from .formats import load_data
+from .formats.fmt_hdf5 import H5Cache
+from .lazy_loader import LazyData
+from .meta import DEF_ALL
+from .parse_funcs import fint
 
 
 __all__ = ["AFMGroup"]
 
+#: Chunk size (number of values) of the column datasets in packed
+#: HDF5 exports (see :func:`AFMGroup.export_data`)
+PACKED_CHUNK_SIZE = 2**16
+
 
 class AFMGroup(object):
     """Container for :class:`afmformats.afm_data.AFMData`"""
     def __init__(self, path=None, meta_override=None, callback=None,
-                 modality=None, data_classes_by_modality=None):
+                 modality=None, data_classes_by_modality=None,
+                 workers=None, diskcache=False, dtype=None):
         """
         Parameters
         ----------
@@ -29,10 +43,29 @@ class AFMGroup(object):
             used by :ref:`nanite:index` to pass `Indentation` (which is a
             subclass of the default `AFMForceDistance`) for handling
             "force-indentation" data.
+        workers: int or None
+            Number of worker threads for decoding the data concurrently
+            (see :func:`afmformats.formats.load_data`)
+        diskcache: bool
+            Whether to use the on-disk cache for decoded data
+            (see :func:`afmformats.formats.load_data`)
+        dtype: np.dtype or str or None
+            Data type of the floating point columns, e.g. "float32"
+            (see :func:`afmformats.formats.load_data`)
         """
         if path is not None:
             path = pathlib.Path(path)
         self._mmlist = []
+        #: Revision counter of the group, incremented whenever curves
+        #: are added (see :func:`append`)
+        self.revision = 0
+        # indexes for fast lookups (updated in `append`):
+        # positions of curves in `self._mmlist` by enum value
+        self._enum_index = {}
+        # positions of curves in `self._mmlist` by resolved path
+        self._path_index = {}
+        # resolved paths by curve path (`resolve` requires syscalls)
+        self._resolved_paths = {}
 
         if path is not None:
             self += load_data(
@@ -40,13 +73,19 @@ class AFMGroup(object):
                 callback=callback,
                 meta_override=meta_override,
                 modality=modality,
-                data_classes_by_modality=data_classes_by_modality
+                data_classes_by_modality=data_classes_by_modality,
+                workers=workers,
+                diskcache=diskcache,
+                dtype=dtype,
             )
         elif meta_override is not None:
             raise ValueError("Specifying `meta_override` without specifying "
                              "`path` is meaningless.")
 
         self.path = path
+        #: Data type of the floating point columns when loading
+        #: from `path` (None if the default data type was used)
+        self.dtype = None if dtype is None else np.dtype(dtype)
 
     def __add__(self, grp):
         out = AFMGroup()
@@ -60,6 +99,7 @@ class AFMGroup(object):
         for afmdata in grp:
             self.append(afmdata)
         self.path = None
+        self.dtype = None
         return self
 
     def __iter__(self):
@@ -90,7 +130,174 @@ class AFMGroup(object):
         """
         if not isinstance(afmdata, AFMData):
             raise ValueError("`afmdata` must be an instance of `AFMData`!")
+        position = len(self._mmlist)
         self._mmlist.append(afmdata)
+        self._enum_index.setdefault(afmdata.enum, []).append(position)
+        self._path_index.setdefault(
+            self._resolve_path(afmdata.path), []).append(position)
+        self.revision += 1
+
+    def _resolve_path(self, path):
+        """Return the resolved `path` (cached for curve paths)"""
+        if path not in self._resolved_paths:
+            self._resolved_paths[path] = pathlib.Path(path).resolve()
+        return self._resolved_paths[path]
+
+    def _export_hdf5_packed(self, h5, metadata=True):
+        """Export all curves to the packed HDF5 layout
+
+        The data of each column of all curves are concatenated and
+        stored in one chunked dataset in the "columns" group. The
+        "offsets" dataset (length N+1) defines the start and stop
+        indices of each curve in these datasets. The metadata of all
+        curves are stored in the compound dataset "metadata" with one
+        row per curve (see :func:`afmformats.formats.fmt_hdf5.
+        load_hdf5_packed`). Only columns that are available in all
+        curves are exported. The data type of floating point columns
+        is the common data type of all curves (e.g. float32 if all
+        curves were loaded with `dtype="float32"`; float64 if the
+        data type of a curve is not known before loading its data).
+        All curves must have the same imaging modality.
+
+        Parameters
+        ----------
+        h5: h5py.Group or h5py.File
+            Destination group
+        metadata: bool or list
+            If True, all available metadata are stored. If False,
+            no metadata are stored. If a list, only the given
+            metadata keys are stored.
+        """
+        modalities = {afmdata.metadata["imaging mode"] for afmdata in self}
+        if len(modalities) > 1:
+            raise ValueError("Cannot export curves with different imaging "
+                             + f"modalities to one packed file: {modalities}")
+        h5.attrs["software"] = "afmformats"
+        h5.attrs["software version"] = version
+        h5.attrs["layout"] = "packed"
+
+        # offsets
+        sizes = [len(afmdata) for afmdata in self]
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        h5.create_dataset("offsets", data=offsets)
+
+        # column data
+        if len(self):
+            columns = sorted(set.intersection(
+                *[set(afmdata.columns) for afmdata in self]) - {"index"})
+        else:
+            columns = []
+        # Write the data in blocks that are aligned with the chunks of
+        # the dataset, so that each chunk is compressed only once.
+        size = int(offsets[-1])
+        chunk_size = min(PACKED_CHUNK_SIZE, size) or None
+        h5cols = h5.create_group("columns")
+        for col in columns:
+            dtype = np.dtype(column_dtypes.get(col, float))
+            if dtype.kind == "f":
+                dtype = np.result_type(
+                    *{_get_float_column_dtype(afmdata, col)
+                      for afmdata in self})
+            ds = h5cols.create_dataset(
+                name=col,
+                shape=(size,),
+                dtype=dtype,
+                chunks=None if chunk_size is None else (chunk_size,),
+                compression=None if chunk_size is None else "gzip",
+                fletcher32=chunk_size is not None)
+            ds.attrs["unit"] = column_units[col]
+            if chunk_size is None:
+                continue
+            block = np.empty(chunk_size, dtype=dtype)
+            filled = 0  # number of values in `block`
+            start = 0  # position of `block` in `ds`
+            for afmdata in self:
+                values = _get_column_view(afmdata, col)
+                pos = 0
+                while pos < values.size:
+                    num = min(chunk_size - filled, values.size - pos)
+                    block[filled:filled + num] = values[pos:pos + num]
+                    filled += num
+                    pos += num
+                    if filled == chunk_size:
+                        ds[start:start + chunk_size] = block
+                        start += chunk_size
+                        filled = 0
+            if filled:
+                ds[start:start + filled] = block[:filled]
+
+        # metadata
+        md_list = []
+        for afmdata in self:
+            md = afmdata.metadata
+            if isinstance(metadata, (list, tuple)):
+                md_list.append({key: md[key] for key in metadata})
+            elif isinstance(metadata, bool) and metadata:
+                md_list.append(md.as_dict())
+            else:
+                md_list.append({})
+        keys = sorted(set().union(*md_list) | {"enum", "imaging mode"})
+        fields = []
+        for key in keys:
+            if DEF_ALL[key][2] in [float, fint]:
+                # numeric value (missing values are NaN)
+                fields.append((key, float))
+            else:
+                # string value (missing values are empty strings)
+                fields.append((key, h5py.string_dtype()))
+        table = np.zeros(len(self), dtype=fields)
+        for ii, (afmdata, md) in enumerate(zip(self, md_list)):
+            md["enum"] = afmdata.enum
+            md["imaging mode"] = afmdata.metadata["imaging mode"]
+            for key, dtype in fields:
+                if key in md:
+                    value = md[key]
+                    table[key][ii] = value if dtype is float else str(value)
+                else:
+                    table[key][ii] = np.nan if dtype is float else ""
+        h5.create_dataset("metadata", data=table)
+
+    def export_data(self, out, metadata=True, fmt="hdf5-packed"):
+        """Export all curves to an HDF5 file
+
+        Parameters
+        ----------
+        out: str, pathlib.Path, or h5py.Group
+            Output path or h5py object
+        metadata: bool or list
+            If True, all available metadata are stored. If False,
+            no metadata are stored. If a list, only the given
+            metadata keys are stored.
+        fmt: str
+            "hdf5-packed" for the packed HDF5 layout, where the data of
+            all curves are stored in one dataset per column (fast to
+            load for many curves), or "hdf5" / "h5" for the HDF5 layout
+            with one group per curve (see
+            :func:`afmformats.afm_data.AFMData.export_data`)
+        """
+        if fmt not in ["hdf5-packed", "hdf5", "h5"]:
+            raise ValueError("Unexpected string for 'fmt': {}".format(fmt))
+        if isinstance(out, (pathlib.Path, str)):
+            # make sure the file is not open for reading
+            H5Cache.close(out)
+            # overrides always
+            h5 = h5py.File(out, "w")
+            close = True
+        elif isinstance(out, h5py.Group):
+            h5 = out
+            close = False
+        else:
+            raise ValueError("Unexpected object class for 'out': "
+                             + "'{}' for format 'hdf5'!".format(
+                                 out.__class__))
+        if fmt == "hdf5-packed":
+            self._export_hdf5_packed(h5, metadata=metadata)
+        else:
+            for afmdata in self:
+                afmdata.export_data(h5, metadata=metadata, fmt="hdf5")
+        if close:
+            h5.close()
 
     def get_enum(self, enum):
         """Return the AFMData curve with this enum value
@@ -100,14 +307,11 @@ class AFMGroup(object):
         ValueError if multiple curves with the same enum value exist.
         KeyError if the enum value is not found
         """
-        curves = []
-        for afmdata in self._mmlist:
-            if afmdata.enum == enum:
-                curves.append(afmdata)
-        if len(curves) == 0:
+        positions = self._enum_index.get(enum, [])
+        if len(positions) == 0:
             raise KeyError(f"Could not find dataset with enum '{enum}'!")
-        elif len(curves) == 1:
-            return curves[0]
+        elif len(positions) == 1:
+            return self._mmlist[positions[0]]
         else:
             raise ValueError(
                 f"Multiple curves with the enum value '{enum}' exist!")
@@ -119,8 +323,111 @@ class AFMGroup(object):
         """Return a subgroup with AFMData matching `path`"""
         path = pathlib.Path(path)
         subgroup = AFMGroup()
-        for afmdata in self:
-            if afmdata.path.samefile(path):
-                subgroup.append(afmdata)
+        for position in self._path_index.get(path.resolve(), []):
+            subgroup.append(self._mmlist[position])
         subgroup.path = path
         return subgroup
+
+    def to_arrays(self, columns=None, segment=None, padded=False,
+                  fill_value=np.nan):
+        """Return the column data of all curves as stacked arrays
+
+        The data of all curves are gathered in a single pass. This
+        allows vectorized operations across all curves with numpy
+        (e.g. with `np.add.reduceat` or with the padded 2D arrays).
+
+        Parameters
+        ----------
+        columns: list of str or None
+            Columns to return; if None, all columns that are available
+            in all curves are returned
+        segment: int or None
+            If set, only return the data of this segment (e.g. 0 for
+            the approach and 1 for the retract part of force-distance
+            curves); if None, the entire curves are returned
+        padded: bool
+            If False (default), return one flat array per column in
+            which the data of all curves are concatenated (ragged
+            array). If True, return one 2D array per column with
+            one row per curve; rows of curves shorter than the
+            longest curve are filled with `fill_value`.
+        fill_value: float
+            Value for padding the 2D arrays if `padded` is True
+
+        Returns
+        -------
+        data: dict
+            Column names as keys and float64 ndarrays as values
+            (1D or 2D depending on `padded`)
+        offsets: 1d ndarray of int64
+            Start and stop indices (length N+1 for N curves) of each
+            curve in the flat arrays; curve `ii` has the data
+            `data[column][offsets[ii]:offsets[ii+1]]`
+            (also returned if `padded` is True, the curve lengths
+            are given by `np.diff(offsets)`)
+        """
+        if columns is None:
+            if len(self):
+                columns = sorted(set.intersection(
+                    *[set(afmdata.columns) for afmdata in self]))
+            else:
+                columns = []
+        parts = {col: [] for col in columns}
+        sizes = np.zeros(len(self), dtype=np.int64)
+        for ii, afmdata in enumerate(self):
+            if segment is None:
+                indices = slice(None)
+            else:
+                indices = get_segment_indices(
+                    _get_column_view(afmdata, "segment"), segment)
+            for col in columns:
+                parts[col].append(_get_column_view(afmdata, col)[indices])
+            if columns:
+                sizes[ii] = parts[columns[0]][-1].size
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+
+        data = {}
+        for col in columns:
+            if padded:
+                width = sizes.max() if sizes.size else 0
+                arr = np.full((len(self), width), fill_value,
+                              dtype=np.float64)
+                for ii, part in enumerate(parts[col]):
+                    arr[ii, :part.size] = part
+            else:
+                arr = np.empty(offsets[-1], dtype=np.float64)
+                if parts[col]:
+                    np.concatenate(parts[col], out=arr, casting="unsafe")
+            data[col] = arr
+        return data, offsets
+
+
+def _get_float_column_dtype(afmdata, column):
+    """Return the data type of a floating point column without loading it
+
+    The data type is taken from data that are already in memory or
+    from the data type declared by :class:`LazyData`. If the data type
+    cannot be determined without loading the data, float64 is returned
+    (which does not lose precision).
+    """
+    if column in afmdata._data:
+        return np.asarray(afmdata._data[column]).dtype
+    raw = afmdata._raw_data
+    if isinstance(raw, LazyData):
+        if raw.dtype is not None:
+            return raw.dtype
+    elif isinstance(raw, dict):
+        return np.asarray(raw[column]).dtype
+    return np.dtype(float)
+
+
+def _get_column_view(afmdata, column):
+    """Return column data of `afmdata` without copying them"""
+    if column in afmdata._data:
+        return np.asarray(afmdata._data[column])
+    elif column in afmdata._raw_data:
+        return np.asarray(afmdata._raw_data[column])
+    else:
+        # e.g. "index" (raises KeyError for undefined columns)
+        return afmdata[column]
@@ -1,20 +1,27 @@
+from collections import OrderedDict
 import functools
+import logging
+import weakref
 
 import numpy as np
 
-from .afm_group import AFMGroup
+from .afm_data import get_global_data_revision
+from .afm_group import AFMGroup, _get_column_view
+from .diskcache import FeatureDiskCache
 from .meta import META_FIELDS
 
 
-__all__ = ["AFMQMap", "qmap_feature", "unit_scales"]
+__all__ = ["AFMQMap", "FeatureCache", "qmap_feature", "unit_scales"]
 
+logger = logging.getLogger(__name__)
 
-def qmap_feature(name, unit, cache=False):
+
+def qmap_feature(name, unit, cache=False, batch=False):
     """Decorator for labeling AFMQMap features
 
     The name and unit are stored as properties of the wrapped function.
-    In addition, the return value of the function can be cached (see
-    `cache` argument).
+    In addition, the return value of the function can be cached by
+    :class:`AFMQMap` (see `cache` argument and :class:`FeatureCache`).
 
     Parameters
     ----------
@@ -28,6 +35,18 @@ def qmap_feature(name, unit, cache=False):
         of AFMData as an argument and should return an identifier
         (str) for the current value. If that identifier is the
         same as in the cache, then the cached value is used.
+        Cached values are always invalidated when the data of
+        the curve are modified (see
+        :func:`afmformats.afm_data.AFMData.data_revision`).
+    batch: bool
+        If True, the wrapped function is a batched feature: it gets
+        an :class:`AFMGroup` as an argument and must return an array
+        with one value per curve. Batched features are cached per
+        curve like other features; if cached values are available
+        for some of the curves, only the remaining curves are passed
+        to the function. A feature may have a per-curve and a
+        batched implementation (with the same `name`), in which
+        case :class:`AFMQMap` uses the batched implementation.
     """
     def attribute_setter(func):
         """Decorator that sets the necessary attributes
@@ -38,51 +57,187 @@ def qmap_feature(name, unit, cache=False):
         """
         func.name = name
         func.unit = unit
+        func.batch = batch
         if isinstance(cache, bool):
             if cache:
                 # cache everything once
                 func.cache_mode = "static"
-                func.cache_values = {}
             else:
                 # disable caching
                 func.cache_mode = "disabled"
-        else:
-            assert isinstance(cache, callable)
+        elif callable(cache):
             func.cache_mode = "variable"
-            func.cache_values = {}
-            func.cache_ids = {}
             func.cache_getid = cache
+        else:
+            raise ValueError("`cache` must be a boolean or a callable!")
 
         @functools.wraps(func)
-        def cached_func(afmdata):
-            afmdataid = hex(id(afmdata))
-            if func.cache_mode == "disabled":
-                # no caching
-                return func(afmdata)
-            elif func.cache_mode == "static":
-                # caching is done only once
-                if afmdataid not in func.cache_values:
-                    func.cache_values[afmdataid] = func(afmdata)
-                return func.cache_values[afmdataid]
+        def feature_func(afmdata):
+            if func.batch:
+                # `afmdata` is the entire group
+                return np.asarray(func(afmdata), dtype=float)
             else:
-                # we have to check whether we have to recompute
-                cid = func.cache_getid(afmdata)
-                assert cid, "Must not be empty string"
-                if func.cache_ids.get(afmdataid, "") != cid:
-                    # recompute the value
-                    func.cache_values[afmdataid] = func(afmdata)
-                    func.cache_ids[afmdataid] = cid
-                return func.cache_values[afmdataid]
+                return func(afmdata)
 
-        return cached_func
+        return feature_func
 
     return attribute_setter
 
 
+class FeatureCache(object):
+    """Size-limited LRU cache for the feature values of AFMQMap
+
+    Entries are keyed by the curve (instance of
+    :class:`afmformats.afm_data.AFMData`) and the feature name.
+    The cache only holds weak references to the curves; when a
+    curve is garbage-collected, its entries are removed. Entries
+    are invalid when the data of a curve were modified (see
+    :func:`afmformats.afm_data.AFMData.data_revision`) or when
+    the cache identifier of a feature changed (see
+    :func:`qmap_feature`).
+
+    In addition, the values of all curves of a group can be stored
+    as one vector per feature (see :func:`get_vector`), such that
+    they can be retrieved without looking up each curve.
+    """
+    def __init__(self, max_entries=2**20):
+        """
+        Parameters
+        ----------
+        max_entries: int
+            Maximum number of cached values; the least recently
+            used entries are evicted to stay below it
+        """
+        #: Maximum number of cached values
+        self.max_entries = max_entries
+        #: Number of cache hits
+        self.hits = 0
+        #: Number of cache misses (including invalid entries)
+        self.misses = 0
+        #: Number of entries evicted due to `max_entries`
+        self.evictions = 0
+        # maps (curve id, feature) to (data revision, cache id, value)
+        self._entries = OrderedDict()
+        # maps curve ids to weak references and cached features
+        self._owners = {}
+        # maps features to (key, values of all curves)
+        self._vectors = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard_owner(self, owner_id):
+        """Remove all entries of the curve with the given `id`"""
+        _, features = self._owners.pop(owner_id, (None, []))
+        for feature in features:
+            self._entries.pop((owner_id, feature), None)
+
+    def _pop(self, key):
+        """Remove an entry"""
+        self._entries.pop(key)
+        features = self._owners[key[0]][1]
+        features.discard(key[1])
+        if not features:
+            self._owners.pop(key[0])
+
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        self._entries.clear()
+        self._owners.clear()
+        self._vectors.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, afmdata, feature, cache_id=None):
+        """Return the cached value or None if there is no valid entry
+
+        Parameters
+        ----------
+        afmdata: afmformats.afm_data.AFMData
+            AFM data
+        feature: str
+            Name of the feature
+        cache_id: str or None
+            Identifier of the current value (see :func:`qmap_feature`)
+        """
+        key = (id(afmdata), feature)
+        entry = self._entries.get(key)
+        if (entry is not None
+                and entry[0] == afmdata.data_revision
+                and entry[1] == cache_id):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+        else:
+            self.misses += 1
+            return None
+
+    def get_vector(self, feature, key):
+        """Return the cached values of all curves or None
+
+        Parameters
+        ----------
+        feature: str
+            Name of the feature
+        key: hashable
+            Identifier of the current state of the curves (e.g. the
+            revisions of the group and of the data); the vector is
+            only returned if it was stored with the same key
+        """
+        entry = self._vectors.get(feature)
+        if entry is not None and entry[0] == key:
+            # one hit per curve, like for the individual entries
+            self.hits += entry[1].size
+            return entry[1].copy()
+        return None
+
+    def get_stats(self):
+        """Return a dictionary with the cache statistics"""
+        total = self.hits + self.misses
+        return {"entries": len(self._entries),
+                "evictions": self.evictions,
+                "hit rate": self.hits / total if total else 0,
+                "hits": self.hits,
+                "max entries": self.max_entries,
+                "misses": self.misses,
+                }
+
+    def invalidate(self, afmdata=None):
+        """Remove the entries of a curve or of all curves (if None)"""
+        if afmdata is None:
+            self._entries.clear()
+            self._owners.clear()
+        else:
+            self._discard_owner(id(afmdata))
+        self._vectors.clear()
+
+    def set(self, afmdata, feature, value, cache_id=None):
+        """Add an entry to the cache (see :func:`get` for parameters)"""
+        owner_id = id(afmdata)
+        if owner_id not in self._owners:
+            # remove all entries of the curve when it is garbage-collected
+            ref = weakref.ref(afmdata,
+                              lambda _: self._discard_owner(owner_id))
+            self._owners[owner_id] = (ref, set())
+        key = (owner_id, feature)
+        self._entries[key] = (afmdata.data_revision, cache_id, value)
+        self._entries.move_to_end(key)
+        self._owners[owner_id][1].add(feature)
+        while len(self._entries) > self.max_entries:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def set_vector(self, feature, key, values):
+        """Store the values of all curves (see :func:`get_vector`)"""
+        self._vectors[feature] = (key, np.array(values, dtype=float))
+
+
 class AFMQMap:
     """Management of quantitative AFM data on a grid"""
     def __init__(self, path_or_group, meta_override=None, callback=None,
-                 modality=None, data_classes_by_modality=None):
+                 modality=None, data_classes_by_modality=None,
+                 workers=None, diskcache=False, dtype=None):
         """
         Parameters
         ----------
@@ -100,6 +255,17 @@ class AFMQMap:
             used by :ref:`nanite:index` to pass `Indentation` (which is a
             subclass of the default `AFMForceDistance`) for handling
             "force-indentation" data.
+        workers: int or None
+            Number of worker threads for decoding the data concurrently
+            (see :func:`afmformats.formats.load_data`)
+        diskcache: bool
+            Whether to store the values of features that are cached
+            statically (see :func:`qmap_feature`) on disk, such that
+            they are available instantly when the same file is opened
+            again (see :class:`afmformats.diskcache.FeatureDiskCache`)
+        dtype: np.dtype or str or None
+            Data type of the floating point columns, e.g. "float32"
+            (see :func:`afmformats.formats.load_data`)
         """
         if isinstance(path_or_group, AFMGroup):
             group = path_or_group
@@ -107,14 +273,29 @@ class AFMQMap:
                 raise ValueError(
                     "Specifying `meta_override` for an AFMGroup instance "
                     "that is already populated is meaningless.")
+            if dtype is not None:
+                raise ValueError(
+                    "Specifying `dtype` for an AFMGroup instance "
+                    "that is already populated is meaningless.")
         else:
             group = AFMGroup(path=path_or_group,
                              meta_override=meta_override,
                              callback=callback,
                              modality=modality,
-                             data_classes_by_modality=data_classes_by_modality)
+                             data_classes_by_modality=data_classes_by_modality,
+                             workers=workers,
+                             dtype=dtype)
         #: AFM data (instance of :class:`afmformats.afm_group.AFMGroup`)
         self.group = group
+        #: Cache for the values of per-curve features
+        #: (see :class:`FeatureCache`)
+        self.feature_cache = FeatureCache()
+        # coordinates and grid indices (see `_check_group_changed`)
+        self._coords = {}
+        self._flat_grid_indices = None
+        self._group_revision = None
+        self._diskcache = diskcache
+        self._feature_diskcache = None
 
         # sanity check (make sure that all necessary metadata are available)
         missing_keys = []
@@ -133,12 +314,144 @@ class AFMQMap:
         fnames = [f for f in dir(self) if f.startswith("feat_")]
         for fn in fnames:
             func = getattr(self, fn)
+            if func.name in self._feature_funcs:
+                # There is a per-curve and a batched implementation of
+                # the feature; the batched implementation is used.
+                other = self._feature_funcs[func.name]
+                assert func.batch != other.batch
+                assert func.unit == other.unit
+                if func.batch:
+                    self._feature_funcs[func.name] = func
+                continue
             assert func.name not in self._feature_funcs
             assert func.name not in self._feature_units
             self._feature_funcs[func.name] = func
             self._feature_units[func.name] = func.unit
             self.features.append(func.name)
 
+    def _get_feature_value(self, ffunc, afmdata):
+        """Compute a per-curve feature, using `self.feature_cache`"""
+        if ffunc.cache_mode == "disabled":
+            return ffunc(afmdata)
+        elif ffunc.cache_mode == "static":
+            cid = None
+        else:
+            cid = ffunc.cache_getid(afmdata)
+            assert cid, "Must not be empty string"
+        value = self.feature_cache.get(afmdata, ffunc.name, cid)
+        if value is None:
+            value = ffunc(afmdata)
+            self.feature_cache.set(afmdata, ffunc.name, value, cid)
+        return value
+
+    def _get_batch_feature_values(self, ffunc):
+        """Compute a batched feature, using `self.feature_cache`
+
+        The feature function is only called for the curves for
+        which there are no valid entries in the cache.
+        """
+        if ffunc.cache_mode == "disabled":
+            return self._call_batch_feature(ffunc, self.group)
+        values = np.zeros(len(self.group))
+        missing = []
+        missing_cids = []
+        for ii, afmdata in enumerate(self.group):
+            if ffunc.cache_mode == "static":
+                cid = None
+            else:
+                cid = ffunc.cache_getid(afmdata)
+                assert cid, "Must not be empty string"
+            value = self.feature_cache.get(afmdata, ffunc.name, cid)
+            if value is None:
+                missing.append(ii)
+                missing_cids.append(cid)
+            else:
+                values[ii] = value
+        if missing:
+            if len(missing) == len(self.group):
+                subgroup = self.group
+            else:
+                subgroup = AFMGroup()
+                for ii in missing:
+                    subgroup.append(self.group[ii])
+            new_values = self._call_batch_feature(ffunc, subgroup)
+            values[missing] = new_values
+            for ii, cid, value in zip(missing, missing_cids, new_values):
+                self.feature_cache.set(self.group[ii], ffunc.name, value,
+                                       cid)
+        return values
+
+    @staticmethod
+    def _call_batch_feature(ffunc, group):
+        """Call a batched feature function and check its return value"""
+        values = ffunc(group)
+        if values.shape != (len(group),):
+            raise ValueError(
+                f"Batched feature '{ffunc.name}' returned {values.shape} "
+                f"values for {len(group)} curves!")
+        return values
+
+    def _get_feature_diskcache(self):
+        """Return the persistent feature cache or None if not applicable
+
+        The persistent cache is only used for unmodified data
+        from a single file.
+        """
+        if not self._diskcache or self.group.path is None:
+            return None
+        for afmdata in self.group:
+            if afmdata.data_revision or afmdata.path != self.group[0].path:
+                return None
+        if self._feature_diskcache is None:
+            md = self.group[0].metadata
+            key_data = {"metadata": {key: md[key] for key in md},
+                        "curves": len(self.group)}
+            if self.group.dtype is not None:
+                # features may depend on the precision of the data
+                key_data["dtype"] = self.group.dtype.name
+            try:
+                self._feature_diskcache = FeatureDiskCache(
+                    self.group[0].path, key_data=key_data)
+            except OSError:
+                logger.warning("Feature disk cache not available for '%s'",
+                               self.group.path, exc_info=True)
+                self._diskcache = False
+        return self._feature_diskcache
+
+    def _check_group_changed(self):
+        """Invalidate cached coordinates if `self.group` changed
+
+        The coordinates (see :func:`get_coords`) and the grid indices
+        (see :func:`_get_flat_grid_indices`) are cached for the curves
+        currently in `self.group`. Curves may be added to the group
+        at any time, so the revision of the group (see
+        :data:`afmformats.afm_group.AFMGroup.revision`) is checked
+        before the cached values are used.
+        """
+        revision = (id(self.group), self.group.revision)
+        if revision != self._group_revision:
+            self._coords.clear()
+            self._flat_grid_indices = None
+            self._group_revision = revision
+
+    def _get_flat_grid_indices(self):
+        """Return the indices of all curves in the flattened 2D map
+
+        The indices are computed from :func:`get_coords` once and
+        then cached.
+        """
+        self._check_group_changed()
+        if self._flat_grid_indices is None:
+            coords = self.get_coords(which="px")
+            self._flat_grid_indices = self._coords_to_flat_indices(coords)
+        return self._flat_grid_indices
+
+    def _coords_to_flat_indices(self, coords):
+        """Convert pixel coordinates to indices in the flattened map"""
+        coords = np.asarray(coords, dtype=int).reshape(-1, 2)
+        xn = int(self.shape[0])
+        return coords[:, 1] * xn + coords[:, 0]
+
     def _map_grid(self, coords, map_data):
         """Create a 2D map from 1D coordinates and data
 
@@ -148,8 +461,10 @@ class AFMQMap:
 
         Parameters
         ----------
-        coords: list-like (length N) with tuple of ints
-            The x- and y-coordinates [px].
+        coords: list-like (length N) with tuple of ints or None
+            The x- and y-coordinates [px]. If set to None, the
+            (cached) pixel coordinates of the curves in `self.group`
+            are used.
         map_data: list-like (length N)
             The data to be mapped.
 
@@ -163,8 +478,11 @@ class AFMQMap:
         shape = self.shape
         extent = self.extent
 
-        coords = np.array(coords)
-        map_data = np.array(map_data)
+        if coords is None:
+            flat_indices = self._get_flat_grid_indices()
+        else:
+            flat_indices = self._coords_to_flat_indices(coords)
+        map_data = np.asarray(map_data, dtype=float)
 
         xn, yn = int(shape[0]), int(shape[1])
 
@@ -177,12 +495,8 @@ class AFMQMap:
         y += dy/2
 
         # Output map
-        map2d = np.zeros((yn, xn), dtype=float)*np.nan
-        for ii in range(map_data.shape[0]):
-            # Determine the coordinate in the output array
-            xi, yi = coords[ii]
-            # Write to the output array
-            map2d[yi, xi] = map_data[ii]
+        map2d = np.full((yn, xn), np.nan, dtype=float)
+        map2d.flat[flat_indices] = map_data
 
         return x, y, map2d
 
@@ -238,7 +552,43 @@ class AFMQMap:
         """Return the enumeration of the dataset"""
         return afmdata.enum
 
-    @functools.lru_cache(maxsize=32)
+    @staticmethod
+    @qmap_feature(name="data: height base point",
+                  unit="µm",
+                  cache=True,
+                  batch=True)
+    def feat_batch_core_data_height_base_point_um(group):
+        """Compute the lowest height (measured) of all curves
+
+        The curves are processed one after another without copying
+        the data; empty curves yield NaN.
+        """
+        height = np.full(len(group), np.nan)
+        for ii, afmdata in enumerate(group):
+            values = _get_column_view(afmdata, "height (measured)")
+            if values.size:
+                height[ii] = np.min(values)
+        return height / unit_scales["µ"]
+
+    @staticmethod
+    @qmap_feature(name="data: piezo range",
+                  unit="µm",
+                  cache=True,
+                  batch=True)
+    def feat_batch_core_data_piezo_range_um(group):
+        """Compute peak-to-peak piezo range of all curves"""
+        zrange = np.array([ad.metadata["z range"] for ad in group])
+        return zrange / unit_scales["µ"]
+
+    @staticmethod
+    @qmap_feature(name="data: scan order",
+                  unit="",
+                  cache=True,
+                  batch=True)
+    def feat_batch_core_data_scan_order(group):
+        """Return the enumeration of all datasets"""
+        return np.array([ad.enum for ad in group])
+
     def get_coords(self, which="px"):
         """Get the qmap coordinates for each curve in `AFMQMap.group`
 
@@ -250,6 +600,10 @@ class AFMQMap:
         if which not in ["px", "um"]:
             raise ValueError("`which` must be 'px' or 'um'!")
 
+        self._check_group_changed()
+        if which in self._coords:
+            return self._coords[which]
+
         if which == "px":
             kx = "grid index x"
             ky = "grid index y"
@@ -264,7 +618,77 @@ class AFMQMap:
             # ensured by the file format reader for qmaps.
             cc = [afmdata.metadata[kx] * mult, afmdata.metadata[ky] * mult]
             coords.append(cc)
-        return np.array(coords)
+        self._coords[which] = np.array(coords)
+        return self._coords[which]
+
+    def get_feature_data(self, features):
+        """Compute the values of features for all curves
+
+        All features are computed in a single pass over the data,
+        i.e. the data of each curve are accessed for all per-curve
+        features before moving on to the next curve. Batched
+        features (see :func:`qmap_feature`) are computed for
+        all (uncached) curves at once.
+
+        Parameters
+        ----------
+        features: list of str
+            Features to compute (see :data:`AFMQMap.features`)
+
+        Returns
+        -------
+        feature_data: dict
+            1d ndarrays (one value per curve) for each feature
+        """
+        ffuncs = [self._feature_funcs[ft] for ft in features]
+        feature_data = {}
+        pending = []
+        # The values of statically cached features are valid as long
+        # as no curve was added to the group and no data were modified.
+        vector_key = (id(self.group), self.group.revision,
+                      get_global_data_revision())
+        for ft, ffunc in zip(features, ffuncs):
+            values = None
+            if ffunc.cache_mode == "static":
+                values = self.feature_cache.get_vector(ft, vector_key)
+            if values is None:
+                pending.append((ft, ffunc))
+            else:
+                feature_data[ft] = values
+        if any(ff.cache_mode == "static" for (_, ff) in pending):
+            diskcache = self._get_feature_diskcache()
+        else:
+            diskcache = None
+        if diskcache is not None:
+            for ft, ffunc in list(pending):
+                if ffunc.cache_mode == "static":
+                    values = diskcache.get(ft)
+                    if values is not None and values.shape == (
+                            len(self.group),):
+                        feature_data[ft] = values
+                        self.feature_cache.set_vector(ft, vector_key, values)
+                        pending.remove((ft, ffunc))
+        # batched features
+        for ft, ffunc in pending:
+            if ffunc.batch:
+                feature_data[ft] = self._get_batch_feature_values(ffunc)
+        # per-curve features
+        curve_features = [(ft, ff) for (ft, ff) in pending if not ff.batch]
+        if curve_features:
+            values = np.zeros((len(curve_features), len(self.group)))
+            for ii, afmdata in enumerate(self.group):
+                for jj, (_, ffunc) in enumerate(curve_features):
+                    values[jj, ii] = self._get_feature_value(ffunc,
+                                                             afmdata)
+            for jj, (ft, _) in enumerate(curve_features):
+                feature_data[ft] = values[jj]
+        for ft, ffunc in pending:
+            if ffunc.cache_mode == "static":
+                self.feature_cache.set_vector(ft, vector_key,
+                                              feature_data[ft])
+                if diskcache is not None:
+                    diskcache.set(ft, feature_data[ft])
+        return {ft: feature_data[ft] for ft in features}
 
     def get_qmap(self, feature, qmap_only=False):
         """Return the quantitative map for a feature
@@ -285,19 +709,44 @@ class AFMQMap:
         qmap: 2d ndarray
             Quantitative map
         """
-        coords = self.get_coords(which="px")
+        if qmap_only:
+            return self.get_qmaps([feature], qmap_only=True)[feature]
+        else:
+            x, y, qmaps = self.get_qmaps([feature])
+            return x, y, qmaps[feature]
 
-        map_data = []
-        ffunc = self._feature_funcs[feature]
-        for afmdata in self.group:
-            val = ffunc(afmdata)
-            map_data.append(val)
+    def get_qmaps(self, features, qmap_only=False):
+        """Return the quantitative maps for multiple features
+
+        This is faster than calling :func:`get_qmap` for each
+        feature, because the data of each curve are accessed
+        only once (see :func:`get_feature_data`).
 
-        x, y, qmap = self._map_grid(coords=coords, map_data=map_data)
+        Parameters
+        ----------
+        features: list of str
+            Features to compute maps for (see :data:`QMap.features`)
+        qmap_only:
+            Only return the quantitative map data,
+            not the coordinates
+
+        Returns
+        -------
+        x, y: 1d ndarray
+            Only returned if `qmap_only` is False; Pixel grid
+            coordinates along x and y
+        qmaps: dict of 2d ndarrays
+            Quantitative map for each feature
+        """
+        feature_data = self.get_feature_data(features)
+        qmaps = {}
+        for ft in features:
+            x, y, qmaps[ft] = self._map_grid(coords=None,
+                                             map_data=feature_data[ft])
         if qmap_only:
-            return qmap
+            return qmaps
         else:
-            return x, y, qmap
+            return x, y, qmaps
 
 
 #: Scale conversion helper
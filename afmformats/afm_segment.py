@@ -6,7 +6,10 @@ __all__ = ["AFMSegment"]
 class AFMSegment(object):
     """Simple wrapper around dict-like `data` to expose a single segment
 
-    This class also caches the segment indices.
+    This class also caches the segment indices. If the segment is a
+    contiguous run in the data (which is the case for all supported
+    file formats), the indices are stored as a `slice` and column
+    data are accessed via basic slicing.
     """
     def __init__(self, raw_data, data, segment):
         """New Segment data
@@ -30,39 +33,62 @@ class AFMSegment(object):
         self._raw_data = raw_data
         self._data = data
 
+        #: Return read-only views instead of copies (if possible)
+        #: (see :func:`afmformats.afm_data.AFMData.zero_copy`)
+        self.zero_copy = False
+
         self._raw_segment_indices = None
         self._user_segment_indices = None
 
     def __getitem__(self, key):
         """Access column data of the segment"""
         if key in self._data:
-            return self._data[key][self.segment_indices]
+            data = self._data[key]
         elif key in self._raw_data:
-            return self._raw_data[key][self.segment_indices].copy()
+            data = self._raw_data[key]
         else:
             raise KeyError("Undefined column '{}'!".format(key))
+        indices = self.segment_indices
+        if isinstance(indices, slice):
+            data = np.asarray(data)[indices]
+            if self.zero_copy:
+                data = data.view()
+                data.flags.writeable = False
+            else:
+                data = data.copy()
+        else:
+            # boolean indexing already returns a copy
+            data = data[indices]
+        return data
 
     def __setitem__(self, key, data):
         """Set column data of the segment"""
         if key not in self._data and key not in self._raw_data:
             raise KeyError("Undefined column '{}'!".format(key))
-        elif key not in self._data:
-            self._data[key] = np.array(self._raw_data[key], copy=True)
-        self._data[key][self.segment_indices] = data
+        elif key in self._data:
+            column = self._data[key]
+        else:
+            column = np.array(self._raw_data[key], copy=True)
+        column[self.segment_indices] = data
+        # always (re)assign so that `data` can keep track of changes
+        self._data[key] = column
 
     @property
     def segment_indices(self):
-        """boolean array of segment indices"""
+        """slice or boolean array of segment indices
+
+        A slice is returned if the segment is contiguous.
+        """
         if "segment" in self._data:  # data takes precedence (user-edited)
             if self._user_segment_indices is None:
-                self._user_segment_indices = \
-                    self._data["segment"] == self.segment
+                self._user_segment_indices = get_segment_indices(
+                    self._data["segment"], self.segment)
             indices = self._user_segment_indices
         elif "segment" in self._raw_data:
             # indices from raw data can safely be cached (will not change)
             if self._raw_segment_indices is None:
-                self._raw_segment_indices = \
-                    self._raw_data["segment"] == self.segment
+                self._raw_segment_indices = get_segment_indices(
+                    self._raw_data["segment"], self.segment)
             indices = self._raw_segment_indices
         else:
             raise ValueError("Could not identify segment data!")
@@ -71,3 +97,32 @@ class AFMSegment(object):
     def clear_cache(self):
         """Invalidates the segment indices corresponding to `self.data`"""
         self._user_segment_indices = None
+
+
+def get_segment_indices(segment_data, segment):
+    """Return the indices of a segment in the "segment" column
+
+    Parameters
+    ----------
+    segment_data: 1d ndarray
+        Data of the "segment" column
+    segment: int
+        The segment to find
+
+    Returns
+    -------
+    indices: slice or 1d boolean ndarray
+        If the segment is a contiguous run in `segment_data`, a slice,
+        otherwise a boolean array with the same length as
+        `segment_data`.
+    """
+    mask = np.asarray(segment_data) == segment
+    size = np.count_nonzero(mask)
+    if size == 0:
+        return slice(0, 0)
+    start = int(np.argmax(mask))
+    stop = start + size
+    if mask[start:stop].all():
+        return slice(start, stop)
+    else:
+        return mask
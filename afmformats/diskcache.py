@@ -0,0 +1,489 @@
+"""Persistent on-disk caches
+
+The cache files are stored in a user-specific cache directory (see
+:func:`get_cache_dir`). Cache entries are keyed by a signature of the
+source file (path, size, modification time, and optionally a content
+hash) and by the afmformats version, such that modified files and
+updates of afmformats never yield stale data.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from ._version import version
+from .lazy_loader import LazyData
+from .meta import MetaData
+
+__all__ = ["ArrayDiskCache", "FeatureDiskCache", "ScanIndex",
+           "get_cache_dir", "get_file_signature", "get_scan_index"]
+
+logger = logging.getLogger(__name__)
+
+#: Environment variable that overrides the default cache directory
+CACHE_DIR_ENV = "AFMFORMATS_CACHE_DIR"
+
+#: Default maximum size of the :class:`ArrayDiskCache` [bytes]
+ARRAY_CACHE_MAX_BYTES = 4 * 1024**3
+
+#: Number of bytes at the beginning and at the end of a file that
+#: are used for computing the content hash in :func:`get_file_signature`
+HASH_CHUNK_SIZE = 1024**2
+
+
+def get_cache_dir(name=None):
+    """Return the afmformats cache directory
+
+    The directory is taken from the environment variable
+    "AFMFORMATS_CACHE_DIR" if it is set. Otherwise, the
+    platform-specific user cache directory is used (e.g.
+    "~/.cache/afmformats" on Linux).
+
+    Parameters
+    ----------
+    name: str
+        Name of a subdirectory for a specific cache
+
+    Returns
+    -------
+    cache_dir: pathlib.Path
+        The cache directory (created if it does not exist)
+    """
+    path = os.environ.get(CACHE_DIR_ENV)
+    if path:
+        cache_dir = pathlib.Path(path)
+    elif sys.platform.startswith("win"):
+        base = os.environ.get("LOCALAPPDATA") or tempfile.gettempdir()
+        cache_dir = pathlib.Path(base) / "afmformats" / "Cache"
+    elif sys.platform == "darwin":
+        cache_dir = pathlib.Path.home() / "Library" / "Caches" / "afmformats"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or (
+            pathlib.Path.home() / ".cache")
+        cache_dir = pathlib.Path(base) / "afmformats"
+    if name is not None:
+        cache_dir = cache_dir / name
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_file_signature(path, content_hash=True):
+    """Return a dictionary that identifies the current state of a file
+
+    The signature consists of the resolved path, the file size,
+    the modification time, and (if `content_hash` is True) a SHA256
+    hash of the first and last :data:`HASH_CHUNK_SIZE` bytes of the
+    file (hashing the entire file would defeat the purpose of caching
+    for large files).
+    """
+    path = pathlib.Path(path).resolve()
+    stat = path.stat()
+    signature = {"path": str(path),
+                 "size": stat.st_size,
+                 "mtime": stat.st_mtime_ns,
+                 }
+    if content_hash:
+        hasher = hashlib.sha256()
+        with path.open("rb") as fd:
+            hasher.update(fd.read(HASH_CHUNK_SIZE))
+            if stat.st_size > 2 * HASH_CHUNK_SIZE:
+                fd.seek(-HASH_CHUNK_SIZE, os.SEEK_END)
+            hasher.update(fd.read(HASH_CHUNK_SIZE))
+        signature["hash"] = hasher.hexdigest()
+    return signature
+
+
+def get_key(**kwargs):
+    """Return a hexadecimal hash for the JSON-serializable `kwargs`"""
+    dump = json.dumps(dict(kwargs, version=version), sort_keys=True,
+                      default=str)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+
+def save_array(path, array):
+    """Atomically save `array` to the .npy file `path`"""
+    path = pathlib.Path(path)
+    tmp = path.with_name(path.name + ".{}.tmp".format(os.getpid()))
+    with tmp.open("wb") as fd:
+        np.save(fd, array, allow_pickle=False)
+    os.replace(tmp, path)
+
+
+class ArrayDiskCache(object):
+    """Persistent cache for decoded AFM data
+
+    For every data file, the metadata and the decoded column data
+    of all curves are stored in a subdirectory of the cache directory
+    (one .npy file per column and curve). When the same file is loaded
+    again, the column data are served as memory-mapped arrays. Cache
+    entries are invalidated when the size or the modification time of
+    the data file changes. The least recently used entries are removed
+    when the total size of the cache exceeds `max_bytes`.
+    """
+    #: Name of the file in an entry directory that contains the metadata
+    index_name = "curves.json"
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+        Parameters
+        ----------
+        cache_dir: str or pathlib.Path
+            Cache directory; defaults to the "arrays" subdirectory
+            of :func:`get_cache_dir`
+        max_bytes: int
+            Maximum total size of the cache [bytes]; defaults to
+            :data:`ARRAY_CACHE_MAX_BYTES`
+        """
+        if cache_dir is None:
+            cache_dir = get_cache_dir("arrays")
+        if max_bytes is None:
+            max_bytes = ARRAY_CACHE_MAX_BYTES
+        #: Cache directory
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        #: Maximum total size of the cache [bytes]
+        self.max_bytes = max_bytes
+
+    def _get_entry_dir(self, path, key_data):
+        signature = get_file_signature(path, content_hash=False)
+        key = get_key(key_data=key_data, **signature)
+        return self.cache_dir / key
+
+    def clear(self):
+        """Remove all cache entries"""
+        for entry in self.cache_dir.iterdir():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def evict(self):
+        """Remove least recently used entries until below `max_bytes`"""
+        entries = []
+        total = 0
+        for entry in self.cache_dir.iterdir():
+            if not entry.is_dir() or entry.suffix == ".tmp":
+                # ignore entries that are currently being written
+                continue
+            index = entry / self.index_name
+            try:
+                size = sum(ff.stat().st_size for ff in entry.iterdir())
+                # incomplete entries are removed first
+                last_used = index.stat().st_mtime if index.exists() else 0
+            except OSError:
+                # entry was removed by another process
+                continue
+            entries.append((last_used, size, entry))
+            total += size
+        for _, size, entry in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logger.debug("Evicted '%s' from the array cache", entry.name)
+
+    def get(self, path, key_data=None):
+        """Return the cached datasets of a data file or None
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Path to the data file
+        key_data: dict
+            Additional JSON-serializable data that the cached data
+            depend on (e.g. overridden metadata)
+
+        Returns
+        -------
+        datasets: list of dict or None
+            List of dictionaries with the keys "data" (dict-like
+            with memory-mapped arrays that are lazily loaded) and
+            "metadata" (dict); None if there is no valid entry
+        """
+        entry = self.get_entry(path, key_data=key_data)
+        return None if entry is None else entry["datasets"]
+
+    def get_entry(self, path, key_data=None):
+        """Return the cached datasets and info of a data file or None
+
+        This is :func:`get` with the additional information that
+        was passed to :func:`set` via `info`.
+
+        Returns
+        -------
+        entry: dict or None
+            Dictionary with the keys "datasets" (see :func:`get`) and
+            "info" (dict); None if there is no valid entry
+        """
+        entry = self._get_entry_dir(path, key_data)
+        index = entry / self.index_name
+        try:
+            content = json.loads(index.read_text(encoding="utf-8"))
+            curves = content["curves"]
+            # keep track of the last access (LRU)
+            os.utime(index)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.warning("Ignoring corrupt array cache entry '%s'", entry)
+            return None
+        datasets = []
+        for ii, curve in enumerate(curves):
+            data = LazyData()
+            for jj, column in enumerate(curve["columns"]):
+                data.set_lazy_loader(
+                    column=column,
+                    func=np.load,
+                    kwargs={"file": entry / "{}-{}.npy".format(ii, jj),
+                            "mmap_mode": "r"})
+            datasets.append({"data": data, "metadata": curve["metadata"]})
+        return {"datasets": datasets, "info": content.get("info") or {}}
+
+    def set(self, path, datasets, key_data=None, info=None):
+        """Store the datasets of a data file
+
+        All columns of all datasets are decoded and written
+        to the cache (see :func:`get` for the parameters).
+        The JSON-serializable dictionary `info` (e.g. the
+        identifier of the file format recipe) is stored alongside
+        and returned by :func:`get_entry`.
+        """
+        entry = self._get_entry_dir(path, key_data)
+        tmp = entry.with_name(entry.name + ".{}.tmp".format(os.getpid()))
+        try:
+            tmp.mkdir(parents=True, exist_ok=True)
+            curves = []
+            for ii, dd in enumerate(datasets):
+                columns = list(dd["data"].keys())
+                for jj, column in enumerate(columns):
+                    with (tmp / "{}-{}.npy".format(ii, jj)).open("wb") as fd:
+                        np.save(fd, np.asarray(dd["data"][column]),
+                                allow_pickle=False)
+                metadata = MetaData(dd["metadata"]).as_dict()
+                curves.append({"columns": columns, "metadata": metadata})
+            (tmp / self.index_name).write_text(
+                json.dumps({"info": info or {}, "curves": curves},
+                           default=str),
+                encoding="utf-8")
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+        except OSError:
+            logger.warning("Could not write to the array cache in '%s'",
+                           self.cache_dir, exc_info=True)
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            self.evict()
+
+
+class FeatureDiskCache(object):
+    """Persistent cache for the per-curve feature values of a file
+
+    For every feature, one .npy file containing the feature values
+    of all curves in the data file is stored in the "qmap-features"
+    subdirectory of :func:`get_cache_dir`.
+    """
+    def __init__(self, path, key_data=None, cache_dir=None):
+        """
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Path to the data file
+        key_data: dict
+            Additional JSON-serializable data that the cached values
+            depend on (e.g. overridden metadata)
+        cache_dir: str or pathlib.Path
+            Cache directory; defaults to the "qmap-features"
+            subdirectory of :func:`get_cache_dir`
+        """
+        if cache_dir is None:
+            cache_dir = get_cache_dir("qmap-features")
+        #: Cache directory
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        #: Signature of the data file (see :func:`get_file_signature`)
+        self.signature = get_file_signature(path)
+        self._key_data = key_data or {}
+
+    def _get_path(self, feature):
+        key = get_key(feature=feature, key_data=self._key_data,
+                      **self.signature)
+        return self.cache_dir / "{}.npy".format(key)
+
+    def get(self, feature):
+        """Return the cached feature values or None"""
+        path = self._get_path(feature)
+        if path.exists():
+            try:
+                return np.load(path, allow_pickle=False)
+            except (OSError, ValueError):
+                logger.warning("Ignoring corrupt cache file '%s'", path)
+        return None
+
+    def set(self, feature, values):
+        """Store the feature values for all curves"""
+        try:
+            save_array(self._get_path(feature), np.asarray(values))
+        except OSError:
+            logger.warning("Could not write to the feature cache in '%s'",
+                           self.cache_dir, exc_info=True)
+
+
+class ScanIndex(object):
+    """Persistent index of detected AFM data files
+
+    The index is an SQLite database that stores, for every file, its
+    size and modification time, the identifier of the matching file
+    format recipe (None for unsupported files), and, once the file
+    was loaded, its imaging modality and number of curves. Entries
+    of files that changed (size or modification time) or that were
+    written by a different version of afmformats are ignored.
+    """
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Path to the SQLite database file (created if it does
+            not exist)
+        """
+        #: Path to the SQLite database file
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path),
+                                     check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                "version TEXT, recipe TEXT, modality TEXT, curves INTEGER)")
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
+
+    def count_curves(self, path):
+        """Return the number of curves in a directory tree
+
+        Only the index is queried; no file is opened or accessed.
+        The curves are counted during detection for file formats
+        that support it (e.g. JPK force maps and packed HDF5 files)
+        and when a file is loaded with :func:`afmformats.load_data`.
+        Files whose curve count is not known are not counted (see
+        :func:`get_uncounted`).
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Data file or directory
+
+        Returns
+        -------
+        curves: int
+            Total number of curves
+        files: int
+            Number of supported files with a known curve count
+        """
+        path = str(pathlib.Path(path).resolve())
+        with self._lock:
+            curves, files = self._conn.execute(
+                "SELECT TOTAL(curves), COUNT(curves) FROM files "
+                "WHERE (path = ? OR substr(path, 1, ?) = ?) "
+                "AND version = ? AND curves IS NOT NULL",
+                (path, len(path) + 1, os.path.join(path, ""), version)
+            ).fetchone()
+        return int(curves), files
+
+    def get_uncounted(self, path):
+        """Return the supported files in a directory tree without count
+
+        These are the files that are not included in
+        :func:`count_curves`; load them with :func:`afmformats.load_data`
+        (`scan_index=True`) to record their number of curves. As with
+        :func:`count_curves`, only the index is queried.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Data file or directory
+
+        Returns
+        -------
+        paths: list of pathlib.Path
+            Sorted list of supported files with unknown curve count
+        """
+        path = str(pathlib.Path(path).resolve())
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM files "
+                "WHERE (path = ? OR substr(path, 1, ?) = ?) "
+                "AND version = ? AND recipe IS NOT NULL "
+                "AND curves IS NULL ORDER BY path",
+                (path, len(path) + 1, os.path.join(path, ""), version)
+            ).fetchall()
+        return [pathlib.Path(row[0]) for row in rows]
+
+    def get(self, path):
+        """Return the index entry of a file or None if not up-to-date
+
+        Returns
+        -------
+        entry: dict or None
+            Dictionary with the keys "recipe", "modality", and
+            "curves" (values may be None)
+        """
+        path = pathlib.Path(path).resolve()
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT recipe, modality, curves FROM files WHERE path = ? "
+                "AND size = ? AND mtime = ? AND version = ?",
+                (str(path), stat.st_size, stat.st_mtime_ns, version)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"recipe": row[0], "modality": row[1], "curves": row[2]}
+
+    def set(self, path, recipe, modality=None, curves=None):
+        """Add or replace the index entry of a file
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Path to the data file
+        recipe: str or None
+            Identifier of the file format recipe, None if
+            the file is not supported
+        modality: str or None
+            Imaging modality of the file, None if unknown
+        curves: int or None
+            Number of curves in the file, None if unknown
+        """
+        path = pathlib.Path(path).resolve()
+        stat = path.stat()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(path), stat.st_size, stat.st_mtime_ns, version,
+                 recipe, modality, curves))
+
+
+def get_scan_index():
+    """Return the :class:`ScanIndex` in :func:`get_cache_dir`"""
+    return _open_scan_index(get_cache_dir() / "scan_index.sqlite")
+
+
+@functools.lru_cache(maxsize=4)
+def _open_scan_index(path):
+    return ScanIndex(path)
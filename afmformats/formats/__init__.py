@@ -1,8 +1,16 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import inspect
 import logging
 import pathlib
+
+import numpy as np
+
 from .. import errors
 from .. import meta
-from .fmt_hdf5 import recipe_hdf5
+from ..diskcache import ArrayDiskCache, get_scan_index
+from ..lazy_loader import as_lazy_data
+from .fmt_hdf5 import recipe_hdf5, recipe_hdf5_packed
 from .fmt_igor import recipe_ibw
 from .fmt_jpk import (
     recipe_jpk_force,
@@ -18,8 +26,9 @@ from ..mod_force_distance import AFMForceDistance
 from ..mod_creep_compliance import AFMCreepCompliance
 from ..mod_stress_relaxation import AFMStressRelaxation
 
-__all__ = ["AFMFormatRecipe", "find_data", "get_recipe", "load_data",
-           "default_data_classes_by_modality", "formats_available",
+__all__ = ["AFMFormatRecipe", "find_data", "get_recipe", "iter_data",
+           "iter_find_data", "load_data", "default_data_classes_by_modality",
+           "formats_available",
            "formats_by_suffix", "formats_by_modality", "supported_extensions"]
 
 logger = logging.getLogger(__name__)
@@ -47,12 +56,12 @@ class AFMFormatRecipe(object):
             raise ValueError("'modalities' must be in {}, got '{}'!".format(
                 meta.IMAGING_MODALITIES, self.modalities))
 
-        # check detect
-        if "detect" in self.recipe:
-            if not callable(self.recipe["detect"]):
+        # check count, detect, probe, and iterator
+        for key in ["count", "detect", "iterator", "probe"]:
+            if key in self.recipe and not callable(self.recipe[key]):
                 raise ValueError(
-                    "'detect' must be callable: '{}'".format(
-                        self.recipe["detect"]))
+                    "'{}' must be callable: '{}'".format(
+                        key, self.recipe[key]))
 
     def __getitem__(self, key):
         # backwards compatibility
@@ -64,11 +73,39 @@ class AFMFormatRecipe(object):
                                               hex(id(self)))
         return repre
 
+    def count_curves(self, path, context=None):
+        """Return the number of curves in `path` or None if unknown
+
+        The "count" function of the recipe (if available) is used,
+        which determines the number of curves without loading the
+        data (e.g. from the index of an archive). The detection
+        `context` is passed on (see :func:`detect`).
+        """
+        if "count" in self.recipe:
+            fcount = self.recipe["count"]
+            return fcount(path, **_context_kwargs(fcount, context))
+        else:
+            return None
+
     @property
     def descr(self):
         """description of file format"""
         return self.recipe.get("descr", "no description")
 
+    @property
+    def identifier(self):
+        """unique identifier of the recipe (e.g. for the scan index)"""
+        return "{} ({}) [{}]".format(self.maker, self.descr, self.suffix)
+
+    @property
+    def iterator(self):
+        """method for loading the data curve by curve (generator)
+
+        Defaults to :func:`loader` if the recipe does not define
+        an "iterator".
+        """
+        return self.recipe.get("iterator", self.loader)
+
     @property
     def loader(self):
         """method for loading the data"""
@@ -98,9 +135,23 @@ class AFMFormatRecipe(object):
         else:
             raise ValueError("No suffix defined for recipe {}!".format(self))
 
-    def detect(self, path):
+    def detect(self, path, fast=False, context=None):
         """Determine whether `path` can be opened with this recipe
 
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            path to the data file
+        fast: bool
+            If True, use the "probe" function of the recipe (if
+            available) instead of "detect". Probes only read a few
+            kilobytes (e.g. magic bytes or the file header) and may
+            thus yield false positives.
+        context: dict or None
+            Detection context that is passed to the "detect" function
+            of the recipe if it accepts the `context` keyword argument
+            (see :func:`load_data`)
+
         Returns
         -------
         valid: bool
@@ -120,28 +171,42 @@ class AFMFormatRecipe(object):
         except ValueError:
             pass
 
-        # advanced check with "detect"
-        if valid and "detect" in self.recipe:
+        # advanced check with "probe" or "detect"
+        if valid and fast and "probe" in self.recipe:
+            valid = self.recipe["probe"](path)
+        elif valid and "detect" in self.recipe:
             fdetect = self.recipe["detect"]
-            valid = fdetect(path)
+            valid = fdetect(path, **_context_kwargs(fdetect, context))
 
         return valid
 
-    def get_modality(self, path):
+    def get_modality(self, path, context=None):
         """Determine modality of a path
 
         If a recipe provides several modalities, load the
         dataset and get the modality from the metadata.
+        The detection `context` is passed on to the "detect"
+        function of the recipe (see :func:`detect`).
         """
         if len(self.modalities) == 1:
             modality = self.modalities[0]
         else:
             fdetect = self.recipe["detect"]
-            _, modality = fdetect(path, return_modality=True)
+            _, modality = fdetect(path, return_modality=True,
+                                  **_context_kwargs(fdetect, context))
         return modality
 
 
-def find_data(path, modality=None):
+def _context_kwargs(func, context):
+    """Return `{"context": context}` if `func` accepts it"""
+    if context is not None and "context" in inspect.signature(func).parameters:
+        return {"context": context}
+    else:
+        return {}
+
+
+def find_data(path, modality=None, fast=False, workers=None,
+              scan_index=False):
     """Recursively find valid AFM data files
 
     Parameters
@@ -150,32 +215,88 @@ def find_data(path, modality=None):
         file or directory
     modality: str
         modality of the measurement ("force-distance")
+    fast: bool
+        If True, only use the fast probes of the recipes for
+        detecting the file format (see :func:`get_recipe`)
+    workers: int or None
+        Number of worker threads for detecting the file formats
+        concurrently (useful e.g. for network file systems); the
+        order of the returned files does not depend on `workers`
+    scan_index: bool
+        Whether to use the persistent scan index to skip the
+        detection of files that did not change since they were
+        last scanned (see :func:`get_recipe`)
 
     Returns
     -------
     file_list: list of pathlib.Path
         list of valid AFM data files
     """
+    return list(iter_find_data(path, modality=modality, fast=fast,
+                               workers=workers, scan_index=scan_index))
+
+
+def iter_find_data(path, modality=None, fast=False, workers=None,
+                   scan_index=False):
+    """Recursively find valid AFM data files and yield them when found
+
+    This is the generator version of :func:`find_data`, useful e.g.
+    for populating file lists incrementally. The files are yielded in
+    the same order as they are returned by :func:`find_data`.
+    """
     path = pathlib.Path(path)
-    file_list = []
     if path.is_dir():
-        # recurse into subdirectories
-        for pp in path.rglob("*"):
-            if pp.is_file():
-                file_list += find_data(pp, modality=modality)
+        candidates = (pp for pp in path.rglob("*") if pp.is_file())
     else:
-        try:
-            get_recipe(path=path, modality=modality)
-        except errors.FileFormatNotSupportedError:
-            # not a valid file format
-            logger.debug("Skipping unsupported file '%s'", path)
-        else:
-            # valid file format
-            file_list.append(path)
-    return file_list
+        candidates = [path]
+
+    if not workers or workers <= 1:
+        for pp in candidates:
+            if _is_supported(pp, modality, fast, scan_index):
+                yield pp
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Only a limited number of files is submitted in advance,
+            # so that the results can be yielded in order while
+            # scanning the directory tree.
+            pending = collections.deque()
+            for pp in candidates:
+                pending.append(
+                    (pp, pool.submit(_is_supported, pp, modality, fast,
+                                     scan_index)))
+                if len(pending) >= 4 * workers:
+                    pp0, future = pending.popleft()
+                    if future.result():
+                        yield pp0
+            while pending:
+                pp0, future = pending.popleft()
+                if future.result():
+                    yield pp0
+
+
+def _is_supported(path, modality=None, fast=False, scan_index=False):
+    """Return True if `path` is a supported AFM data file"""
+    try:
+        get_recipe(path=path, modality=modality, fast=fast,
+                   scan_index=scan_index)
+    except errors.FileFormatNotSupportedError:
+        # not a valid file format
+        logger.debug("Skipping unsupported file '%s'", path)
+        return False
+    else:
+        return True
+
 
+def _get_recipe_by_identifier(path, identifier):
+    """Return the registered recipe for `path` with `identifier` or None"""
+    for rec in formats_by_suffix.get(pathlib.Path(path).suffix, []):
+        if rec.identifier == identifier:
+            return rec
+    return None
 
-def get_recipe(path, modality=None):
+
+def get_recipe(path, modality=None, fast=False, scan_index=False,
+               context=None):
     """Return the file format recipe for a given path
 
     Parameters
@@ -184,6 +305,26 @@ def get_recipe(path, modality=None):
         file or directory
     modality: str
         modality of the measurement (see :const:`IMAGING_MODALITIES`)
+    fast: bool
+        If True, only check the file suffix and the header or magic
+        bytes of the file (see :func:`AFMFormatRecipe.detect`). This
+        is much faster, but may yield false positives. In addition,
+        for suffixes shared by several recipes (e.g. ".h5"), the
+        returned recipe may not be the one that can load the file.
+        Use the default (full validation) before loading data.
+    scan_index: bool
+        Whether to use the persistent scan index (see
+        :class:`afmformats.diskcache.ScanIndex`). If the file did
+        not change since it was last detected, the recipe is taken
+        from the index. Otherwise, the result of the (full) detection
+        is stored in the index, including the number of curves if the
+        recipe can count them cheaply (see
+        :func:`AFMFormatRecipe.count_curves`).
+    context: dict or None
+        Detection context that recipes may use for storing objects
+        created during detection (e.g. an opened file reader); these
+        are reused by the loader in :func:`load_data`. The context
+        is cleared for every recipe that does not match.
 
     Returns
     -------
@@ -197,9 +338,27 @@ def get_recipe(path, modality=None):
             f"No recipe for suffix '{path.suffix}' (file '{path}')!")
 
     recipes = formats_by_suffix[path.suffix]
+    index = get_scan_index() if scan_index else None
+    if index is not None:
+        entry = index.get(path)
+        if entry is not None:
+            if entry["recipe"] is None:
+                raise errors.FileFormatNotSupportedError(
+                    f"File '{path}' is not supported (scan index)!")
+            for rec in recipes:
+                if (rec.identifier == entry["recipe"]
+                        and (modality is None or modality in rec.modalities)):
+                    return rec
+    # Only store the results of the full detection; with `modality`,
+    # the result is not necessarily the first matching recipe.
+    store = index is not None and not fast and modality is None
+    if store and context is None:
+        # reuse objects created during detection for counting the curves
+        context = {}
+
     for rec in recipes:
         try:
-            supported = rec.detect(path)
+            supported = rec.detect(path, fast=fast, context=context)
         except BaseException:
             logger.debug(
                 "Detect failed for '%s' using recipe '%s'. Traceback follows.",
@@ -207,6 +366,8 @@ def get_recipe(path, modality=None):
             supported = False
         if ((modality is None or modality in rec.modalities) and supported):
             break
+        if context is not None:
+            context.clear()
         logger.debug(
             "Recipe '%s' did not match '%s' for modality '%s'",
             rec, path, modality)
@@ -214,15 +375,25 @@ def get_recipe(path, modality=None):
         logger.debug(
             "No recipe matched '%s' for modality '%s'. Tried: %s",
             path, modality, [r.descr for r in recipes])
+        if store:
+            index.set(path, recipe=None)
         raise errors.FileFormatNotSupportedError(
             f"Could not determine file format recipe for '{path}'!")
 
+    if store:
+        try:
+            curves = rec.count_curves(path, context=context)
+        except BaseException:
+            logger.debug("Counting curves in '%s' failed. Traceback follows.",
+                         path, exc_info=True)
+            curves = None
+        index.set(path, recipe=rec.identifier, curves=curves)
     return rec
 
 
 def load_data(path, meta_override=None, modality=None,
               data_classes_by_modality=None, diskcache=False,
-              callback=None):
+              callback=None, workers=None, scan_index=False, dtype=None):
     """Load AFM data
 
     Parameters
@@ -240,15 +411,72 @@ def load_data(path, meta_override=None, modality=None,
         subclass of the default `AFMForceDistance`) for handling
         "force-indentation" data.
     diskcache: bool
-        Whether to use caching (not implemented)
+        Whether to use the on-disk cache for decoded data (see
+        :class:`afmformats.diskcache.ArrayDiskCache`). If the data
+        file is not in the cache yet, all columns are decoded and
+        written to the cache. Otherwise, the data are served from
+        memory-mapped arrays and the file is not read at all.
     callback: callable
         A method that accepts a float between 0 and 1
         to externally track the process of loading the data
+    workers: int or None
+        Number of worker threads for decoding the data concurrently
+        while loading; only supported by loaders that accept the
+        `workers` keyword argument (e.g. the JPK file formats) and
+        ignored otherwise
+    scan_index: bool
+        Whether to use the persistent scan index for detecting the
+        file format and modality (see :func:`get_recipe`); the number
+        of curves and the modality of the file are stored in the index
+        (see :func:`afmformats.diskcache.ScanIndex.count_curves`)
+    dtype: np.dtype or str or None
+        Data type of the floating point columns (e.g. "float32" to
+        halve the memory footprint of large maps); defaults to the
+        data type of the loader (float64). Loaders that accept the
+        `dtype` keyword argument (e.g. the JPK file formats) decode
+        the data directly to `dtype`, for all other loaders the data
+        are converted when they are accessed (see
+        :class:`afmformats.lazy_loader.LazyData`).
 
     Returns
     -------
     afm_list: list of afmformats.afm_data.AFMData
         List where each element is on AFMData curve
+
+    See Also
+    --------
+    iter_data: generator version for processing curves one at a time
+    """
+    return list(iter_data(path=path,
+                          meta_override=meta_override,
+                          modality=modality,
+                          data_classes_by_modality=data_classes_by_modality,
+                          diskcache=diskcache,
+                          callback=callback,
+                          workers=workers,
+                          scan_index=scan_index,
+                          dtype=dtype))
+
+
+def iter_data(path, meta_override=None, modality=None,
+              data_classes_by_modality=None, diskcache=False,
+              callback=None, workers=None, scan_index=False, dtype=None):
+    """Load AFM data and yield the curves one at a time
+
+    This is the generator version of :func:`load_data` (which
+    accepts the same arguments). For loaders that support it (see
+    the "iterator" key of the file format recipes, e.g. the JPK
+    file formats), the curves are yielded straight from the loader.
+    Thus, processing of the first curve can start immediately and,
+    if the curves are not kept around, the memory consumption does
+    not depend on the number of curves in the file. Note that with
+    `diskcache`, all curves are decoded before the first one is
+    yielded if the file is not in the cache yet.
+
+    Yields
+    ------
+    afmdata: afmformats.afm_data.AFMData
+        AFMData curve
     """
     if meta_override is None:
         meta_override = {}
@@ -256,11 +484,60 @@ def load_data(path, meta_override=None, modality=None,
         data_classes_by_modality = {}
     path = pathlib.Path(path)
     if path.suffix in formats_by_suffix:
-        afmdata = []
-        cur_recipe = get_recipe(path, modality=modality)
-        loader = cur_recipe.loader
+        count = 0
+        # objects created during detection that are reused by the loader
+        context = {}
+        cur_recipe = None
+        cache_entry = None
+        if diskcache:
+            # The cache entry is looked up before detecting the file
+            # format, such that the file is not accessed on a hit.
+            array_cache = ArrayDiskCache()
+            cache_key_data = {"meta_override": meta_override,
+                              "modality": modality}
+            if dtype is not None:
+                cache_key_data["dtype"] = np.dtype(dtype).name
+            cache_entry = array_cache.get_entry(path,
+                                                key_data=cache_key_data)
+            if cache_entry is not None:
+                cur_recipe = _get_recipe_by_identifier(
+                    path, cache_entry["info"].get("recipe"))
+                if cur_recipe is None:
+                    # the recipe is not registered anymore
+                    cache_entry = None
+        if cur_recipe is None:
+            cur_recipe = get_recipe(path, modality=modality,
+                                    scan_index=scan_index, context=context)
+        index_entry = get_scan_index().get(path) if scan_index else None
+        if diskcache:
+            # all curves are written to the cache at once
+            loader = cur_recipe.loader
+        else:
+            loader = cur_recipe.iterator
+        loader_kwargs = _context_kwargs(loader, context)
+        if workers is not None:
+            if "workers" in inspect.signature(loader).parameters:
+                loader_kwargs["workers"] = workers
+            else:
+                logger.debug("Loader of '%s' does not support `workers`",
+                             cur_recipe)
+        # whether the data have to be converted to `dtype`
+        convert_dtype = False
+        if dtype is not None:
+            if "dtype" in inspect.signature(loader).parameters:
+                loader_kwargs["dtype"] = dtype
+            else:
+                convert_dtype = True
         if modality is None:
-            modality = cur_recipe.get_modality(path)
+            if (cache_entry is not None
+                    and cache_entry["info"].get("modality") is not None):
+                modality = cache_entry["info"]["modality"]
+            elif (index_entry is not None
+                    and index_entry["recipe"] == cur_recipe.identifier
+                    and index_entry["modality"] is not None):
+                modality = index_entry["modality"]
+            else:
+                modality = cur_recipe.get_modality(path, context=context)
             fix_modality = False
         else:
             fix_modality = True
@@ -269,9 +546,27 @@ def load_data(path, meta_override=None, modality=None,
         else:
             afm_data_class = default_data_classes_by_modality[modality]
         try:
-            for dd in loader(path,
-                             callback=callback,
-                             meta_override=meta_override):
+            datasets = None
+            if cache_entry is not None:
+                logger.debug("Loading '%s' from the array cache", path)
+                datasets = cache_entry["datasets"]
+                if callback is not None:
+                    callback(1)
+            elif diskcache:
+                logger.debug("Writing '%s' to the array cache", path)
+                datasets = list(loader(path,
+                                       callback=callback,
+                                       meta_override=meta_override,
+                                       **loader_kwargs))
+                array_cache.set(path, datasets, key_data=cache_key_data,
+                                info={"recipe": cur_recipe.identifier,
+                                      "modality": modality})
+            if datasets is None:
+                datasets = loader(path,
+                                  callback=callback,
+                                  meta_override=meta_override,
+                                  **loader_kwargs)
+            for dd in datasets:
                 dd["metadata"]["format"] = "{} ({})".format(
                     cur_recipe["maker"], cur_recipe["descr"])
                 if fix_modality and dd["metadata"]["imaging mode"] != modality:
@@ -281,10 +576,16 @@ def load_data(path, meta_override=None, modality=None,
                         "from '%s'",
                         dd["metadata"]["imaging mode"], modality, path)
                     continue
+                if convert_dtype:
+                    dd["data"] = as_lazy_data(dd["data"], dtype=dtype)
                 ddi = afm_data_class(data=dd["data"],
                                      metadata=dd["metadata"],
                                      diskcache=diskcache)
-                afmdata.append(ddi)
+                count += 1
+                yield ddi
+        except GeneratorExit:
+            # the consumer stopped iterating
+            raise
         except BaseException:
             logger.exception(
                 "Loader failed for '%s' using recipe '%s'. Traceback follows.",
@@ -292,13 +593,17 @@ def load_data(path, meta_override=None, modality=None,
             raise
         logger.debug(
             "Loaded %d dataset(s) from '%s' using '%s'",
-            len(afmdata), path, cur_recipe.descr)
+            count, path, cur_recipe.descr)
+        if scan_index and not fix_modality:
+            get_scan_index().set(path,
+                                 recipe=cur_recipe.identifier,
+                                 modality=modality,
+                                 curves=count)
     else:
         logger.debug(
             "Loader failed for '%s' as the extension '%s' is not recognised.",
             path, path.suffix)
         raise ValueError("Unsupported file extension: '{}'!".format(path))
-    return afmdata
 
 
 def register_format(recipe):
@@ -341,6 +646,7 @@ supported_extensions = []
 
 for _recipe in [
     recipe_hdf5,
+    recipe_hdf5_packed,
     recipe_ibw,
     recipe_jpk_force,
     recipe_jpk_force_map,
@@ -78,6 +78,17 @@ def detect_txt(path):
     return valid
 
 
+def probe_txt(path, size=8192):
+    """Quickly check whether the header identifies a Chiaro file
+
+    Only the first `size` bytes are read (see :func:`detect_txt`
+    for a full validation).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        head = fd.read(size).decode("ISO-8859-1")
+    return "Device:\tChiaro" in head
+
+
 def load_txt(path, callback=None, meta_override=None):
     """Load text files exported by the Optics11 Chiaro Indenter.
 
@@ -160,6 +171,7 @@ def load_txt(path, callback=None, meta_override=None):
 recipe_chiaro_txt = {
     "descr": "exported by Optics11 Chiaro Indenter",
     "detect": detect_txt,
+    "probe": probe_txt,
     "loader": load_txt,
     "suffix": ".txt",
     "modalities": ["force-distance"],
@@ -1,5 +1,8 @@
-import functools
+from collections import OrderedDict
+import os
 import pathlib
+import threading
+import weakref
 
 import h5py
 import numpy as np
@@ -8,7 +11,99 @@ from ..afm_data import column_dtypes, known_columns
 from ..meta import IMAGING_MODALITIES
 
 
-__all__ = ["H5DictReader", "load_hdf5"]
+__all__ = ["H5Cache", "H5DictReader", "H5PackedReader", "load_hdf5",
+           "load_hdf5_packed"]
+
+
+class H5Cache:
+    """Cache of read-only HDF5 file handles
+
+    Similar to :class:`afmformats.formats.fmt_jpk.jpk_reader.ArchiveCache`,
+    this class keeps the last `max_files=32` HDF5 files open, such
+    that :class:`H5DictReader` does not have to open and close the
+    file for every column access. The least-recently used files are
+    closed first. In addition, the number of readers that use a file
+    is counted (see :func:`acquire` and :func:`release`). Files that
+    are in use are never evicted (they may temporarily exceed
+    `max_files`) and a file is closed as soon as it is not used
+    anymore.
+
+    After a fork, the file handles inherited from the parent process
+    are discarded and the files are reopened.
+    """
+    open_files = OrderedDict()
+    ref_counts = {}
+    max_files = 32
+    pid = os.getpid()
+    lock = threading.RLock()
+
+    @staticmethod
+    def _check_fork():
+        """Discard handles inherited from a parent process"""
+        if H5Cache.pid != os.getpid():
+            H5Cache.pid = os.getpid()
+            H5Cache.open_files = OrderedDict()
+            H5Cache.ref_counts = {}
+            H5Cache.lock = threading.RLock()
+
+    @staticmethod
+    def acquire(path):
+        """Register a user of the HDF5 file `path`"""
+        H5Cache._check_fork()
+        key = str(path)
+        with H5Cache.lock:
+            H5Cache.ref_counts[key] = H5Cache.ref_counts.get(key, 0) + 1
+
+    @staticmethod
+    def close(path):
+        """Close the HDF5 file `path` if it is open"""
+        H5Cache._check_fork()
+        with H5Cache.lock:
+            h5 = H5Cache.open_files.pop(str(path), None)
+            if h5 is not None:
+                h5.close()
+
+    @staticmethod
+    def _evict(keep=None):
+        """Close least-recently used files that are not in use"""
+        with H5Cache.lock:
+            too_many = len(H5Cache.open_files) - H5Cache.max_files
+            for old_key in list(H5Cache.open_files.keys()):
+                if too_many <= 0:
+                    break
+                if old_key == keep or H5Cache.ref_counts.get(old_key, 0):
+                    continue
+                H5Cache.open_files.pop(old_key).close()
+                too_many -= 1
+
+    @staticmethod
+    def get(path):
+        """Return the (possibly cached) `h5py.File` object for `path`"""
+        H5Cache._check_fork()
+        key = str(path)
+        with H5Cache.lock:
+            if key in H5Cache.open_files:
+                h5 = H5Cache.open_files.pop(key)
+            else:
+                h5 = h5py.File(path, mode="r")
+            H5Cache.open_files[key] = h5
+            H5Cache._evict(keep=key)
+        return h5
+
+    @staticmethod
+    def release(path):
+        """Unregister a user of `path` and close the file if unused"""
+        H5Cache._check_fork()
+        key = str(path)
+        with H5Cache.lock:
+            count = H5Cache.ref_counts.get(key, 0) - 1
+            if count > 0:
+                H5Cache.ref_counts[key] = count
+            else:
+                H5Cache.ref_counts.pop(key, None)
+                H5Cache.close(path)
+                # files that were kept open beyond `max_files`
+                H5Cache._evict()
 
 
 class H5DictReader(object):
@@ -28,11 +123,13 @@ class H5DictReader(object):
             self.path = None
             self.h5 = path_or_h5
         else:
-            # we are responsible for closing the HDF5 file
+            # the HDF5 file is managed by H5Cache
             self.path = path_or_h5
             self.h5 = None
+            H5Cache.acquire(self.path)
+            weakref.finalize(self, H5Cache.release, self.path)
         self.enum_key = enum_key
-        self._columns = self.keys()
+        self._columns = sorted(self._get_h5()[self.enum_key].keys())
 
     def __contains__(self, key):
         return key in self._columns
@@ -40,14 +137,9 @@ class H5DictReader(object):
     def __getitem__(self, key):
         if key not in known_columns:
             raise ValueError("Column '{}' is not documented!".format(key))
-        elif key in self.keys():
-            if self.path is not None:
-                with h5py.File(self.path, "r") as h5:
-                    val = np.asarray(h5[self.enum_key][key][:],
-                                     dtype=column_dtypes[key])
-            else:
-                val = np.asarray(self.h5[self.enum_key][key][:],
-                                 dtype=column_dtypes[key])
+        elif key in self._columns:
+            val = _as_column_dtype(key,
+                                   self._get_h5()[self.enum_key][key][:])
         else:
             raise KeyError("Column '{}' not in '{}/{}'".format(key, self.path,
                                                                self.enum_key))
@@ -57,14 +149,84 @@ class H5DictReader(object):
         for kk in self._columns:
             yield kk
 
-    @functools.lru_cache(maxsize=2)
-    def keys(self):
+    def _get_h5(self):
         if self.path is not None:
-            with h5py.File(self.path, "r") as h5:
-                cols = sorted(h5[self.enum_key].keys())
+            return H5Cache.get(self.path)
         else:
-            cols = sorted(self.h5[self.enum_key].keys())
-        return cols
+            return self.h5
+
+    def keys(self):
+        return self._columns
+
+
+class H5PackedReader(object):
+    def __init__(self, path, start, stop, columns):
+        """Read-only dictionary for a curve in a packed HDF5 file
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Path to HDF5 file in the packed layout
+            (see :func:`load_hdf5_packed`)
+        start, stop: int
+            Location of the curve in the column datasets
+        columns: list of str
+            Available columns
+        """
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self._columns = columns
+        H5Cache.acquire(self.path)
+        weakref.finalize(self, H5Cache.release, self.path)
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __getitem__(self, key):
+        if key not in known_columns:
+            raise ValueError("Column '{}' is not documented!".format(key))
+        elif key in self._columns:
+            ds = H5Cache.get(self.path)["columns"][key]
+            val = _as_column_dtype(key, ds[self.start:self.stop])
+        else:
+            raise KeyError("Column '{}' not in '{}'".format(key, self.path))
+        return val
+
+    def __iter__(self):
+        for kk in self._columns:
+            yield kk
+
+    def keys(self):
+        return self._columns
+
+
+def _as_column_dtype(column, data):
+    """Convert `data` to the data type of `column`
+
+    Floating point data keep their precision (e.g. float32 data
+    exported from a group loaded with `dtype="float32"`).
+    """
+    dtype = np.dtype(column_dtypes[column])
+    if dtype.kind == "f" and data.dtype.kind == "f":
+        return np.asarray(data)
+    return np.asarray(data, dtype=dtype)
+
+
+def probe_hdf5(path):
+    """Quickly check for the HDF5 signature
+
+    The signature is located at the beginning of the file or, if
+    the file has a user block, at byte 512, 1024, or 2048. This
+    probe is shared by the HDF5 recipes (see :func:`detect_hdf5`
+    and :func:`detect_hdf5_packed` for a full validation).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        head = fd.read(2048 + 8)
+    for offset in [0, 512, 1024, 2048]:
+        if head[offset:offset + 8] == b"\x89HDF\r\n\x1a\n":
+            return True
+    return False
 
 
 def detect_hdf5(path):
@@ -126,12 +288,10 @@ def load_hdf5(path_or_h5, callback=None, meta_override=None):
 
     if isinstance(path_or_h5, h5py.Group):
         path = pathlib.Path(path_or_h5.file.filename)
-        close = False
         h5 = path_or_h5
     else:
         path = pathlib.Path(path_or_h5)
-        close = True
-        h5 = h5py.File(path, "r")
+        h5 = H5Cache.get(path_or_h5)
     fdlist = []
     for enum_key in h5.keys():
         metadata = dict(h5[enum_key].attrs)
@@ -141,8 +301,112 @@ def load_hdf5(path_or_h5, callback=None, meta_override=None):
         data = H5DictReader(path_or_h5, enum_key=enum_key)
         fdlist.append({"data": data,
                        "metadata": metadata})
-    if close:
-        h5.close()
+    if callback is not None:
+        callback(1)
+    return fdlist
+
+
+def count_hdf5_packed(path):
+    """Return the number of curves in a packed HDF5 file
+
+    Only the shape of the "offsets" dataset is read
+    (see :func:`load_hdf5_packed`).
+    """
+    with h5py.File(path, mode="r") as h5:
+        return h5["offsets"].shape[0] - 1
+
+
+def detect_hdf5_packed(path, return_modality=False):
+    """Detect HDF5 file format with packed layout
+
+    All curves in a packed file must have the same imaging modality.
+    """
+    modality = None
+    with h5py.File(path, mode="r") as h5:
+        valid = (h5.attrs.get("layout") == "packed"
+                 and "software version" in h5.attrs
+                 and "offsets" in h5
+                 and "metadata" in h5)
+        if valid:
+            modalities = set()
+            for value in h5["metadata"]["imaging mode"]:
+                if isinstance(value, bytes):
+                    value = value.decode("utf-8")
+                modalities.add(value)
+            if len(modalities) > 1:
+                valid = False
+            elif modalities:
+                modality = modalities.pop()
+    if return_modality:
+        return valid, modality
+    else:
+        return valid
+
+
+def load_hdf5_packed(path, callback=None, meta_override=None):
+    """Loads HDF5 files in the packed layout as exported by afmformats
+
+    In contrast to :func:`load_hdf5`, where each curve is stored
+    in a separate group, the data of all curves are concatenated
+    and stored in one dataset per column in the "columns" group.
+    The int64 dataset "offsets" (length N+1 for N curves) holds
+    the start and stop indices of each curve in these datasets.
+    The compound dataset "metadata" has one row per curve and
+    one field per metadata key (missing values are stored as
+    NaN or as empty strings). The root attribute "layout" is
+    set to "packed". Opening a file thus only requires reading
+    these two datasets, independent of the number of curves.
+
+    Such files are written with
+    :func:`afmformats.afm_group.AFMGroup.export_data`.
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        path to HDF5 file
+    callback: callable
+        function for progress tracking; must accept a float in
+        [0, 1] as an argument.
+    meta_override: dict
+        if specified, contains key-value pairs of metadata that
+        are used when loading the files
+        (see :data:`afmformats.meta.META_FIELDS`)
+    """
+    if meta_override is None:
+        meta_override = {}
+    else:
+        # just make sure nobody expects a different result for the forces
+        for key in ["sensitivity", "spring constant"]:
+            if key in meta_override:
+                raise NotImplementedError(
+                    f"Setting metadata such as '{key}' is not implemented!")
+
+    path = pathlib.Path(path)
+    h5 = H5Cache.get(path)
+    offsets = h5["offsets"][:]
+    table = h5["metadata"][:]
+    columns = sorted(h5["columns"].keys())
+    fdlist = []
+    for ii in range(offsets.size - 1):
+        metadata = {}
+        for key in table.dtype.names:
+            value = table[key][ii]
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            if isinstance(value, str):
+                if not value:
+                    continue
+            elif np.isnan(value):
+                continue
+            metadata[key] = value
+        metadata["path"] = path
+        metadata.update(meta_override)
+        data = H5PackedReader(path,
+                              start=int(offsets[ii]),
+                              stop=int(offsets[ii + 1]),
+                              columns=columns)
+        fdlist.append({"data": data,
+                       "metadata": metadata})
     if callback is not None:
         callback(1)
     return fdlist
@@ -151,8 +415,20 @@ def load_hdf5(path_or_h5, callback=None, meta_override=None):
 recipe_hdf5 = {
     "descr": "HDF5-based",
     "detect": detect_hdf5,
+    "probe": probe_hdf5,
     "loader": load_hdf5,
     "suffix": ".h5",
     "modalities": ["force-distance"],
     "maker": "afmformats",
 }
+
+recipe_hdf5_packed = {
+    "count": count_hdf5_packed,
+    "descr": "HDF5-based (packed)",
+    "detect": detect_hdf5_packed,
+    "probe": probe_hdf5,
+    "loader": load_hdf5_packed,
+    "suffix": ".h5",
+    "modalities": IMAGING_MODALITIES,
+    "maker": "afmformats",
+}
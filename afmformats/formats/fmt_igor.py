@@ -3,7 +3,23 @@ import pathlib
 from igor2 import binarywave
 import numpy as np
 
-__all__ = ["load_igor"]
+__all__ = ["load_igor", "probe_igor"]
+
+#: Versions of the Igor binarywave format
+IBW_VERSIONS = [1, 2, 3, 5]
+
+
+def probe_igor(path):
+    """Quickly check whether a file could be an Igor binarywave file
+
+    Only the version number in the first two bytes of the file
+    is checked (in little or big endian byte order).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        data = fd.read(2)
+    return (len(data) == 2
+            and (int.from_bytes(data, "little") in IBW_VERSIONS
+                 or int.from_bytes(data, "big") in IBW_VERSIONS))
 
 
 def load_igor(path, callback=None, meta_override=None):
@@ -123,6 +139,7 @@ def load_igor(path, callback=None, meta_override=None):
 recipe_ibw = {
     "descr": "binarywave",
     "loader": load_igor,
+    "probe": probe_igor,
     "suffix": ".ibw",
     "modalities": ["force-distance"],
     "maker": "Asylum Research",
@@ -1,22 +1,52 @@
+import pathlib
+
 import numpy as np
 
 from ...errors import MissingMetaDataError
 from ...lazy_loader import LazyData
-from ...meta import LazyMetaValue
+from ...meta import LazyMetaValue, MetaData, MetaDataMissingError
 
 from .jpk_reader import JPKReader
 
 
-__all__ = ["load_jpk"]
+__all__ = ["iter_jpk", "load_jpk"]
+
+
+#: Metadata keys that are identical for all curves in a JPK archive;
+#: these are not evaluated lazily in :func:`load_jpk`.
+JPK_GRID_META_KEYS = [
+    "grid center x",
+    "grid center y",
+    "grid shape x",
+    "grid shape y",
+    "grid size x",
+    "grid size y",
+    "imaging mode",
+    "instrument",
+    "segment count",
+    "software",
+    "software version",
+]
+
 
+def count_jpk(path, context=None):
+    """Return the number of curves in a JPK data file
 
-def detect(path, return_modality=False):
+    Only the file list of the archive is read (see
+    :func:`JPKReader.get_index_numbers`).
+    """
+    return len(get_reader(path, context))
+
+
+def detect(path, return_modality=False, context=None):
     """Check whether a file is a valid JPK data file
 
+    If `context` is given, the :class:`JPKReader` instance is stored
+    in it and reused by :func:`load_jpk` (see :func:`get_reader`).
     """
     # The suffix is not checked, because that is done in
     # the wrapper class formats.AFMFormatRecipe.
-    jpkr = JPKReader(path)
+    jpkr = get_reader(path, context)
     try:
         jpkr.get_metadata(index=0)
     except MissingMetaDataError:
@@ -31,7 +61,148 @@ def detect(path, return_modality=False):
         return valid
 
 
-def load_jpk(path, callback=None, meta_override=None):
+def get_reader(path, context=None):
+    """Return a :class:`JPKReader` for `path`
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        path to JPK data file
+    context: dict or None
+        Detection context shared by the recipe functions within one
+        call to :func:`afmformats.formats.load_data`. If the context
+        already contains a reader for `path`, that reader (including
+        its cached properties) is returned. Otherwise, a new reader
+        is created and stored in the context.
+    """
+    if context is None:
+        return JPKReader(path)
+    jpkr = context.get("jpk reader")
+    if jpkr is None or pathlib.Path(jpkr.path) != pathlib.Path(path):
+        jpkr = JPKReader(path)
+        context["jpk reader"] = jpkr
+    return jpkr
+
+
+def probe(path):
+    """Quickly check whether a file could be a JPK data file
+
+    Only the zip magic bytes at the beginning of the file are checked
+    (see :func:`detect` for a full validation).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        return fd.read(4) == b"PK\x03\x04"
+
+
+def get_lazy_metadata(jpkr, index, md_ref):
+    """Return curve metadata with only grid-level keys evaluated
+
+    Parameters
+    ----------
+    jpkr: JPKReader
+        JPK reader instance
+    index: int
+        Curve index
+    md_ref: dict
+        Fully evaluated metadata of a reference curve in the same
+        archive; the grid-level keys (:const:`JPK_GRID_META_KEYS`)
+        and the user-defined metadata are taken from here.
+
+    Returns
+    -------
+    metadata: afmformats.meta.MetaData
+        Metadata where all curve-specific values are instances of
+        :class:`afmformats.meta.LazyMetaValue` that parse the
+        properties of curve `index` only when first accessed;
+        keys that are not defined for curve `index` are removed
+        when accessed (raising :class:`afmformats.meta.
+        MetaDataMissingError` as for non-lazy metadata)
+    """
+    md = MetaData()
+    for key in md_ref:
+        if key in JPK_GRID_META_KEYS or key in jpkr._user_metadata:
+            md[key] = md_ref[key]
+    md["enum"] = int(jpkr.get_index_numbers()[index])
+    md["path"] = jpkr.path
+    lazy_keys = [key for key in md_ref if key not in md]
+    # Set the grid indices first, otherwise
+    # `MetaData._autocomplete_grid_metadata` would evaluate the positions.
+    lazy_keys.sort(key=lambda key: not key.startswith("grid index"))
+    for key in lazy_keys:
+        md[key] = LazyMetaValue(_get_metadata_value, jpkr, index, key)
+    return md
+
+
+def _get_metadata_value(jpkr, index, key):
+    md = jpkr.get_metadata(index=index)
+    if key not in md:
+        raise MetaDataMissingError(
+            f"No meta data was defined for '{key}' in curve {index} "
+            f"of '{jpkr.path}'!")
+    return md[key]
+
+
+def iter_jpk(path, callback=None, meta_override=None, lazy_metadata=True,
+             workers=None, context=None, dtype=None):
+    """Loads JPK Instruments data files and yields the curves
+
+    This is the generator version of :func:`load_jpk` (which accepts
+    the same arguments). The curve data and metadata are only created
+    when they are requested, which keeps the memory footprint constant
+    when iterating over large QI maps (unless `workers` is set).
+    """
+    if meta_override is None:
+        meta_override = {}
+
+    jpkr = get_reader(path, context)
+    jpkr.set_metadata(meta_override)
+
+    columns = ["force", "height (measured)", "height (piezo)",
+               "segment", "time"]
+
+    dtype = np.dtype(float if dtype is None else dtype)
+
+    if workers:
+        data_list = jpkr.get_data_parallel(columns=columns,
+                                           workers=workers,
+                                           callback=callback,
+                                           dtype=dtype)
+        # progress has already been reported
+        callback = None
+
+    md_ref = None
+    # iterate over all datasets and add them
+    for index in range(len(jpkr)):
+        if workers:
+            data = data_list[index]
+        else:
+            data = LazyData(dtype=dtype)
+            for column in columns:
+                data.set_lazy_loader(column=column,
+                                     func=jpkr.get_data,
+                                     kwargs={"column": column,
+                                             "index": index,
+                                             "dtype": dtype})
+        if index == 0 or not lazy_metadata:
+            metadata = jpkr.get_metadata(index=index)
+        else:
+            metadata = get_lazy_metadata(jpkr, index, md_ref=md_ref)
+        if index == 0:
+            # reference for the lazy metadata (before the yielded
+            # metadata are modified)
+            md_ref = dict(metadata)
+        metadata["z range"] = LazyMetaValue(
+            lambda data: np.ptp(data["height (piezo)"]),
+            data)
+        if callback:
+            callback((1+index) / len(jpkr))
+        yield {"data": data,
+               "metadata": metadata,
+               }
+
+
+def load_jpk(path, callback=None, meta_override=None, lazy_metadata=True,
+             workers=None, context=None, dtype=None):
     """Loads JPK Instruments data files
 
     These files are zip files containing java property files and
@@ -49,38 +220,44 @@ def load_jpk(path, callback=None, meta_override=None):
         if specified, contains key-value pairs of metadata that
         are used when loading the files
         (see :data:`afmformats.meta.META_FIELDS`)
-    """
-    if meta_override is None:
-        meta_override = {}
-
-    jpkr = JPKReader(path)
-    jpkr.set_metadata(meta_override)
+    lazy_metadata: bool
+        If True (default), only the metadata of the first curve are
+        parsed when loading. For all other curves, only the grid-level
+        metadata are set and the curve-specific metadata are parsed
+        on first access (see :func:`get_lazy_metadata`). This makes
+        loading large QI maps a lot faster.
+    workers: int or None
+        If specified, the data of all curves are decoded concurrently
+        with this number of worker threads when loading (see
+        :func:`JPKReader.get_data_parallel`) instead of lazily on
+        first access. This speeds up batch-processing of large maps.
+    context: dict or None
+        Detection context; the :class:`JPKReader` that was already
+        used for detecting the file format is reused, so that the
+        archive is only parsed once (see :func:`get_reader`).
+    dtype: np.dtype or str or None
+        Data type of the floating point columns; defaults to float64.
+        Use "float32" to halve the memory footprint of large maps.
 
-    dataset = []
-    # iterate over all datasets and add them
-    for index in range(len(jpkr)):
-        lazy_data = LazyData()
-        for column in ["force", "height (measured)", "height (piezo)",
-                       "segment", "time"]:
-            lazy_data.set_lazy_loader(column=column,
-                                      func=jpkr.get_data,
-                                      kwargs={"column": column,
-                                              "index": index})
-        metadata = jpkr.get_metadata(index=index)
-        metadata["z range"] = LazyMetaValue(
-            lambda data: np.ptp(data["height (piezo)"]),
-            lazy_data)
-        dataset.append({"data": lazy_data,
-                        "metadata": metadata,
-                        })
-        if callback:
-            callback((1+index) / len(jpkr))
-    return dataset
+    See Also
+    --------
+    iter_jpk: generator version of this function
+    """
+    return list(iter_jpk(path,
+                         callback=callback,
+                         meta_override=meta_override,
+                         lazy_metadata=lazy_metadata,
+                         workers=workers,
+                         context=context,
+                         dtype=dtype))
 
 
 recipe_jpk_force = {
     "descr": "binary FD data",
+    "count": count_jpk,
     "detect": detect,
+    "probe": probe,
+    "iterator": iter_jpk,
     "loader": load_jpk,
     "maker": "JPK Instruments",
     "modalities": ["creep-compliance", "force-distance", "stress-relaxation"],
@@ -89,7 +266,10 @@ recipe_jpk_force = {
 
 recipe_jpk_force_map = {
     "descr": "binary QMap data",
+    "count": count_jpk,
     "detect": detect,
+    "probe": probe,
+    "iterator": iter_jpk,
     "loader": load_jpk,
     "maker": "JPK Instruments",
     "modalities": ["creep-compliance", "force-distance", "stress-relaxation"],
@@ -98,7 +278,10 @@ recipe_jpk_force_map = {
 
 recipe_jpk_force_qi_data = {
     "descr": "binary QMap data",
+    "count": count_jpk,
     "detect": detect,
+    "probe": probe,
+    "iterator": iter_jpk,
     "loader": load_jpk,
     "maker": "JPK Instruments",
     "modalities": ["creep-compliance", "force-distance", "stress-relaxation"],
@@ -107,7 +290,10 @@ recipe_jpk_force_qi_data = {
 
 recipe_jpk_force_qi_series = {
     "descr": "binary QMap data",
+    "count": count_jpk,
     "detect": detect,
+    "probe": probe,
+    "iterator": iter_jpk,
     "loader": load_jpk,
     "maker": "JPK Instruments",
     "modalities": ["creep-compliance", "force-distance", "stress-relaxation"],
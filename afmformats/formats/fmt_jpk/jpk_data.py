@@ -8,8 +8,11 @@ __all__ = ["JPK_COLUMNS",
            "JPK_UNITS",
            "ReadJPKError",
            "find_column_dat",
+           "get_dat_conversion",
+           "get_dat_encoding",
            "load_dat_raw",
            "load_dat_unit",
+           "scale_dat",
            ]
 
 #: Maps afmformats column names to JPK column names
@@ -35,6 +38,10 @@ JPK_UNITS = {
 }
 
 
+#: Number of data points scaled at once in :func:`scale_dat`
+SCALE_CHUNK_SIZE = 2**16
+
+
 class ReadJPKError(FileFormatNotSupportedError):
     pass
 
@@ -112,82 +119,185 @@ def get_property(description, keys, properties):
     return mult
 
 
-def load_dat_raw(fd, name, properties):
-    """Load data from binary JPK .dat files
+def get_dat_conversion(name, properties, slot="default"):
+    """Return the affine conversion from raw .dat data to a slot
+
+    The encoder scaling and all conversions of the calibration
+    slots (see :func:`load_dat_unit`) are collapsed into a single
+    multiplier and offset, such that the data in units of `slot`
+    are `raw * mult + off`.
 
     Parameters
     ----------
-    fd: file
-        Open .dat file
     name: str
-        Name of the data to read (required for scale conversions)
-        (valid options are values in :const:`JPK_COLUMNS`)
+        Name of the data (valid options are values in
+        :const:`JPK_COLUMNS`)
     properties: dict
         Property dictionary metadata (see also
         :func:`JPKReader._get_index_segment_properties`)
+    slot: str
+        Calibration slot (see :func:`load_dat_unit`)
 
     Returns
     -------
-    data: 1d ndarray
-        A numpy array with the raw data.
+    enc_dtype: np.dtype
+        Data type of the raw data
+    mult: float
+        Total multiplier
+    off: float
+        Total offset
+    unit: str
+        A string representing the metric unit of the data.
+    name: str
+        The name of the data column.
+    """
+    enc_dtype, mult, off = get_dat_encoding(name=name, properties=properties)
 
-    Notes
-    -----
-    This method tries to correctly determine the data type of the
-    binary data and scales it with the `data.encoder.scaling`
-    values given in the header files.
+    conv = f"channel.{name}.conversion-set"
+    if slot == "default":
+        slot = properties[f"{conv}.conversions.default"]
 
-    See Also
-    --------
-    load_dat_unit: Includes conversion to useful units
+    # get base unit
+    base = properties[f"{conv}.conversions.base"]
+
+    # Now iterate through the conversion sets until we have the base converter.
+    # A list of multipliers and offsets
+    converters = []
+    curslot = slot
+
+    while curslot != base:
+        # Get current slot multipliers and offsets
+        c_off = properties[f"{conv}.conversion.{curslot}.scaling.offset"]
+        c_mult = properties[
+            f"{conv}.conversion.{curslot}.scaling.multiplier"]
+        converters.append([c_mult, c_off])
+        curslot = properties[
+            f"{conv}.conversion.{curslot}.base-calibration-slot"
+        ]
+
+    # Collapse the conversion chain (all conversions are affine)
+    for c in converters[::-1]:
+        mult = c[0] * mult
+        off = c[0] * off + c[1]
+
+    if base == slot:
+        unit = properties[f"channel.{name}.data.encoder.scaling.unit.unit"]
+    else:
+        unit = get_property(
+            description=f"scale conversion {name} for {slot}",
+            keys=[f"{conv}.conversion.{slot}.scaling.unit",
+                  f"{conv}.conversion.{slot}.scaling.unit.unit"],
+            properties=properties)
+
+    out_name = properties[f"{conv}.conversion.{slot}.name"]
+    return enc_dtype, mult, off, unit, f"{name} ({out_name})"
+
+
+def get_dat_encoding(name, properties):
+    """Return data type, multiplier, and offset of raw .dat data
+
+    Parameters
+    ----------
+    name: str
+        Name of the data (valid options are values in
+        :const:`JPK_COLUMNS`)
+    properties: dict
+        Property dictionary metadata (see also
+        :func:`JPKReader._get_index_segment_properties`)
+
+    Returns
+    -------
+    enc_dtype: np.dtype
+        Data type of the raw (big-endian) integer data
+    mult: float
+        Encoder scaling multiplier
+    off: float
+        Encoder scaling offset
     """
     # Multiplier
     mult = get_property(
-        description=f"{name} multiplier in {fd}",
+        description=f"{name} multiplier",
         keys=[f"channel.{name}.data.encoder.scaling.multiplier",
               f"channel.{name}.encoder.scaling.multiplier"],
         properties=properties)
 
     # Offset
     off = get_property(
-        description=f"{name} offset in {fd}",
+        description=f"{name} offset",
         keys=[f"channel.{name}.data.encoder.scaling.offset",
               f"channel.{name}.encoder.scaling.offset"],
         properties=properties)
 
     # Data type
     enc = get_property(
-        description=f"{name} offset in {fd}",
+        description=f"{name} encoder type",
         keys=[f"channel.{name}.data.encoder.type",
               f"channel.{name}.encoder.type"],
         properties=properties)
 
     # determine encoder
     if enc == "signedshort":
-        mydtype = np.dtype(">i2")
+        enc_dtype = np.dtype(">i2")
     elif enc == "unsignedshort":
-        mydtype = np.dtype(">u2")
+        enc_dtype = np.dtype(">u2")
     elif enc == "signedinteger":
-        mydtype = np.dtype(">i4")
+        enc_dtype = np.dtype(">i4")
     elif enc == "unsignedinteger":
-        mydtype = np.dtype(">u4")
+        enc_dtype = np.dtype(">u4")
     elif enc == "signedlong":
-        mydtype = np.dtype(">i8")
+        enc_dtype = np.dtype(">i8")
     else:
         raise NotImplementedError("Data file format '{}' not supported".
                                   format(enc))
+    return enc_dtype, mult, off
 
-    data = np.frombuffer(fd.read(), dtype=mydtype) * mult + off
-    return data
 
+def load_dat_raw(fd, name, properties, dtype=float):
+    """Load data from binary JPK .dat files
+
+    Parameters
+    ----------
+    fd: file or memoryview
+        Open .dat file or buffer containing the binary data
+        (e.g. a memory-mapped member of the archive)
+    name: str
+        Name of the data to read (required for scale conversions)
+        (valid options are values in :const:`JPK_COLUMNS`)
+    properties: dict
+        Property dictionary metadata (see also
+        :func:`JPKReader._get_index_segment_properties`)
+    dtype: np.dtype
+        Output data type (e.g. `np.float32` to save memory)
 
-def load_dat_unit(fd, name, properties, slot="default"):
+    Returns
+    -------
+    data: 1d ndarray
+        A numpy array with the raw data.
+
+    Notes
+    -----
+    This method tries to correctly determine the data type of the
+    binary data and scales it with the `data.encoder.scaling`
+    values given in the header files.
+
+    See Also
+    --------
+    load_dat_unit: Includes conversion to useful units
+    """
+    enc_dtype, mult, off = get_dat_encoding(name=name,
+                                            properties=properties)
+    return scale_dat(fd, enc_dtype=enc_dtype, mult=mult, off=off,
+                     dtype=dtype)
+
+
+def load_dat_unit(fd, name, properties, slot="default", dtype=float):
     """Load data from a JPK .dat file with a specific calibration slot
 
     Parameters
     ----------
-    fd: file
-        Open .dat file
+    fd: file or memoryview
+        Open .dat file or buffer containing the binary data
+        (see :func:`load_dat_raw`)
     name: str
         Name of the data to read (required for scale conversions)
         (valid options are values in :const:`JPK_COLUMNS`)
@@ -211,6 +321,8 @@ def load_dat_unit(fd, name, properties, slot="default"):
 
             - For the recorded cantilever deflection:
               "vDeflection.dat": "volts", "distance", "force"
+    dtype: np.dtype
+        Output data type (e.g. `np.float32` to save memory)
 
     Returns
     -------
@@ -293,41 +405,60 @@ def load_dat_unit(fd, name, properties, slot="default"):
     sensitivity = 7.000143623002982E-8 m/V
     spring_constant = 0.043493666407368466 N/m
     """
-    data = load_dat_raw(fd, name=name, properties=properties)
+    enc_dtype, mult, off, unit, out_name = get_dat_conversion(
+        name=name, properties=properties, slot=slot)
+    data = scale_dat(fd, enc_dtype=enc_dtype, mult=mult, off=off,
+                     dtype=dtype)
+    return data, unit, out_name
 
-    conv = f"channel.{name}.conversion-set"
-    if slot == "default":
-        slot = properties[f"{conv}.conversions.default"]
 
-    # get base unit
-    base = properties[f"{conv}.conversions.base"]
+def scale_dat(fd, enc_dtype, mult, off, dtype=float):
+    """Decode and scale binary .dat data in a single pass
 
-    # Now iterate through the conversion sets until we have the base converter.
-    # A list of multipliers and offsets
-    converters = []
-    curslot = slot
+    The byte-swap, the conversion to floating point, and the affine
+    scaling `raw * mult + off` are performed blockwise (see
+    :const:`SCALE_CHUNK_SIZE`) into a preallocated output array,
+    such that intermediate results stay in the CPU cache. For
+    output data types other than float64 (e.g. `np.float32`), the
+    scaling is computed in double precision and only the result
+    is rounded.
 
-    while curslot != base:
-        # Get current slot multipliers and offsets
-        off = properties[f"{conv}.conversion.{curslot}.scaling.offset"]
-        mult = properties[f"{conv}.conversion.{curslot}.scaling.multiplier"]
-        converters.append([mult, off])
-        curslot = properties[
-            f"{conv}.conversion.{curslot}.base-calibration-slot"
-        ]
-
-    # Get raw data
-    for c in converters[::-1]:
-        data[:] = c[0] * data[:] + c[1]
+    Parameters
+    ----------
+    fd: file or memoryview
+        Open .dat file or buffer containing the binary data
+    enc_dtype: np.dtype
+        Data type of the raw data (see :func:`get_dat_encoding`)
+    mult: float
+        Multiplier
+    off: float
+        Offset
+    dtype: np.dtype
+        Output data type
 
-    if base == slot:
-        unit = properties[f"channel.{name}.data.encoder.scaling.unit.unit"]
+    Returns
+    -------
+    data: 1d ndarray
+        Scaled data
+    """
+    if isinstance(fd, memoryview):
+        raw = np.frombuffer(fd, dtype=enc_dtype)
     else:
-        unit = get_property(
-            description=f"scale conversion {name} for {slot} in {fd}",
-            keys=[f"{conv}.conversion.{slot}.scaling.unit",
-                  f"{conv}.conversion.{slot}.scaling.unit.unit"],
-            properties=properties)
-
-    out_name = properties[f"{conv}.conversion.{slot}.name"]
-    return data, unit, f"{name} ({out_name})"
+        raw = np.frombuffer(fd.read(), dtype=enc_dtype)
+    data = np.empty(raw.size, dtype=dtype)
+    if data.dtype == np.float64:
+        buffer = None
+    else:
+        # compute in double precision and only round the result
+        buffer = np.empty(min(raw.size, SCALE_CHUNK_SIZE), dtype=np.float64)
+    for start in range(0, raw.size, SCALE_CHUNK_SIZE):
+        stop = min(start + SCALE_CHUNK_SIZE, raw.size)
+        if buffer is None:
+            chunk = data[start:stop]
+        else:
+            chunk = buffer[:stop - start]
+        np.multiply(raw[start:stop], mult, out=chunk)
+        chunk += off
+        if buffer is not None:
+            data[start:stop] = chunk
+    return data
@@ -1,6 +1,11 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
 import copy
 import functools
+import mmap
+import struct
+import threading
 import zipfile
 
 import jprops
@@ -13,6 +18,9 @@ from . import jpk_data, jpk_meta
 
 __all__ = ["ArchiveCache", "JPKReader"]
 
+#: Structure of the local file header of zip archive members
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+
 
 class ArchiveCache:
     """Archive cache for fast access to zip data
@@ -27,33 +35,72 @@ class ArchiveCache:
 
     The solution is `ArchiveCache`, which keeps a reference to the
     last `max_archives=32` archives and closes the ones that were
-    used least.
+    used least. Archives that are currently in use (see :func:`use`)
+    are never closed, so that the cache can safely be used from
+    multiple threads (e.g. in :func:`afmformats.formats.find_data`).
     """
     open_archives = OrderedDict()
     max_archives = 32
+    # number of users of each archive (see `use`)
+    in_use = {}
+    lock = threading.RLock()
 
     @staticmethod
-    def get(zip_path):
-        """Return the (possibly cached) `ZipFile` object for `zip_path`"""
-        if zip_path in ArchiveCache.open_archives:
-            arc = ArchiveCache.open_archives.pop(zip_path)
-        else:
-            arc = zipfile.ZipFile(zip_path, mode="r")
-        ArchiveCache.open_archives[zip_path] = arc
-        # remove any open archives
+    def _evict():
+        """Close least-recently used archives that are not in use"""
         too_many = len(ArchiveCache.open_archives) - ArchiveCache.max_archives
         if too_many > 0:
-            to_remove = list(ArchiveCache.open_archives.keys())[:too_many]
-            for key in to_remove:
-                old_arc = ArchiveCache.open_archives.pop(key)
-                old_arc.close()
+            for key in list(ArchiveCache.open_archives.keys()):
+                if too_many <= 0:
+                    break
+                if key not in ArchiveCache.in_use:
+                    ArchiveCache.open_archives.pop(key).close()
+                    too_many -= 1
+
+    @staticmethod
+    def get(zip_path):
+        """Return the (possibly cached) `ZipFile` object for `zip_path`"""
+        with ArchiveCache.lock:
+            if zip_path in ArchiveCache.open_archives:
+                arc = ArchiveCache.open_archives.pop(zip_path)
+            else:
+                arc = zipfile.ZipFile(zip_path, mode="r")
+            ArchiveCache.open_archives[zip_path] = arc
+            # remove any open archives
+            ArchiveCache._evict()
         return arc
 
+    @staticmethod
+    @contextlib.contextmanager
+    def use(zip_path):
+        """Context manager returning the `ZipFile` for `zip_path`
+
+        The archive is not closed while the context is active,
+        even if more than `max_archives` archives are opened
+        in the meantime (e.g. from other threads).
+        """
+        with ArchiveCache.lock:
+            # register before `get`, which might evict the archive
+            ArchiveCache.in_use[zip_path] = \
+                ArchiveCache.in_use.get(zip_path, 0) + 1
+        try:
+            yield ArchiveCache.get(zip_path)
+        finally:
+            with ArchiveCache.lock:
+                count = ArchiveCache.in_use.pop(zip_path) - 1
+                if count:
+                    ArchiveCache.in_use[zip_path] = count
+                ArchiveCache._evict()
+
 
 class JPKReader(object):
     def __init__(self, path):
         self.path = path
         self._user_metadata = {}
+        # thread-specific archive handles (see `get_data_parallel`)
+        self._local = threading.local()
+        # collapsed .dat conversions (see `_get_dat_conversion`)
+        self._dat_conversions = {}
 
     @functools.lru_cache()
     def __len__(self):
@@ -63,8 +110,8 @@ class JPKReader(object):
     @functools.lru_cache()
     def files(self):
         """List of files and folders in the archive"""
-        arc = ArchiveCache.get(self.path)
-        nlist = arc.namelist()
+        with self._archive() as arc:
+            nlist = arc.namelist()
         maxdigits = int(np.ceil(np.log10(len(nlist)))) + 1
         repstr = "{:0" + "{}".format(maxdigits) + "d}"
 
@@ -80,13 +127,47 @@ class JPKReader(object):
 
         return sorted(nlist, key=sortkey)
 
+    @property
+    @functools.lru_cache()
+    def _files_set(self):
+        """Set of files and folders in the archive (for membership tests)"""
+        return frozenset(self.files)
+
+    @property
+    @functools.lru_cache()
+    def _segment_files(self):
+        """Dictionary mapping segment folders to the files they contain
+
+        The keys are segment paths as returned by
+        :func:`get_index_segment_path` (e.g. "index/5/segments/1/")
+        and the values are lists of the files within that folder
+        (in the order of :func:`files`). The dictionary is built in
+        a single pass over the archive, which avoids scanning the
+        whole file list for every segment of large QI maps.
+        """
+        segfiles = {}
+        for ff in self.files:
+            parts = ff.split("/")
+            if parts[0] == "segments":
+                depth = 2
+            elif (parts[0] == "index"
+                  and len(parts) > 3
+                  and parts[2] == "segments"):
+                depth = 4
+            else:
+                continue
+            if len(parts) > depth:
+                p_seg = "/".join(parts[:depth]) + "/"
+                segfiles.setdefault(p_seg, []).append(ff)
+        return segfiles
+
     @property
     @functools.lru_cache()
     def hierarchy(self):
         """Format hierarchy ("single" or "indexed")"""
-        if "segments/" in self.files:
+        if "segments/" in self._files_set:
             return "single"
-        elif "index/" in self.files:
+        elif "index/" in self._files_set:
             return "indexed"
         else:
             msg = "Cannot determine hierarchy: {}".format(self.path)
@@ -96,8 +177,7 @@ class JPKReader(object):
     @functools.lru_cache()
     def _properties_general(self):
         """Return content of "header.properties"""
-        arc = ArchiveCache.get(self.path)
-        with arc.open("header.properties", "r") as fd:
+        with self._archive() as arc, arc.open("header.properties", "r") as fd:
             props = jprops.load_properties(fd)
         return props
 
@@ -106,14 +186,82 @@ class JPKReader(object):
     def _properties_shared(self):
         """Return content of "shared-data/header.properties"""
         path = "shared-data/header.properties"
-        if path in self.files:
-            arc = ArchiveCache.get(self.path)
-            with arc.open(path, "r") as fd:
+        if path in self._files_set:
+            with self._archive() as arc, arc.open(path, "r") as fd:
                 props = jprops.load_properties(fd)
         else:
             props = {}
         return props
 
+    @contextlib.contextmanager
+    def _archive(self):
+        """Context manager returning the `ZipFile` of the archive
+
+        In the worker threads of :func:`get_data_parallel`, this is
+        the thread's own handle, otherwise the handle from
+        :class:`ArchiveCache` (which is not closed while in use).
+        """
+        arc = getattr(self._local, "archive", None)
+        if arc is None:
+            with ArchiveCache.use(self.path) as arc:
+                yield arc
+        else:
+            yield arc
+
+    def _get_dat_conversion(self, index, segment, name, slot):
+        """Return the collapsed conversion of a .dat file to `slot`
+
+        See :func:`jpk_data.get_dat_conversion`; the result is
+        cached for each segment and channel in this reader.
+        """
+        key = (index, segment, name, slot)
+        conv = self._dat_conversions.get(key)
+        if conv is None:
+            prop = self._get_index_segment_properties(index=index,
+                                                      segment=segment)
+            conv = jpk_data.get_dat_conversion(name=name, properties=prop,
+                                               slot=slot)
+            self._dat_conversions[key] = conv
+        return conv
+
+    @contextlib.contextmanager
+    def _stored_member(self, name):
+        """Context manager returning a memory-mapped uncompressed member
+
+        Yields None if the member is compressed or encrypted. In
+        that case, it has to be read via `ZipFile.open`. Only the
+        member is mapped, and the memory map (including its file
+        descriptor) is closed when the context is exited, so the
+        returned memoryview must not be used afterwards.
+        """
+        with self._archive() as arc:
+            info = arc.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            yield None
+            return
+        with open(self.path, "rb") as fd:
+            fd.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(fd.read(ZIP_LOCAL_HEADER.size))
+            if header[0] != b"PK\x03\x04" or info.file_size == 0:
+                yield None
+                return
+            # skip the local header, file name, and extra field
+            start = (info.header_offset + ZIP_LOCAL_HEADER.size
+                     + header[10] + header[11])
+            # the offset of the map must be a multiple of the granularity
+            offset = start - start % mmap.ALLOCATIONGRANULARITY
+            with mmap.mmap(fd.fileno(),
+                           length=start - offset + info.file_size,
+                           offset=offset,
+                           access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                member = view[start - offset:]
+                try:
+                    yield member
+                finally:
+                    member.release()
+                    view.release()
+
     @functools.lru_cache()
     def _get_index_segment_properties(self, index, segment):
         """Return properties from a specific index and segment
@@ -128,16 +276,16 @@ class JPKReader(object):
         """
         # 1. Properties of index
         p_index = self.get_index_path(index) + "header.properties"
-        arc = ArchiveCache.get(self.path)
-        with arc.open(p_index, "r") as fd:
-            prop = jprops.load_properties(fd)
+        with self._archive() as arc:
+            with arc.open(p_index, "r") as fd:
+                prop = jprops.load_properties(fd)
 
-        # 2. Properties of segment (if applicable)
-        if segment is not None:
-            p_segment = self.get_index_segment_path(index, segment) \
-                        + "segment-header.properties"
-            with arc.open(p_segment, "r") as fd:
-                prop.update(jprops.load_properties(fd))
+            # 2. Properties of segment (if applicable)
+            if segment is not None:
+                p_segment = self.get_index_segment_path(index, segment) \
+                            + "segment-header.properties"
+                with arc.open(p_segment, "r") as fd:
+                    prop.update(jprops.load_properties(fd))
 
         # 3. Substitute shared properties
         psprop = self._properties_shared
@@ -208,7 +356,7 @@ class JPKReader(object):
                     prop[opt_slot] = base_slot
         return prop
 
-    def get_data(self, column, index, segment=None):
+    def get_data(self, column, index, segment=None, dtype=float):
         """Return data for a given column, index, or segment
 
         Parameters
@@ -219,6 +367,8 @@ class JPKReader(object):
             Curve index in the current archive
         segment: int or None
             Segment index for chosen curve index
+        dtype: np.dtype
+            Data type of floating point columns (e.g. `np.float32`)
 
         Returns
         -------
@@ -231,10 +381,9 @@ class JPKReader(object):
             data = []
             for seg in numsegs:
                 data.append(self.get_data(column=column, index=index,
-                                          segment=seg))
+                                          segment=seg, dtype=dtype))
             return np.concatenate(data)
         md = self.get_metadata(index, segment)
-        prop = self._get_index_segment_properties(index, segment)
         numsegs = self.get_index_segment_numbers(index)
         # Find the data file that corresponds to the specified column
         if column == "time":
@@ -246,25 +395,88 @@ class JPKReader(object):
                         start += self.get_metadata(index, seg)["duration"]
 
             return np.linspace(start, start + md["duration"],
-                               md["point count"], endpoint=False)
+                               md["point count"], endpoint=False,
+                               dtype=dtype)
         elif column == "segment":
             return np.ones(md["point count"], dtype=np.uint8) * segment
         else:
             # get the segment's data list
             p_seg = self.get_index_segment_path(index, segment)
-            loc_list = [ff for ff in self.files if ff.count(p_seg)]
+            loc_list = self._segment_files.get(p_seg, [])
             name, slot, dat = jpk_data.find_column_dat(loc_list, column)
-            arc = ArchiveCache.get(self.path)
-            with arc.open(dat, "r") as fd:
-                data, unit, _ = jpk_data.load_dat_unit(fd, name=name,
-                                                       properties=prop,
-                                                       slot=slot)
+            enc_dtype, mult, off, unit, _ = self._get_dat_conversion(
+                index=index, segment=segment, name=name, slot=slot)
             # verify unit
             if unit != jpk_data.JPK_UNITS[column]:
                 raise jpk_data.ReadJPKError("Unknown unit for {}: {}".format(
                     column, unit))
+            with self._stored_member(dat) as buf:
+                if buf is not None:
+                    # uncompressed member: read directly from memory map
+                    data = jpk_data.scale_dat(buf, enc_dtype=enc_dtype,
+                                              mult=mult, off=off,
+                                              dtype=dtype)
+            if buf is None:
+                with self._archive() as arc, arc.open(dat, "r") as fd:
+                    data = jpk_data.scale_dat(fd, enc_dtype=enc_dtype,
+                                              mult=mult, off=off,
+                                              dtype=dtype)
             return data
 
+    def get_data_parallel(self, columns, workers, callback=None,
+                          dtype=float):
+        """Return data of all curves, decoded concurrently
+
+        Decoding the data is mostly zlib decompression and NumPy
+        operations which release the GIL. Every worker thread
+        uses its own `ZipFile` handle.
+
+        Parameters
+        ----------
+        columns: list of str
+            Valid columns from :const:`afmformats.afm_data.known_columns`
+        workers: int
+            Number of worker threads
+        callback: callable
+            Function for progress tracking; must accept a float in
+            [0, 1] as an argument. It is called from the calling
+            thread.
+        dtype: np.dtype
+            Data type of floating point columns (see :func:`get_data`)
+
+        Returns
+        -------
+        data_list: list of dict
+            For each curve index, a dictionary with the column data
+        """
+        handles = []
+        handles_lock = threading.Lock()
+
+        def decode(index):
+            if getattr(self._local, "archive", None) is None:
+                self._local.archive = zipfile.ZipFile(self.path, mode="r")
+                with handles_lock:
+                    handles.append(self._local.archive)
+            return {cc: self.get_data(column=cc, index=index, dtype=dtype)
+                    for cc in columns}
+
+        # build the archive index before spawning the threads
+        size = len(self)
+        self._segment_files
+        data_list = [None] * size
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(decode, idx): idx
+                           for idx in range(size)}
+                for ii, fut in enumerate(as_completed(futures)):
+                    data_list[futures[fut]] = fut.result()
+                    if callback:
+                        callback((ii + 1) / size)
+        finally:
+            for arc in handles:
+                arc.close()
+        return data_list
+
     @functools.lru_cache()
     def get_index_numbers(self):
         """Return int array with available index numbers
@@ -277,7 +489,6 @@ class JPKReader(object):
         if self.hierarchy == "single":
             indices.append(0)
         else:
-            # TODO: is there a more efficient way?
             for ff in self.files:
                 if (ff.startswith("index/")
                         and ff.count("/") == 2
@@ -297,7 +508,7 @@ class JPKReader(object):
         else:
             raise NotImplementedError("No rule to get path for hierarchy "
                                       + "'{}'!".format(self.hierarchy))
-        if path and path not in self.files:
+        if path and path not in self._files_set:
             raise IndexError("Cannot find path for index '{}' ".format(index)
                              + " (enum '{}')!".format(enum))
         return path
@@ -328,7 +539,7 @@ class JPKReader(object):
         else:
             raise NotImplementedError("No rule to get path for hierarchy "
                                       + "'{}'!".format(self.hierarchy))
-        if path not in self.files:
+        if path not in self._files_set:
             raise IndexError("Cannot find path for index '{}' ".format(index)
                              + "(enum '{}')".format(enum))
         return path
@@ -477,7 +688,11 @@ class JPKReader(object):
 
         This has a direct effect on :func:`.get_metadata`.
         """
+        if metadata == self._user_metadata:
+            # keep the cached metadata and properties
+            return
         self._user_metadata.clear()
         self._user_metadata.update(metadata)
         self.get_metadata.cache_clear()
         self._get_index_segment_properties.cache_clear()
+        self._dat_conversions.clear()
@@ -1,3 +1,5 @@
+import pathlib
+
 import numpy as np
 
 from .. import errors
@@ -41,6 +43,33 @@ def detect_txt(path):
     return valid
 
 
+def probe_txt(path, size=4096, max_rows=10):
+    """Quickly check whether the first lines contain three numbers
+
+    Only the first `size` bytes are read (see :func:`detect_txt`
+    for a full validation).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        head = fd.read(size)
+    lines = head.splitlines()
+    if len(head) == size:
+        # ignore the last (incomplete) line
+        lines = lines[:-1]
+    rows = [ll for ll in lines if ll.strip()][:max_rows]
+    if not rows:
+        return False
+    for row in rows:
+        items = row.split(b"\t")
+        if len(items) != len(converters):
+            return False
+        try:
+            for ii, item in enumerate(items):
+                converters[ii](item)
+        except ValueError:
+            return False
+    return True
+
+
 def load_txt(path, callback=None, meta_override=None):
     """Load text files exported by the NT-MDT Nova software
 
@@ -122,6 +151,7 @@ def load_txt(path, callback=None, meta_override=None):
 recipe_ntmdt_txt = {
     "descr": "exported by NT-MDT Nova",
     "detect": detect_txt,
+    "probe": probe_txt,
     "loader": load_txt,
     "suffix": ".txt",
     "modalities": ["force-distance"],
@@ -1,3 +1,4 @@
+import itertools
 import json
 import pathlib
 
@@ -31,6 +32,16 @@ def detect_tab(path, max_header=1000):
     return has_begin and has_data and has_end
 
 
+def probe_tab(path):
+    """Quickly check whether `path` was written by afmformats
+
+    Only the first line is checked (see :func:`detect_tab`
+    for a full validation).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        return fd.read(12) == b"# afmformats"
+
+
 def load_tab(path, callback=None, meta_override=None):
     """Loads tab-separated-value files as exported by afmformats
 
@@ -62,55 +73,50 @@ def load_tab(path, callback=None, meta_override=None):
 
     path = pathlib.Path(path)
     with path.open() as fd:
-        tsvdata = fd.readlines()
-
-    # get the metadata
-    dump = []
-    injson = False
-    for ii, line in enumerate(tsvdata):
-        if line.startswith("# BEGIN METADATA"):
-            injson = True
-            continue
-        elif line.startswith("# END METADATA"):
-            break
-        elif injson:
-            dump.append(line.strip("#").strip())
-    if dump:
-        metadata = json.loads("\n".join(dump))
-    else:
-        metadata = {}
-    metadata["path"] = path
-    metadata["enum"] = 0
-
-    # last line with a hash is the header
-    for ii, line in enumerate(tsvdata):
-        if not line.strip():
-            # empty line
-            pass
-        elif line.startswith("#"):
-            # header candidate
-            header_line = line
+        # read the commented header line by line
+        header = []
+        while True:
+            line = fd.readline()
+            if not line or (line.strip() and not line.startswith("#")):
+                break
+            header.append(line)
+
+        # get the metadata
+        dump = []
+        injson = False
+        for hline in header:
+            if hline.startswith("# BEGIN METADATA"):
+                injson = True
+                continue
+            elif hline.startswith("# END METADATA"):
+                break
+            elif injson:
+                dump.append(hline.strip("#").strip())
+        if dump:
+            metadata = json.loads("\n".join(dump))
         else:
-            if ii == 0:
-                raise ValueError("No header found in '{}'!".format(path))
-            break
-    else:
-        raise ValueError("No data found in '{}'!".format(path))
-    columns = header_line.strip("#").strip().split("\t")
-
-    # load the data
-    da = [f.strip() for f in tsvdata if f.strip() and not f.startswith("#")]
-    # generate arrays
+            metadata = {}
+        metadata["path"] = path
+        metadata["enum"] = 0
+
+        # last line with a hash is the header
+        header_lines = [hl for hl in header if hl.startswith("#")]
+        if not header_lines:
+            raise ValueError("No header found in '{}'!".format(path))
+        elif not line:
+            raise ValueError("No data found in '{}'!".format(path))
+        columns = header_lines[-1].strip("#").strip().split("\t")
+
+        # load the data directly from the file, starting at `line`
+        # (boolean columns, e.g. "segment", are stored as True/False)
+        lines = (dl.replace("True", "1").replace("False", "0")
+                 for dl in itertools.chain([line], fd))
+        usecols = [jj for jj, cc in enumerate(columns) if cc in known_columns]
+        table = np.loadtxt(lines, delimiter="\t", usecols=usecols, ndmin=2)
     data = {}
-    for cc in columns:
-        if cc in known_columns:
-            data[cc] = np.zeros(len(da), dtype=column_dtypes[cc])
-    for ii, line in enumerate(da):
-        for jj, item in enumerate(line.strip().split("\t")):
-            assert jj < len(columns)
-            cc = columns[jj]
-            if cc in known_columns:
-                data[cc][ii] = string_to_dtype(item, column_dtypes[cc])
+    for ii, jj in enumerate(usecols):
+        cc = columns[jj]
+        data[cc] = np.asarray(table[:, ii], dtype=column_dtypes[cc])
 
     metadata.update(meta_override)
     dd = {"data": data,
@@ -122,21 +128,10 @@ def load_tab(path, callback=None, meta_override=None):
     return [dd]
 
 
-def string_to_dtype(astring, dtype):
-    astring = astring.strip()
-    if astring == "False":
-        astring = "0"
-    elif astring == "True":
-        astring = "1"
-    if dtype in [float, int, np.uint8]:
-        return dtype(astring)
-    else:
-        raise ValueError("No conversion rule for dtype '{}'!".format(dtype))
-
-
 recipe_tab = {
     "descr": "tab-separated values",
     "detect": detect_tab,
+    "probe": probe_tab,
     "loader": load_tab,
     "suffix": ".tab",
     "modalities": ["force-distance"],
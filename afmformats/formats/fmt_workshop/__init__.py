@@ -1,10 +1,11 @@
-from .ws_single import load_csv
-from .ws_map import load_map
+from .ws_single import load_csv, probe_csv
+from .ws_map import load_map, probe_map
 
 
 recipe_workshop_map = {
     "descr": "QMAP as zipped comma-separated values",
     "loader": load_map,
+    "probe": probe_map,
     "suffix": ".zip",
     "modalities": ["force-distance"],
     "maker": "AFM workshop",
@@ -13,6 +14,7 @@ recipe_workshop_map = {
 recipe_workshop_single = {
     "descr": "comma-separated values",
     "loader": load_csv,
+    "probe": probe_csv,
     "suffix": ".csv",
     "modalities": ["force-distance"],
     "maker": "AFM workshop",
@@ -7,7 +7,16 @@ import numpy as np
 
 from .ws_single import AFMWorkshopFormatWarning, load_csv
 
-__all__ = ["load_map"]
+__all__ = ["load_map", "probe_map"]
+
+
+def probe_map(path):
+    """Quickly check whether a file could be a zipped AFM workshop map
+
+    Only the zip magic bytes at the beginning of the file are checked.
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        return fd.read(4) == b"PK\x03\x04"
 
 
 def load_map(path, callback=None, meta_override=None):
@@ -11,7 +11,7 @@ class AFMWorkshopFormatWarning(UserWarning):
     pass
 
 
-__all__ = ["load_csv"]
+__all__ = ["load_csv", "probe_csv"]
 
 
 months = {
@@ -30,6 +30,18 @@ months = {
 }
 
 
+def probe_csv(path):
+    """Quickly check whether a file could be an AFM workshop .csv file
+
+    Only the first line of the file is checked, which is
+    "Force-Distance Curve" (see :func:`load_csv`).
+    """
+    with pathlib.Path(path).open("rb") as fd:
+        line = fd.read(64)
+    # ignore a possible byte order mark
+    return line.lstrip(b"\xef\xbb\xbf").startswith(b"Force-Distance Curve")
+
+
 def load_csv(path, callback=None, meta_override=None, mode="single"):
     """Load csv data from AFM workshop
 
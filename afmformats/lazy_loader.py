@@ -1,6 +1,128 @@
-import functools
+from collections import OrderedDict
+import threading
+import weakref
 
-__all__ = ["LazyData"]
+import numpy as np
+
+__all__ = ["LazyData", "LazyDataCache", "as_lazy_data", "default_cache"]
+
+
+class LazyDataCache(object):
+    """Memory-bounded LRU cache for lazily-loaded data
+
+    Entries are keyed by the owning :class:`LazyData` instance and
+    the column name. The cache only holds weak references to its
+    owners; when an owner is garbage-collected (e.g. because the
+    corresponding `AFMGroup` was dropped), its entries are removed
+    and their memory is freed.
+    """
+    def __init__(self, max_bytes=256 * 1024**2):
+        """
+        Parameters
+        ----------
+        max_bytes: int
+            Maximum total size of the cached arrays in bytes; the
+            least recently used entries are evicted to stay below it
+        """
+        #: Maximum total size of the cached arrays [bytes]
+        self.max_bytes = max_bytes
+        #: Total size of the cached arrays [bytes]
+        self.size = 0
+        #: Number of cache hits
+        self.hits = 0
+        #: Number of cache misses
+        self.misses = 0
+        #: Number of entries evicted due to `max_bytes`
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # maps owner ids to the cached columns
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        """Remove least-recently used entries until below `max_bytes`"""
+        while self.size > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._pop(key)
+            self.evictions += 1
+
+    def _pop(self, key):
+        """Remove an entry (the lock must be acquired)"""
+        value = self._entries.pop(key)
+        self.size -= _nbytes(value)
+        owner_keys = self._owners[key[0]]
+        owner_keys.discard(key)
+        if not owner_keys:
+            self._owners.pop(key[0])
+
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def discard(self, key):
+        """Remove the entry `key` if it exists"""
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def discard_owner(self, owner_id):
+        """Remove all entries of the owner with the given `id`"""
+        with self._lock:
+            for key in list(self._owners.get(owner_id, [])):
+                self._pop(key)
+
+    def get(self, key):
+        """Return the cached value for `key` or None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        return value
+
+    def get_stats(self):
+        """Return a dictionary with the cache statistics"""
+        total = self.hits + self.misses
+        return {"entries": len(self._entries),
+                "evictions": self.evictions,
+                "hit rate": self.hits / total if total else 0,
+                "hits": self.hits,
+                "max bytes": self.max_bytes,
+                "misses": self.misses,
+                "size": self.size,
+                }
+
+    def set(self, key, value):
+        """Add an entry to the cache
+
+        The `key` is a tuple whose first item identifies the owner
+        (see :func:`discard_owner`).
+        Values that are larger than `max_bytes` are not cached.
+        """
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = value
+            self._owners.setdefault(key[0], set()).add(key)
+            self.size += size
+            self._evict()
 
 
 class LazyData(object):
@@ -11,8 +133,24 @@ class LazyData(object):
     this reduces the memory footprint (not all data are
     loaded).
     """
-    def __init__(self):
+    def __init__(self, cache=None, dtype=None):
+        """
+        Parameters
+        ----------
+        cache: LazyDataCache
+            Cache for the loaded data; defaults to the shared
+            :data:`default_cache`
+        dtype: np.dtype or str or None
+            If set, floating point columns are converted to this
+            data type when they are loaded (e.g. "float32" to
+            halve the memory footprint)
+        """
         self.loaders = {}
+        self.cache = default_cache if cache is None else cache
+        #: Data type of floating point columns (None: as loaded)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        # free the cache entries when this instance is garbage-collected
+        weakref.finalize(self, self.cache.discard_owner, id(self))
 
     def __deepcopy__(self, memo):
         # Make sure deepcopy does not copy anything.
@@ -22,12 +160,16 @@ class LazyData(object):
     def __contains__(self, key):
         return key in self.loaders
 
-    # cache a few curves so everything is more responsive
-    @functools.lru_cache(maxsize=100)
     def __getitem__(self, key):
         if key in self:
-            func, kwargs = self.loaders[key]
-            return func(**kwargs)
+            # cache recently used data so everything is more responsive
+            cache_key = (id(self), key)
+            data = self.cache.get(cache_key)
+            if data is None:
+                func, kwargs = self.loaders[key]
+                data = _astype(func(**kwargs), self.dtype)
+                self.cache.set(cache_key, data)
+            return data
 
     def __iter__(self):
         for column in self.loaders:
@@ -49,3 +191,67 @@ class LazyData(object):
             Keyword arguments to ``func``
         """
         self.loaders[column] = (func, kwargs)
+        self.cache.discard((id(self), column))
+
+
+def as_lazy_data(data, dtype=None):
+    """Return an instance of :class:`LazyData` for dict-like `data`
+
+    Parameters
+    ----------
+    data: dict-like
+        Column data; the columns are only accessed when they are
+        requested from the returned `LazyData`
+    dtype: np.dtype or str or None
+        Data type of the floating point columns (see :class:`LazyData`)
+
+    Returns
+    -------
+    lazy_data: LazyData
+        If `data` already is an instance of `LazyData`, it is
+        returned with its data type set to `dtype`.
+
+    Notes
+    -----
+    The columns of a plain `dict` are held in memory anyway, so they
+    are converted to `dtype` right away. This way, `data` (and with it
+    the original arrays) can be dropped by the caller. The columns
+    of other dict-like objects (e.g. the HDF5 readers) are only
+    converted when they are accessed.
+    """
+    if isinstance(data, LazyData):
+        dtype = None if dtype is None else np.dtype(dtype)
+        if data.dtype != dtype:
+            data.dtype = dtype
+            # remove data with the previous data type
+            data.cache.discard_owner(id(data))
+        return data
+    if type(data) is dict and dtype is not None:
+        data = {column: _astype(value, dtype)
+                for column, value in data.items()}
+    lazy_data = LazyData(dtype=dtype)
+    for column in data.keys():
+        lazy_data.set_lazy_loader(column=column,
+                                  func=_get_item,
+                                  kwargs={"data": data, "key": column})
+    return lazy_data
+
+
+def _astype(data, dtype):
+    """Convert floating point `data` to `dtype` (if not None)"""
+    if (dtype is not None
+            and np.issubdtype(getattr(data, "dtype", object), np.floating)):
+        data = np.asarray(data).astype(dtype, copy=False)
+    return data
+
+
+def _get_item(data, key):
+    return data[key]
+
+
+def _nbytes(value):
+    return getattr(value, "nbytes", 0)
+
+
+#: Cache shared by all :class:`LazyData` instances by default
+default_cache = LazyDataCache()
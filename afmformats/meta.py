@@ -192,7 +192,7 @@ class MetaData(dict):
         """
         if key not in self.valid_keys:
             raise KeyError("Unknown metadata key: '{}'".format(key))
-        elif key == "time":
+        elif key == "time" and not isinstance(value, LazyMetaValue):
             value = parse_time(value)
         elif key == "imaging mode" and "segment count" not in self:
             if value == "force-distance":
@@ -228,11 +228,7 @@ class MetaData(dict):
         value = super(MetaData, self).__getitem__(key)
 
         if isinstance(value, LazyMetaValue):
-            # Evaluate LazyMetaValue and assign value to self
-            value = value()
-            # parse the value
-            value = DEF_ALL[key][2](value)
-            super(MetaData, self).__setitem__(key, value)
+            value = self._evaluate_lazy(key, value)
         return value
 
     def _autocomplete_grid_metadata(self):
@@ -289,7 +285,7 @@ class MetaData(dict):
 
     def _get_curve_id(self):
         # already set?
-        thisid = super(MetaData, self).get("curve id")
+        thisid = self._get_evaluated("curve id")
         # compute using session_id
         if not thisid and "enum" in self:
             thisid = self._get_session_id() + "_{}".format(self["enum"])
@@ -298,9 +294,39 @@ class MetaData(dict):
             raise MetaDataMissingError("Key 'curve id' not set!")
         return thisid
 
+    def _evaluate_lazy(self, key, value):
+        """Evaluate the LazyMetaValue `value` and assign it to `key`
+
+        If the value is not available after all (the LazyMetaValue
+        raises :class:`MetaDataMissingError`), `key` is removed, i.e.
+        it behaves as if it had never been set, and the error is
+        raised.
+        """
+        try:
+            value = value()
+        except MetaDataMissingError:
+            super(MetaData, self).__delitem__(key)
+            raise
+        # parse the value
+        if key == "time":
+            value = parse_time(value)
+        value = DEF_ALL[key][2](value)
+        super(MetaData, self).__setitem__(key, value)
+        return value
+
+    def _get_evaluated(self, key):
+        """Return the (evaluated) raw value of `key` or None"""
+        value = super(MetaData, self).get(key)
+        if isinstance(value, LazyMetaValue):
+            try:
+                value = self._evaluate_lazy(key, value)
+            except MetaDataMissingError:
+                value = None
+        return value
+
     def _get_session_id(self):
         # already set?
-        thisid = super(MetaData, self).get("session id")
+        thisid = self._get_evaluated("session id")
         # compute using date/time
         if not thisid:
             idlist = [self.get("date", ""),
@@ -319,8 +345,12 @@ class MetaData(dict):
         JSON serializable)
         """
         realdict = {}
-        for key in self:
-            realdict[key] = self[key]
+        for key in list(self):
+            try:
+                realdict[key] = self[key]
+            except MetaDataMissingError:
+                if key in self:
+                    raise
         return realdict
 
     def copy(self):
@@ -335,9 +365,12 @@ class MetaData(dict):
 
     def get(self, key, default=None):
         if key in self:
-            return self[key]
-        else:
-            return default
+            try:
+                return self[key]
+            except MetaDataMissingError:
+                if key in self:
+                    raise
+        return default
 
     def get_summary(self):
         """Convenience function returning the meta data summary
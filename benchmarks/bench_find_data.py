@@ -0,0 +1,58 @@
+"""Benchmark the detection of AFM data files with find_data
+
+Creates a directory tree with copies of the test data (JPK force
+curves and maps, NT-MDT text files, and HDF5 files) and compares
+the time it takes `find_data` to scan it with the full detection
+and with the fast probes (``fast=True``). The speed-up with worker
+threads (``workers``) is largest on network file systems.
+
+Usage::
+
+    python bench_find_data.py
+"""
+import pathlib
+import shutil
+import tempfile
+import time
+
+import afmformats
+
+
+data_path = pathlib.Path(__file__).resolve().parent.parent / "tests" / "data"
+templates = [
+    "fmt-jpk-fd_spot3-0192.jpk-force",
+    "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+    "fmt-ntmdt-txt-fd_2015_01_17_gel4-0,1_mQ_adh_6B_Curve_DFL_Height_51.txt",
+    "fmt-hdf5-fd_version_0.13.3.h5",
+]
+
+
+def make_tree(path, copies):
+    """Create `copies` subdirectories with a copy of each template"""
+    for ii in range(copies):
+        pdir = path / "dir_{}".format(ii)
+        pdir.mkdir(parents=True)
+        for name in templates:
+            shutil.copy2(data_path / name, pdir / name)
+
+
+def time_find(path, fast, workers=None):
+    t0 = time.perf_counter()
+    file_list = afmformats.find_data(path, fast=fast, workers=workers)
+    return file_list, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    tdir = pathlib.Path(tempfile.mkdtemp(prefix="afmformats_bench_"))
+    make_tree(tdir, copies=100)
+    files_full, t_full = time_find(tdir, fast=False)
+    files_fast, t_fast = time_find(tdir, fast=True)
+    assert files_full == files_fast
+    print("{} files: full {:.3f}s, fast {:.3f}s ({:.1f}x)".format(
+        len(files_full), t_full, t_fast, t_full / t_fast))
+    for workers in [4, 16]:
+        files_w, t_w = time_find(tdir, fast=False, workers=workers)
+        assert files_full == files_w
+        print("full detection with {} workers: {:.3f}s".format(
+            workers, t_w))
+    shutil.rmtree(tdir, ignore_errors=True)
@@ -0,0 +1,56 @@
+"""Benchmark loading of JPK force maps of increasing size
+
+The archive index of :class:`afmformats.formats.fmt_jpk.JPKReader`
+should allow loading times that grow linearly with the number
+of curves in a map. This script creates synthetic .jpk-force-map
+files from the 2x2 test map and prints the time it takes to
+load all curves (including the "force" column). The time per
+curve should remain roughly constant.
+
+Usage::
+
+    python bench_jpk_archive_index.py
+"""
+import pathlib
+import tempfile
+import time
+import zipfile
+
+import afmformats
+
+
+data_path = pathlib.Path(__file__).resolve().parent.parent / "tests" / "data"
+jpk_template = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+
+
+def make_jpk_map(path, size):
+    """Write a .jpk-force-map with `size` copies of the template curve 2"""
+    with zipfile.ZipFile(jpk_template) as arc_in, \
+            zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as arc_out:
+        for name in arc_in.namelist():
+            if not name.startswith("index/"):
+                arc_out.writestr(name, arc_in.read(name))
+        arc_out.writestr("index/", b"")
+        curve = [nn for nn in arc_in.namelist() if nn.startswith("index/2/")]
+        for ii in range(size):
+            for name in curve:
+                new_name = "index/{}/".format(ii) + name[len("index/2/"):]
+                arc_out.writestr(new_name, arc_in.read(name))
+
+
+def time_load(path):
+    t0 = time.perf_counter()
+    group = afmformats.AFMGroup(path)
+    for afmdata in group:
+        afmdata["force"]
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    tdir = pathlib.Path(tempfile.mkdtemp(prefix="afmformats_bench_"))
+    print("curves\ttotal [s]\tper curve [ms]")
+    for size in [16, 64, 256, 1024]:
+        path = tdir / "map_{}.jpk-force-map".format(size)
+        make_jpk_map(path, size)
+        dt = time_load(path)
+        print("{}\t{:.3f}\t\t{:.3f}".format(size, dt, dt / size * 1000))
@@ -0,0 +1,61 @@
+"""Benchmark the conversion of raw JPK .dat data to SI units
+
+Compares the fused scaling kernel `jpk_data.scale_dat` with the
+previous implementation, which scaled the raw data and then made
+one pass over the data for each calibration slot.
+
+Usage::
+
+    python bench_jpk_scaling.py
+"""
+import time
+
+import numpy as np
+
+from afmformats.formats.fmt_jpk import jpk_data
+
+
+def scale_chain(buf, enc_dtype, mult, off, converters):
+    """Previous implementation"""
+    data = np.frombuffer(buf, dtype=enc_dtype) * mult + off
+    for c in converters[::-1]:
+        data[:] = c[0] * data[:] + c[1]
+    return data
+
+
+def timeit(func, repeat=5):
+    """Return the output of `func()` and the best execution time"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t0)
+    return out, min(times)
+
+
+if __name__ == "__main__":
+    enc_dtype = np.dtype(">i2")
+    mult, off = 3.0921021713588157E-4, -0.00728873489143207
+    # force <- distance <- volts
+    converters = [[0.043493666407368466, 0.0], [7.000143623002982E-8, 0.0]]
+    amult, aoff = mult, off
+    for c in converters[::-1]:
+        amult, aoff = c[0] * amult, c[0] * aoff + c[1]
+
+    rng = np.random.default_rng(42)
+    for size in [10**4, 10**6, 10**7]:
+        buf = memoryview(rng.integers(-2**15, 2**15, size=size,
+                                      dtype=np.int16).astype(enc_dtype))
+        out_old, t_old = timeit(
+            lambda: scale_chain(buf, enc_dtype, mult, off, converters))
+        out_new, t_new = timeit(
+            lambda: jpk_data.scale_dat(buf, enc_dtype, amult, aoff))
+        out_f32, t_f32 = timeit(
+            lambda: jpk_data.scale_dat(buf, enc_dtype, amult, aoff,
+                                       dtype=np.float32))
+        assert np.allclose(out_old, out_new, rtol=1e-14, atol=0)
+        assert np.allclose(out_old, out_f32, rtol=1e-6, atol=0)
+        print("{} points: chain {:.3f}ms, fused {:.3f}ms ({:.1f}x), "
+              "fused float32 {:.3f}ms ({:.1f}x)".format(
+                  size, t_old * 1e3, t_new * 1e3, t_old / t_new,
+                  t_f32 * 1e3, t_old / t_f32))
@@ -0,0 +1,80 @@
+"""Benchmark the computation of quantitative maps with AFMQMap
+
+Creates synthetic quantitative maps of increasing size (in random
+scan order) and compares the time it takes to map the feature data
+to the 2D grid with the current implementation of
+`AFMQMap._map_grid` and with the previous pixel-by-pixel loop.
+The total time of `AFMQMap.get_qmap` is printed as well.
+
+Usage::
+
+    python bench_qmap.py
+"""
+import time
+
+import numpy as np
+
+import afmformats
+
+
+def make_qmap(size):
+    """Return an AFMQMap with `size`x`size` curves in random order"""
+    rng = np.random.default_rng(42)
+    order = rng.permutation(size**2)
+    group = afmformats.AFMGroup()
+    data = {"force": np.zeros(2),
+            "height (measured)": np.arange(2, dtype=float),
+            "segment": np.array([0, 1], dtype=bool)}
+    for ii, pos in enumerate(order):
+        metadata = {"path": "bench_{}.map".format(size),
+                    "enum": ii,
+                    "grid center x": 0.,
+                    "grid center y": 0.,
+                    "grid index x": pos % size,
+                    "grid index y": pos // size,
+                    "grid shape x": size,
+                    "grid shape y": size,
+                    "grid size x": 1e-4,
+                    "grid size y": 1e-4,
+                    "position x": 0.,
+                    "position y": 0.,
+                    }
+        group.append(afmformats.AFMForceDistance(data=data,
+                                                 metadata=metadata))
+    return afmformats.AFMQMap(group)
+
+
+def map_grid_loop(qmap, coords, map_data):
+    """Previous implementation of `AFMQMap._map_grid` (map only)"""
+    coords = np.array(coords)
+    xn, yn = int(qmap.shape[0]), int(qmap.shape[1])
+    map2d = np.zeros((yn, xn)) * np.nan
+    for ii in range(coords.shape[0]):
+        xi, yi = coords[ii]
+        map2d[yi, xi] = map_data[ii]
+    return map2d
+
+
+def timeit(func, repeat=3):
+    """Return the output of `func()` and the best execution time"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t0)
+    return out, min(times)
+
+
+if __name__ == "__main__":
+    print("size\tloop [ms]\tvectorized [ms]\tget_qmap [ms]")
+    for size in [64, 256, 512]:
+        qm = make_qmap(size)
+        coords = qm.get_coords(which="px")
+        map_data = np.arange(size**2, dtype=float)
+        ref, t_loop = timeit(lambda: map_grid_loop(qm, coords, map_data))
+        (_, _, new), t_vec = timeit(
+            lambda: qm._map_grid(coords=None, map_data=map_data))
+        assert np.array_equal(ref, new)
+        _, t_qmap = timeit(lambda: qm.get_qmap("data: scan order"))
+        print("{}²\t{:.1f}\t\t{:.1f}\t\t{:.1f}".format(
+            size, t_loop * 1000, t_vec * 1000, t_qmap * 1000))
@@ -0,0 +1,68 @@
+"""Benchmark the export of AFMData to the .tab file format
+
+Compares the current implementation of `AFMData._export_tab` with
+the previous row-by-row implementation and makes sure that both
+produce byte-identical output.
+
+Usage::
+
+    python bench_tab_export.py
+"""
+import io
+import pathlib
+import time
+
+import numpy as np
+
+import afmformats
+
+
+data_path = pathlib.Path(__file__).resolve().parent.parent / "tests" / "data"
+
+
+def export_tab_rows(afmdata, fd):
+    """Previous implementation (without metadata)"""
+    fd.write("# afmformats {}\r\n".format(afmformats.__version__))
+    fd.write("#\r\n")
+    data = {}
+    for cc in afmdata.columns:
+        data[cc] = afmdata[cc]
+    fd.write("# " + "\t".join(afmdata.columns) + "\r\n")
+    for ii in range(len(afmdata)):
+        items = []
+        for cc in afmdata.columns:
+            items.append("{:.8g}".format(data[cc][ii]))
+        fd.write("\t".join(items) + "\r\n")
+
+
+def timeit(func, repeat=3):
+    """Return the output of `func(fd)` and the best execution time"""
+    times = []
+    for _ in range(repeat):
+        fd = io.StringIO()
+        t0 = time.perf_counter()
+        func(fd)
+        times.append(time.perf_counter() - t0)
+    return fd.getvalue(), min(times)
+
+
+if __name__ == "__main__":
+    afmdata = afmformats.load_data(
+        data_path / "fmt-jpk-fd_spot3-0192.jpk-force")[0]
+    afmdata["tip position"] = afmdata["height (piezo)"] * np.pi
+    for mult in [1, 10]:
+        if mult > 1:
+            # create a larger dataset
+            fdata = afmformats.AFMForceDistance(
+                data={cc: np.tile(afmdata[cc], mult)
+                      for cc in afmdata.columns},
+                metadata={"path": afmdata.path, "enum": 0,
+                          "point count": len(afmdata) * mult})
+        else:
+            fdata = afmdata
+
+        out_old, t_old = timeit(lambda fd: export_tab_rows(fdata, fd))
+        out_new, t_new = timeit(fdata._export_tab)
+        assert out_old == out_new, "output differs"
+        print("{} points: rows {:.3f}s, chunked {:.3f}s ({:.1f}x)".format(
+            len(fdata), t_old, t_new, t_old / t_new))
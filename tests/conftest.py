@@ -19,6 +19,8 @@ def pytest_configure(config):
     file after command line options have been parsed.
     """
     tempfile.tempdir = TMPDIR
+    # do not write to the user cache directory
+    os.environ["AFMFORMATS_CACHE_DIR"] = os.path.join(TMPDIR, "cache")
     # deal with logging directory
     ci_log_path = os.getenv("AFMFORMATS_LOG_PATH")
     if ci_log_path:
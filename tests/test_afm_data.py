@@ -9,6 +9,22 @@ import afmformats
 data_path = pathlib.Path(__file__).resolve().parent / "data"
 
 
+def test_data_revision():
+    jpkfile = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    fd = afmformats.load_data(jpkfile)[0]
+    rev0 = fd.data_revision
+    fd["force"]
+    assert fd.data_revision == rev0
+    fd["tip position"] = np.ones(len(fd))
+    rev1 = fd.data_revision
+    assert rev1 > rev0
+    fd.appr["force"] = np.zeros(2000)
+    rev2 = fd.data_revision
+    assert rev2 > rev1
+    fd.reset_data()
+    assert fd.data_revision > rev2
+
+
 @pytest.mark.parametrize("name,size,meta", [
     ("fmt-jpk-fd_spot3-0192.jpk-force", 4000, {}),
     ("fmt-afm-workshop-fd_single_2020-02-14_13.41.25.csv", 2030, {}),
@@ -64,6 +80,42 @@ def test_segment():
     assert fd.appr["segment"].size == 600
 
 
+def test_segment_non_contiguous():
+    jpkfile = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    fd = afmformats.load_data(jpkfile)[0]
+    assert fd.appr.segment_indices == slice(0, 2000)
+    assert fd.retr.segment_indices == slice(2000, 4000)
+
+    new_segment = np.zeros_like(fd["segment"])
+    new_segment[500:1000] = 1
+    new_segment[2000:] = 1
+    fd["segment"] = new_segment
+    assert fd.appr.segment_indices.dtype == bool
+    assert fd.appr["segment"].size == 1500
+    assert np.all(fd.appr["force"]
+                  == np.concatenate([fd["force"][:500],
+                                     fd["force"][1000:2000]]))
+    fd["tip position"] = np.zeros(len(fd))
+    fd.appr["tip position"] = np.arange(1500)
+    assert np.all(fd["tip position"][1000:2000] == np.arange(500, 1500))
+    assert np.all(fd["tip position"][500:1000] == 0)
+
+
+def test_segment_zero_copy():
+    jpkfile = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    fd = afmformats.load_data(jpkfile)[0]
+    force = fd.appr["force"]
+    force[:] = 0
+    assert not np.all(fd.appr["force"] == 0)
+
+    fd.zero_copy = True
+    force1 = fd.appr["force"]
+    assert not force1.flags.writeable
+    assert np.shares_memory(force1, fd.appr["force"])
+    assert np.shares_memory(force1, fd["force"])
+    assert np.all(fd.retr["force"] == fd["force"][2000:])
+
+
 def test_segment_set_item():
     jpkfile = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
     fd = afmformats.load_data(jpkfile)[0]
@@ -95,3 +147,28 @@ def test_segment_set_item_2():
                   == fd.appr._data["height (measured)"][:2000])
     assert not np.all(fd.appr["height (measured)"]
                       == fd.appr._raw_data["height (measured)"][:2000])
+
+
+def test_zero_copy():
+    jpkfile = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    fd = afmformats.load_data(jpkfile)[0]
+    force = fd["force"]
+    assert force.flags.writeable
+    assert not np.shares_memory(force, fd["force"])
+
+    fd.zero_copy = True
+    force1 = fd["force"]
+    force2 = fd["force"]
+    assert not force1.flags.writeable
+    assert np.shares_memory(force1, force2)
+    assert np.all(force1 == force)
+    with pytest.raises(ValueError, match="read-only"):
+        force1[0] = 1
+
+    # setting data does not touch the raw data
+    fd["force"] = force * 2
+    assert np.all(fd["force"] == force * 2)
+    assert not fd["force"].flags.writeable
+    assert np.all(force1 == force)
+    fd.reset_data()
+    assert np.all(fd["force"] == force)
@@ -1,6 +1,7 @@
 """Test group functionalities"""
 import pathlib
 
+import numpy as np
 import pytest
 
 from afmformats import AFMForceDistance, AFMGroup, load_data
@@ -94,3 +95,63 @@ def test_subgroup():
     assert len(group) == 8
     assert len(subgrp) == 4
     assert subgrp[0].path == exp
+
+
+def test_subgroup_symlink(tmp_path):
+    path = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    link = tmp_path / "link.jpk-force-map"
+    link.symlink_to(path)
+    group = AFMGroup(link)
+    group += load_data(data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    assert len(group.subgroup_with_path(path)) == 4
+    assert len(group.subgroup_with_path(link)) == 4
+    assert len(group.subgroup_with_path(tmp_path / "peter.jpk-force")) == 0
+
+
+def test_index_incremental():
+    group = AFMGroup()
+    for fdist in load_data(
+            data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"):
+        group.append(fdist)
+        assert group.get_enum(fdist.enum) is fdist
+    group += load_data(data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    assert group._enum_index == {0: [0, 4], 1: [1], 2: [2], 3: [3]}
+    assert len(group._path_index) == 2
+    subgrp = group.subgroup_with_path(
+        data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    assert subgrp.get_enum(0) is group[4]
+
+
+def test_to_arrays():
+    grp = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    grp += load_data(data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    data, offsets = grp.to_arrays(columns=["force", "height (piezo)"])
+    assert offsets.dtype == np.int64
+    assert offsets.size == len(grp) + 1
+    assert sorted(data.keys()) == ["force", "height (piezo)"]
+    for ii, afmd in enumerate(grp):
+        assert np.array_equal(data["force"][offsets[ii]:offsets[ii+1]],
+                              afmd["force"])
+    # segment
+    data, offsets = grp.to_arrays(columns=["force", "segment"], segment=1)
+    assert np.all(data["segment"] == 1)
+    for ii, afmd in enumerate(grp):
+        assert np.array_equal(data["force"][offsets[ii]:offsets[ii+1]],
+                              afmd.retr["force"])
+    # all columns
+    data, _ = grp.to_arrays()
+    assert "time" in data
+    assert data["segment"].dtype == np.float64
+
+
+def test_to_arrays_padded():
+    grp = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    grp += load_data(data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    sizes = [afmd.appr["force"].size for afmd in grp]
+    data, offsets = grp.to_arrays(columns=["force"], segment=0, padded=True)
+    assert data["force"].shape == (len(grp), max(sizes))
+    assert np.array_equal(np.diff(offsets), sizes)
+    for ii, afmd in enumerate(grp):
+        assert np.array_equal(data["force"][ii, :sizes[ii]],
+                              afmd.appr["force"])
+        assert np.all(np.isnan(data["force"][ii, sizes[ii]:]))
@@ -1,3 +1,4 @@
+import gc
 import pathlib
 from unittest import mock
 
@@ -5,11 +6,195 @@ import pytest
 
 import numpy as np
 
-from afmformats import AFMGroup, AFMQMap
+import afmformats
+from afmformats import AFMForceDistance, AFMGroup, AFMQMap
+from afmformats.afm_qmap import FeatureCache, qmap_feature
 
 data_path = pathlib.Path(__file__).parent / "data"
 
 
+def test_feature_cache_invalidation():
+    qm = AFMQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    feat = "data: height base point"
+    qd1 = qm.get_qmap(feat, qmap_only=True)
+    assert qm.feature_cache.get_stats()["misses"] == 4
+    qm.get_qmap(feat, qmap_only=True)
+    stats = qm.feature_cache.get_stats()
+    assert stats["hits"] == 4
+    assert stats["hit rate"] == 0.5
+    # modifying the data invalidates the cached value
+    fd = qm.group[0]
+    fd["height (measured)"] = fd["height (measured)"] + 1e-6
+    qd2 = qm.get_qmap(feat, qmap_only=True)
+    assert np.allclose(qd2[0, 0], qd1[0, 0] + 1)
+    assert np.array_equal(qd2[1:], qd1[1:], equal_nan=True)
+    assert qm.feature_cache.misses == 5
+    # same for segments
+    fd.appr["height (measured)"] = fd.appr["height (measured)"] - 1e-3
+    qd3 = qm.get_qmap(feat, qmap_only=True)
+    assert qd3[0, 0] < qd2[0, 0] - 900
+    fd.reset_data()
+    qd4 = qm.get_qmap(feat, qmap_only=True)
+    assert np.allclose(qd4[0, 0], qd1[0, 0])
+    # the cache is not shared among instances
+    qm2 = AFMQMap(qm.group)
+    qm2.get_qmap(feat)
+    assert qm2.feature_cache.hits == 0
+
+
+def test_feature_cache_max_entries():
+    group = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    cache = FeatureCache(max_entries=3)
+    for ii, fd in enumerate(group):
+        cache.set(fd, "feat", ii)
+    assert len(cache) == 3
+    assert cache.evictions == 1
+    assert cache.get(group[0], "feat") is None
+    assert cache.get(group[3], "feat") == 3
+    cache.invalidate(group[3])
+    assert cache.get(group[3], "feat") is None
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_feature_cache_variable():
+    cids = {"value": "a"}
+    calls = []
+
+    class VarQMap(AFMQMap):
+        @staticmethod
+        @qmap_feature(name="test: variable", unit="",
+                      cache=lambda afmdata: cids["value"])
+        def feat_test_variable(afmdata):
+            calls.append(afmdata.enum)
+            return afmdata.enum
+
+    qm = VarQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    qm.get_qmap("test: variable")
+    qm.get_qmap("test: variable")
+    assert len(calls) == 4
+    cids["value"] = "b"
+    qm.get_qmap("test: variable")
+    assert len(calls) == 8
+
+
+def test_feature_cache_vector():
+    """Cached features are retrieved without per-curve lookups"""
+    qm = AFMQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    feat = "data: height base point"
+    qd1 = qm.get_qmap(feat, qmap_only=True)
+    with mock.patch.object(FeatureCache, "get") as get:
+        qd2 = qm.get_qmap(feat, qmap_only=True)
+    assert not get.called
+    assert np.array_equal(qd1, qd2, equal_nan=True)
+    # adding curves invalidates the vectors
+    revision = qm.group.revision
+    qm.group.append(AFMForceDistance(data=qm.group[0]._raw_data,
+                                     metadata=qm.group[0].metadata))
+    assert qm.group.revision == revision + 1
+    assert qm.get_feature_data([feat])[feat].size == 5
+    # modifying data invalidates the vectors
+    qm.group[0]["height (measured)"] = qm.group[0]["height (measured)"] + 1
+    assert np.allclose(qm.get_feature_data([feat])[feat][0],
+                       qd1[0, 0] + 1e6)
+
+
+def test_feature_cache_weak():
+    group = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    cache = FeatureCache()
+    for fd in group:
+        cache.set(fd, "feat", 1)
+    assert len(cache) == 4
+    del fd
+    del group
+    gc.collect()
+    assert len(cache) == 0
+
+
+def test_feature_diskcache(monkeypatch, tmp_path):
+    monkeypatch.setenv("AFMFORMATS_CACHE_DIR", str(tmp_path))
+    calls = []
+
+    class CountQMap(AFMQMap):
+        @staticmethod
+        @qmap_feature(name="test: max force", unit="N", cache=True)
+        def feat_test_max_force(afmdata):
+            calls.append(afmdata.enum)
+            return np.max(afmdata["force"])
+
+    path = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    qm1 = CountQMap(path, diskcache=True)
+    qd1 = qm1.get_qmap("test: max force", qmap_only=True)
+    assert len(calls) == 4
+    assert len(list((tmp_path / "qmap-features").glob("*.npy"))) == 1
+    # reopening the file uses the disk cache
+    qm2 = CountQMap(path, diskcache=True)
+    qd2 = qm2.get_qmap("test: max force", qmap_only=True)
+    assert len(calls) == 4
+    assert np.array_equal(qd1, qd2, equal_nan=True)
+    # modified data are not taken from the disk cache
+    qm2.group[0]["force"] = qm2.group[0]["force"] * 2
+    qm2.get_qmap("test: max force", qmap_only=True)
+    assert len(calls) == 8
+    # different metadata yield different cache entries
+    qm3 = CountQMap(path, diskcache=True,
+                    meta_override={"spring constant": 100})
+    qm3.get_qmap("test: max force", qmap_only=True)
+    assert len(calls) == 12
+    assert len(list((tmp_path / "qmap-features").glob("*.npy"))) == 2
+
+
+def test_feat_batch():
+    class BatchQMap(AFMQMap):
+        @staticmethod
+        @qmap_feature(name="test: double order", unit="", batch=True)
+        def feat_test_double_order(group):
+            return 2 * np.arange(len(group))
+
+        @staticmethod
+        @qmap_feature(name="test: bad shape", unit="", batch=True)
+        def feat_test_bad_shape(group):
+            return np.arange(len(group) + 1)
+
+    qm = BatchQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    order = qm.get_qmap("data: scan order", qmap_only=True)
+    double = qm.get_qmap("test: double order", qmap_only=True)
+    assert np.array_equal(2 * order, double, equal_nan=True)
+    with pytest.raises(ValueError, match="returned"):
+        qm.get_qmap("test: bad shape")
+
+
+def test_feat_batch_cache():
+    calls = []
+
+    class BatchQMap(AFMQMap):
+        @staticmethod
+        @qmap_feature(name="test: max force", unit="N", cache=True,
+                      batch=True)
+        def feat_test_max_force(group):
+            calls.append([fd.enum for fd in group])
+            return [np.max(fd["force"]) for fd in group]
+
+    qm = BatchQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    qd1 = qm.get_qmap("test: max force", qmap_only=True)
+    qd2 = qm.get_qmap("test: max force", qmap_only=True)
+    assert calls == [[0, 1, 2, 3]]
+    assert np.array_equal(qd1, qd2, equal_nan=True)
+    # only modified curves are passed to the feature function again
+    qm.group[2]["force"] = qm.group[2]["force"] * 2
+    qm.get_qmap("test: max force", qmap_only=True)
+    assert calls == [[0, 1, 2, 3], [2]]
+    # built-in features are cached as well
+    with mock.patch("afmformats.afm_qmap._get_column_view",
+                    side_effect=afmformats.afm_group._get_column_view) \
+            as get_column_view:
+        qm.get_qmaps(["data: height base point", "data: piezo range"])
+        qm.get_qmaps(["data: height base point", "data: piezo range"])
+    assert get_column_view.call_count == 4
+    assert qm.feature_cache.get(qm.group[0], "data: piezo range") == \
+        qm.group[0].metadata["z range"] * 1e6
+
+
 def test_feat_scan_order():
     qm = AFMQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
     order = qm.get_qmap("data: scan order", qmap_only=True)
@@ -29,6 +214,30 @@ def test_feat_min_height():
     assert np.allclose(qd[-1, 0], 89.95170867840217)
 
 
+def test_feat_core_per_curve():
+    """The built-in features can still be computed for single curves"""
+    qm = AFMQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    fd = qm.group[1]
+    feature_data = qm.get_feature_data(["data: height base point",
+                                        "data: piezo range",
+                                        "data: scan order"])
+    assert np.allclose(AFMQMap.feat_core_data_height_base_point_um(fd),
+                       feature_data["data: height base point"][1])
+    assert np.allclose(AFMQMap.feat_core_data_piezo_range_um(fd),
+                       feature_data["data: piezo range"][1])
+    assert AFMQMap.feat_core_data_scan_order(fd) == 1
+    assert qm.features.count("data: scan order") == 1
+
+
+def test_feat_min_height_empty_curve():
+    group = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    group.append(AFMForceDistance(data={"height (measured)": np.zeros(0)},
+                                  metadata=group[0].metadata))
+    height = AFMQMap.feat_batch_core_data_height_base_point_um(group)
+    assert np.all(np.isfinite(height[:4]))
+    assert np.isnan(height[4])
+
+
 def test_get_coords():
     qm = AFMQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
 
@@ -61,6 +270,74 @@ def test_get_qmap():
     assert y.size == 10
 
 
+def test_get_qmap_flat_indices():
+    """Map data to a non-square grid and append curves afterwards"""
+    group = AFMGroup()
+    metadata = {"grid center x": 0., "grid center y": 0.,
+                "grid shape x": 3, "grid shape y": 2,
+                "grid size x": 3e-6, "grid size y": 2e-6,
+                "position x": 0., "position y": 0.,
+                "path": "fake.map"}
+    pixels = [(2, 1), (0, 0), (1, 1)]
+    for ii, (xi, yi) in enumerate(pixels):
+        metadata.update({"enum": ii, "grid index x": xi, "grid index y": yi})
+        group.append(AFMForceDistance(data={"force": np.zeros(2)},
+                                      metadata=metadata))
+    qm = AFMQMap(group)
+    order = qm.get_qmap("data: scan order", qmap_only=True)
+    assert order.shape == (2, 3)
+    assert np.array_equal(order,
+                          [[1, np.nan, np.nan], [np.nan, 2, 0]],
+                          equal_nan=True)
+
+    # the cached indices must be updated when the group changes
+    metadata.update({"enum": 3, "grid index x": 1, "grid index y": 0})
+    group.append(AFMForceDistance(data={"force": np.zeros(2)},
+                                  metadata=metadata))
+    assert np.array_equal(qm.get_coords(which="px")[-1], [1, 0])
+    order2 = qm.get_qmap("data: scan order", qmap_only=True)
+    assert np.array_equal(order2,
+                          [[1, 3, np.nan], [np.nan, 2, 0]],
+                          equal_nan=True)
+
+
+def test_get_qmaps():
+    qm = AFMQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    features = ["data: height base point", "data: scan order"]
+    x, y, qmaps = qm.get_qmaps(features)
+    assert list(qmaps.keys()) == features
+    for ft in features:
+        xi, yi, qmi = qm.get_qmap(ft)
+        assert np.array_equal(x, xi)
+        assert np.array_equal(y, yi)
+        assert np.array_equal(qmaps[ft], qmi, equal_nan=True)
+
+
+def test_get_qmaps_single_pass():
+    """Each curve must be accessed only once for all features"""
+    calls = []
+
+    class CountQMap(AFMQMap):
+        @staticmethod
+        @qmap_feature(name="test: max force", unit="N")
+        def feat_test_max_force(afmdata):
+            calls.append(("max", afmdata.enum))
+            return np.max(afmdata["force"])
+
+        @staticmethod
+        @qmap_feature(name="test: min force", unit="N")
+        def feat_test_min_force(afmdata):
+            calls.append(("min", afmdata.enum))
+            return np.min(afmdata["force"])
+
+    qm = CountQMap(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    qmaps = qm.get_qmaps(["test: max force", "test: min force"],
+                         qmap_only=True)
+    assert np.nanmin(qmaps["test: max force"] - qmaps["test: min force"]) > 0
+    # curve-major order
+    assert calls == [(ft, ii) for ii in range(4) for ft in ["max", "min"]]
+
+
 def test_init_with_group():
     group = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
     qm = AFMQMap(group)
@@ -75,6 +352,12 @@ def test_init_with_group_meta_override_meaningless():
                                "sensitivity": 2})
 
 
+def test_init_with_group_dtype_meaningless():
+    group = AFMGroup(data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    with pytest.raises(ValueError, match="meaningless"):
+        AFMQMap(group, dtype="float32")
+
+
 def test_metadata_missing():
     fake_qmap_dict = {
         "test-key": ["A description for the test key", "m", float],
@@ -2,10 +2,12 @@
 import pathlib
 import shutil
 import tempfile
+import zipfile
 
 import pytest
 
 import afmformats
+from afmformats.formats.fmt_jpk.jpk_reader import ArchiveCache
 
 
 data_path = pathlib.Path(__file__).resolve().parent / "data"
@@ -95,6 +97,73 @@ def test_find_data_recursively():
     assert file_list[0].samefile(td2 / "fmt-jpk-fd_spot3-0192.jpk-force")
 
 
+def test_find_data_fast():
+    file_list = afmformats.find_data(data_path)
+    file_list_fast = afmformats.find_data(data_path, fast=True)
+    assert file_list
+    assert file_list == file_list_fast
+
+
+def test_find_data_fast_invalid():
+    td = pathlib.Path(tempfile.mkdtemp(prefix="find_data_fast_"))
+    (td / "random_file.jpk-force").write_bytes(b"peterpanhook")
+    (td / "random_file.txt").write_text("hello\tworld\n")
+    (td / "random_file.h5").write_bytes(b"\x89HDF")
+    (td / "random_file.csv").write_text("a,b,c,d\n1,2,3,4\n")
+    (td / "random_file.ibw").write_bytes(b"\x04\x00peterpan")
+    (td / "random_file.zip").write_bytes(b"peterpanhook")
+    assert not afmformats.find_data(td, fast=True)
+
+
+def test_get_recipe_fast_txt():
+    td = pathlib.Path(tempfile.mkdtemp(prefix="get_recipe_fast_txt_"))
+    with zipfile.ZipFile(
+            data_path / "fmt-chiaro-txt_AEBP1_Indentation_002.zip") as arc:
+        name = [nn for nn in arc.namelist() if nn.endswith(".txt")][0]
+        (td / "chiaro.txt").write_bytes(arc.read(name))
+    shutil.copy2(data_path / "fmt-ntmdt-txt-fd_2015_01_17_gel4-0,1_mQ_adh_"
+                             "6B_Curve_DFL_Height_51.txt",
+                 td / "ntmdt.txt")
+    for name in ["chiaro.txt", "ntmdt.txt"]:
+        path = td / name
+        recipe = afmformats.formats.get_recipe(path)
+        recipe_fast = afmformats.formats.get_recipe(path, fast=True)
+        assert recipe is recipe_fast
+
+
+def test_find_data_workers():
+    file_list = afmformats.find_data(data_path)
+    assert afmformats.find_data(data_path, workers=3) == file_list
+    assert afmformats.find_data(data_path, fast=True, workers=3) == file_list
+    path = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    assert afmformats.find_data(path, workers=2) == [path]
+
+
+def test_find_data_workers_many_archives(tmp_path):
+    """More archives than `ArchiveCache.max_archives` are scanned at once"""
+    for ii in range(3 * ArchiveCache.max_archives):
+        shutil.copy2(data_path / "fmt-jpk-fd_spot3-0192.jpk-force",
+                     tmp_path / f"spot_{ii:03d}.jpk-force")
+    file_list = afmformats.find_data(tmp_path)
+    assert len(file_list) == 3 * ArchiveCache.max_archives
+    for _ in range(3):
+        assert afmformats.find_data(tmp_path, workers=64) == file_list
+    # archives that were in use are closed eventually
+    assert not ArchiveCache.in_use
+    assert len(ArchiveCache.open_archives) <= ArchiveCache.max_archives
+
+
+def test_iter_find_data():
+    file_list = afmformats.find_data(data_path)
+    gen = afmformats.iter_find_data(data_path, workers=2)
+    assert next(gen) == file_list[0]
+    assert [file_list[0]] + list(gen) == file_list
+    # stopping early is possible
+    gen2 = afmformats.iter_find_data(data_path, workers=2)
+    next(gen2)
+    gen2.close()
+
+
 def test_find_data_invalid_missing():
     td = pathlib.Path(tempfile.mkdtemp(prefix="find_data_invalid_"))
     shutil.copy2(data_path / "fmt-jpk-fd_spot3-0192.jpk-force",
@@ -0,0 +1,183 @@
+import os
+import pathlib
+import shutil
+from unittest import mock
+
+import numpy as np
+
+import pytest
+
+import afmformats
+from afmformats.diskcache import (
+    ArrayDiskCache, get_file_signature, get_scan_index)
+from afmformats.formats import AFMFormatRecipe
+
+
+data_path = pathlib.Path(__file__).resolve().parent / "data"
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    path = tmp_path / "cache"
+    monkeypatch.setenv("AFMFORMATS_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.mark.parametrize("name", [
+    "fmt-afm-workshop-fd_mapping_16_2018-08-01_13.07.zip",
+    "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+    "fmt-ntmdt-txt-fd_2015_01_17_gel4-0,1_mQ_adh_6B_Curve_DFL_Height_51.txt",
+])
+def test_array_cache(cache_dir, name):
+    meta = {"sensitivity": 61, "spring constant": 0.055}
+    ref = afmformats.load_data(data_path / name, meta_override=meta)
+    data1 = afmformats.load_data(data_path / name, meta_override=meta,
+                                 diskcache=True)
+    entries = list((cache_dir / "arrays").iterdir())
+    assert len(entries) == 1
+    data2 = afmformats.load_data(data_path / name, meta_override=meta,
+                                 diskcache=True)
+    assert len(ref) == len(data1) == len(data2)
+    for fd0, fd1, fd2 in zip(ref, data1, data2):
+        assert isinstance(fd2._raw_data["force"], np.memmap)
+        assert fd0.columns == fd2.columns
+        for column in fd0.columns:
+            assert np.array_equal(fd0[column], fd1[column])
+            assert np.array_equal(fd0[column], fd2[column])
+        assert fd0.metadata.as_dict() == fd2.metadata.as_dict()
+        assert fd0.appr["force"].size == fd2.appr["force"].size
+
+
+def test_array_cache_evict(tmp_path):
+    cache = ArrayDiskCache(cache_dir=tmp_path, max_bytes=1)
+    path = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    datasets = afmformats.formats.get_recipe(path).loader(path)
+    cache.set(path, datasets)
+    # entry is larger than `max_bytes`
+    assert cache.get(path) is None
+    assert not list(tmp_path.iterdir())
+
+    cache.max_bytes = 10 * 1024**2
+    for ii in range(3):
+        path_ii = tmp_path / "data_{}.jpk-force".format(ii)
+        shutil.copy2(path, path_ii)
+        cache.set(path_ii, datasets)
+    # keep track of the last access
+    assert cache.get(tmp_path / "data_0.jpk-force") is not None
+    size = sum(ff.stat().st_size for ff in tmp_path.rglob("*.npy"))
+    cache.max_bytes = size - 1
+    cache.evict()
+    assert cache.get(tmp_path / "data_0.jpk-force") is not None
+    assert cache.get(tmp_path / "data_1.jpk-force") is None
+    assert cache.get(tmp_path / "data_2.jpk-force") is not None
+
+
+def test_array_cache_invalidate(cache_dir, tmp_path):
+    path = tmp_path / "data.jpk-force"
+    shutil.copy2(data_path / "fmt-jpk-fd_spot3-0192.jpk-force", path)
+    cache = ArrayDiskCache()
+    afmformats.load_data(path, diskcache=True)
+    key_data = {"meta_override": {}, "modality": None}
+    entry = cache.get_entry(path, key_data=key_data)
+    assert entry["info"] == {
+        "recipe": "JPK Instruments (binary FD data) [.jpk-force]",
+        "modality": "force-distance"}
+    # other metadata
+    afmformats.load_data(path, diskcache=True,
+                         meta_override={"spring constant": 2})
+    assert len(list(cache.cache_dir.iterdir())) == 2
+    # modification time changed
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.get(path, key_data=key_data) is None
+
+
+def test_array_cache_no_detection(cache_dir):
+    path = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    ref = afmformats.load_data(path, diskcache=True, dtype="float32")
+    # the file format and the modality are taken from the cache entry
+    with mock.patch("afmformats.formats.get_recipe") as get_recipe, \
+            mock.patch.object(AFMFormatRecipe, "detect") as detect, \
+            mock.patch.object(AFMFormatRecipe, "get_modality") as get_mod:
+        data = afmformats.load_data(path, diskcache=True, dtype="float32")
+    assert not get_recipe.called
+    assert not detect.called
+    assert not get_mod.called
+    assert len(ref) == len(data)
+    for fd0, fd1 in zip(ref, data):
+        assert fd0.metadata["format"] == fd1.metadata["format"]
+        assert fd1.modality == "force-distance"
+        assert fd1["force"].dtype == np.float32
+        assert np.array_equal(fd0["force"], fd1["force"])
+    # a different `dtype` is a different entry
+    afmformats.load_data(path, diskcache=True)
+    assert len(list((cache_dir / "arrays").iterdir())) == 2
+
+
+def test_file_signature(tmp_path):
+    path = tmp_path / "data.txt"
+    path.write_bytes(b"0" * 100)
+    sig1 = get_file_signature(path)
+    path.write_bytes(b"1" * 100)
+    sig2 = get_file_signature(path)
+    assert sig1["hash"] != sig2["hash"]
+    assert sig1["size"] == sig2["size"]
+    assert "hash" not in get_file_signature(path, content_hash=False)
+
+
+def test_scan_index_count_curves(cache_dir, tmp_path):
+    names = ["fmt-jpk-fd_spot3-0192.jpk-force",
+             "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+             "fmt-tab-fd_version_0.13.3.tab"]
+    for name in names:
+        shutil.copy2(data_path / name, tmp_path / name)
+    index = get_scan_index()
+    assert index.count_curves(tmp_path) == (0, 0)
+    assert index.get_uncounted(tmp_path) == []
+    afmformats.find_data(tmp_path, scan_index=True)
+    # the curves in the JPK files are counted during detection
+    assert index.count_curves(tmp_path) == (5, 2)
+    assert index.get_uncounted(tmp_path) == [tmp_path.resolve() / names[2]]
+    for name in names:
+        afmformats.load_data(tmp_path / name, scan_index=True)
+    assert index.count_curves(tmp_path) == (6, 3)
+    assert index.get_uncounted(tmp_path) == []
+    path_map = tmp_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    assert index.count_curves(path_map) == (4, 1)
+    assert index.get(path_map)["modality"] == "force-distance"
+    # other directories are not counted
+    assert index.count_curves(tmp_path / "fmt") == (0, 0)
+
+
+def test_scan_index_count_hdf5_packed(cache_dir, tmp_path):
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    path = tmp_path / "packed.h5"
+    group.export_data(path, fmt="hdf5-packed")
+    assert afmformats.find_data(tmp_path, scan_index=True) == [path]
+    assert get_scan_index().count_curves(tmp_path) == (4, 1)
+
+
+def test_scan_index_find_data(cache_dir, tmp_path):
+    names = ["fmt-jpk-fd_spot3-0192.jpk-force",
+             "fmt-tab-fd_version_0.13.3.tab"]
+    for name in names:
+        shutil.copy2(data_path / name, tmp_path / name)
+    (tmp_path / "invalid.jpk-force").write_bytes(b"peterpanhook")
+    ref = afmformats.find_data(tmp_path)
+    assert len(ref) == 2
+
+    with mock.patch.object(AFMFormatRecipe, "detect",
+                           autospec=True,
+                           side_effect=AFMFormatRecipe.detect) as detect:
+        assert afmformats.find_data(tmp_path, scan_index=True) == ref
+        assert detect.call_count == 3
+        # all files are in the index now
+        assert afmformats.find_data(tmp_path, scan_index=True) == ref
+        assert detect.call_count == 3
+        # modified files are detected again
+        path = tmp_path / names[1]
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert afmformats.find_data(tmp_path, scan_index=True) == ref
+        assert detect.call_count == 4
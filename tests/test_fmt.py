@@ -1,5 +1,6 @@
 import pathlib
 
+import numpy as np
 import pytest
 
 import afmformats
@@ -34,6 +35,47 @@ def test_load_force_distance_with_callback(path):
     assert calls[-1] == 1
 
 
+@pytest.mark.parametrize("path", data_path.glob("fmt-*-fd_*"))
+def test_iter_data(path):
+    """The generator yields the same curves as `load_data`"""
+    meta = {"spring constant": 20, "sensitivity": .01e-6}
+    try:
+        ref = afmformats.load_data(path=path)
+    except afmformats.errors.MissingMetaDataError:
+        ref = afmformats.load_data(path=path, meta_override=meta)
+    else:
+        meta = None
+    data = afmformats.iter_data(path=path, meta_override=meta)
+    assert not isinstance(data, list)
+    data = list(data)
+    assert len(data) == len(ref)
+    for fd0, fd1 in zip(ref, data):
+        assert fd0.metadata.as_dict() == fd1.metadata.as_dict()
+        assert np.array_equal(fd0["force"], fd1["force"])
+
+
+def test_load_data_float32():
+    """Data of loaders without `dtype` support are converted on access"""
+    path = data_path / "fmt-tab-fd_version_0.13.3.tab"
+    ref = afmformats.load_data(path)[0]
+    fdist = afmformats.load_data(path, dtype="float32")[0]
+    assert fdist["force"].dtype == np.float32
+    assert fdist["segment"].dtype == ref["segment"].dtype
+    assert np.allclose(fdist["force"], ref["force"], rtol=1e-6, atol=0)
+
+
+def test_iter_data_jpk_generator():
+    """Curves of JPK files are yielded straight from the loader"""
+    path = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    calls = []
+    gen = afmformats.iter_data(path=path, callback=calls.append)
+    fd = next(gen)
+    assert fd.enum == 0
+    assert calls == [.25]
+    assert [fdi.enum for fdi in gen] == [1, 2, 3]
+    assert calls == [.25, .5, .75, 1]
+
+
 @pytest.mark.parametrize("path", data_path.glob("fmt-*-cc_*"))
 def test_load_creep_compliance_modality(path):
     recipe = afmformats.formats.get_recipe(path)
@@ -1,15 +1,213 @@
 """Test .tab format functionalities"""
+from collections import OrderedDict
+import gc
 import pathlib
+import shutil
 import tempfile
+from unittest import mock
 
+import h5py
 import numpy as np
+import pytest
 
 import afmformats
+from afmformats.formats.fmt_hdf5 import H5Cache
+from afmformats.formats.fmt_jpk.jpk_reader import JPKReader
+from afmformats.lazy_loader import default_cache
 
 
 data_path = pathlib.Path(__file__).resolve().parent / "data"
 
 
+def test_h5cache_single_open():
+    _, path = tempfile.mkstemp(suffix=".h5", prefix="afmformats_test_")
+    shutil.copy2(data_path / "fmt-hdf5-fd_version_0.13.3.h5", path)
+    fdat = afmformats.load_data(path)[0]
+    h5 = H5Cache.get(path)
+    fdat["force"]
+    fdat["height (measured)"]
+    # the same handle is used for all column accesses
+    assert H5Cache.get(path) is h5
+    assert h5.id.valid
+    # the file is closed when the data are garbage-collected
+    del fdat
+    gc.collect()
+    assert not h5.id.valid
+    assert str(path) not in H5Cache.open_files
+
+
+def test_h5cache_fork(monkeypatch):
+    path = data_path / "fmt-hdf5-fd_version_0.13.3.h5"
+    # run against isolated state (restored by monkeypatch)
+    monkeypatch.setattr(H5Cache, "open_files", OrderedDict())
+    monkeypatch.setattr(H5Cache, "ref_counts", {})
+    h5 = H5Cache.get(path)
+    monkeypatch.setattr(H5Cache, "pid", -1)
+    try:
+        # handles from the "parent" are not reused
+        assert H5Cache.get(path) is not h5
+        H5Cache.close(path)
+    finally:
+        h5.close()
+
+
+def test_h5cache_max_files():
+    td = pathlib.Path(tempfile.mkdtemp(prefix="h5cache_"))
+    handles = []
+    for ii in range(H5Cache.max_files + 1):
+        pnew = td / f"data_{ii:03d}.h5"
+        shutil.copy2(data_path / "fmt-hdf5-fd_version_0.13.3.h5", pnew)
+        handles.append(H5Cache.get(pnew))
+    assert not handles[0].id.valid
+    assert handles[1].id.valid
+    assert handles[-1].id.valid
+
+
+def test_h5cache_max_files_in_use(monkeypatch):
+    monkeypatch.setattr(H5Cache, "open_files", OrderedDict())
+    monkeypatch.setattr(H5Cache, "ref_counts", {})
+    monkeypatch.setattr(H5Cache, "max_files", 2)
+    td = pathlib.Path(tempfile.mkdtemp(prefix="h5cache_"))
+    paths = []
+    for ii in range(4):
+        pnew = td / f"data_{ii:03d}.h5"
+        shutil.copy2(data_path / "fmt-hdf5-fd_version_0.13.3.h5", pnew)
+        paths.append(pnew)
+    # the two least-recently used files are in use by readers
+    for pp in paths[:2]:
+        H5Cache.acquire(pp)
+    handles = [H5Cache.get(pp) for pp in paths]
+    try:
+        # files in use are not evicted, even beyond `max_files`
+        assert handles[0].id.valid
+        assert handles[1].id.valid
+        assert not handles[2].id.valid
+        assert handles[3].id.valid
+        assert len(H5Cache.open_files) == 3
+        # the files are closed when they are released
+        H5Cache.release(paths[0])
+        assert not handles[0].id.valid
+        assert handles[1].id.valid
+        assert len(H5Cache.open_files) == 2
+        H5Cache.release(paths[1])
+        assert not handles[1].id.valid
+        assert handles[3].id.valid
+    finally:
+        for pp in paths:
+            H5Cache.close(pp)
+
+
+def test_packed_export_load():
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    group += afmformats.load_data(
+        data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    group[1]["tip position"] = group[1]["height (piezo)"] * 2
+    _, path = tempfile.mkstemp(suffix=".h5", prefix="afmformats_test_")
+    group.export_data(path, fmt="hdf5-packed")
+
+    recipe = afmformats.formats.get_recipe(path)
+    assert recipe.descr == "HDF5-based (packed)"
+
+    group2 = afmformats.AFMGroup(path)
+    assert len(group2) == 5
+    for afmd, afmd2 in zip(group, group2):
+        assert afmd2.enum == afmd.enum
+        assert afmd2.modality == afmd.modality
+        # "tip position" is not available in all curves
+        assert afmd2.columns == ["force", "height (measured)",
+                                 "height (piezo)", "segment", "time"]
+        for col in afmd2.columns:
+            assert np.all(afmd[col] == afmd2[col])
+        assert afmd2["segment"].dtype == np.uint8
+        md = afmd.metadata
+        md2 = afmd2.metadata
+        for key in md:
+            if key in ["path", "format"]:
+                assert md[key] != md2[key]
+            else:
+                assert md[key] == md2[key]
+        assert sorted(md) == sorted(md2)
+
+
+def test_packed_export_load_float32(tmp_path):
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+        dtype="float32")
+    assert group.dtype == np.float32
+    path = tmp_path / "packed.h5"
+    group.export_data(path, fmt="hdf5-packed")
+    with h5py.File(path, "r") as h5:
+        assert h5["columns"]["force"].dtype == np.float32
+        assert h5["columns"]["segment"].dtype == np.uint8
+    group2 = afmformats.AFMGroup(path)
+    for afmd, afmd2 in zip(group, group2):
+        assert afmd2["force"].dtype == np.float32
+        assert np.all(afmd["force"] == afmd2["force"])
+
+
+@pytest.mark.parametrize("dtype", [None, "float32"])
+def test_packed_export_decode_once(monkeypatch, tmp_path, dtype):
+    """The data of lazily loaded curves are decoded only once"""
+    # do not keep decoded data in memory
+    monkeypatch.setattr(default_cache, "max_bytes", 0)
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+        dtype=dtype)
+    with mock.patch.object(JPKReader, "get_data", autospec=True,
+                           side_effect=JPKReader.get_data) as get_data:
+        # (the "z range" metadata are computed from the data)
+        group.export_data(tmp_path / "packed.h5", fmt="hdf5-packed",
+                          metadata=False)
+    calls = [(cc.kwargs["column"], cc.kwargs["index"],
+              cc.kwargs.get("segment")) for cc in get_data.call_args_list]
+    assert calls
+    assert len(calls) == len(set(calls))
+    with h5py.File(tmp_path / "packed.h5", "r") as h5:
+        assert h5["columns"]["force"].dtype == (dtype or np.float64)
+
+
+def test_packed_export_mixed_dtype(tmp_path):
+    """Mixed float32/float64 groups are exported in float64"""
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+        dtype="float32")
+    group += afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_spot3-0192.jpk-force")
+    path = tmp_path / "packed.h5"
+    group.export_data(path, fmt="hdf5-packed")
+    with h5py.File(path, "r") as h5:
+        assert h5["columns"]["force"].dtype == np.float64
+    group2 = afmformats.AFMGroup(path)
+    # the float64 curve is not rounded
+    assert np.all(group[4]["force"] == group2[4]["force"])
+
+
+def test_packed_export_load_metadata_list():
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    _, path = tempfile.mkstemp(suffix=".h5", prefix="afmformats_test_")
+    group.export_data(path, fmt="hdf5-packed",
+                      metadata=["imaging mode", "spring constant"])
+    group2 = afmformats.AFMGroup(path)
+    md = group2[3].metadata
+    assert md["spring constant"] == group[3].metadata["spring constant"]
+    assert md["enum"] == 3
+    assert "sensitivity" not in md
+
+
+def test_group_export_hdf5():
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    _, path = tempfile.mkstemp(suffix=".h5", prefix="afmformats_test_")
+    group.export_data(path, fmt="hdf5")
+    recipe = afmformats.formats.get_recipe(path)
+    assert recipe.descr == "HDF5-based"
+    group2 = afmformats.AFMGroup(path)
+    assert len(group2) == 4
+    assert np.all(group[2]["force"] == group2[2]["force"])
+
+
 def test_open_0_13_3():
     fdat = afmformats.load_data(data_path / "fmt-hdf5-fd_version_0.13.3.h5")[0]
     assert fdat.metadata["imaging mode"] == "force-distance"
@@ -47,3 +245,48 @@ if __name__ == "__main__":
     for _key in list(_loc.keys()):
         if _key.startswith("test_") and hasattr(_loc[_key], "__call__"):
             _loc[_key]()
+
+
+def test_packed_export_chunk_blocks(monkeypatch, tmp_path):
+    """Curves are written in blocks that span multiple chunks"""
+    monkeypatch.setattr(afmformats.afm_group, "PACKED_CHUNK_SIZE", 100)
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    path = tmp_path / "packed.h5"
+    group.export_data(path, fmt="hdf5-packed")
+    with h5py.File(path, "r") as h5:
+        assert h5["columns"]["force"].chunks == (100,)
+    group2 = afmformats.AFMGroup(path)
+    for afmd, afmd2 in zip(group, group2):
+        for col in afmd2.columns:
+            assert np.all(afmd[col] == afmd2[col])
+
+
+def test_packed_export_empty_group(tmp_path):
+    path = tmp_path / "packed.h5"
+    afmformats.AFMGroup().export_data(path, fmt="hdf5-packed")
+    with h5py.File(path, "r") as h5:
+        assert len(h5["columns"]) == 0
+        assert np.all(h5["offsets"][:] == [0])
+
+
+def test_packed_export_no_metadata(tmp_path):
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    path = tmp_path / "packed.h5"
+    group.export_data(path, fmt="hdf5-packed", metadata=False)
+    # the imaging modality is always stored
+    assert afmformats.formats.fmt_hdf5.detect_hdf5_packed(
+        path, return_modality=True) == (True, "force-distance")
+    group2 = afmformats.AFMGroup(path)
+    assert len(group2) == 4
+    assert group2[2].enum == 2
+
+
+def test_packed_export_mixed_modalities(tmp_path):
+    group = afmformats.AFMGroup(
+        data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map")
+    group += afmformats.AFMGroup(
+        data_path / "fmt-jpk-cc_pr14-brain-2021.06.30.jpk-force")
+    with pytest.raises(ValueError, match="different imaging modalities"):
+        group.export_data(tmp_path / "packed.h5", fmt="hdf5-packed")
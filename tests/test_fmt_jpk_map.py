@@ -1,10 +1,15 @@
 """Test of basic opening functionalities"""
 import pathlib
+from unittest import mock
+import zipfile
 
 import numpy as np
+import pytest
 
 import afmformats
-from afmformats.formats.fmt_jpk import load_jpk
+from afmformats.formats.fmt_jpk import get_lazy_metadata, load_jpk
+from afmformats.formats.fmt_jpk.jpk_reader import ArchiveCache, JPKReader
+from afmformats.meta import LazyMetaValue, MetaDataMissingError
 
 
 data_path = pathlib.Path(__file__).resolve().parent / "data"
@@ -46,6 +51,163 @@ def test_open_jpk_map2():
     assert dataset[3]["metadata"]["grid index x"] == 0
 
 
+@pytest.mark.parametrize("name", [
+    "fmt-jpk-fd_map2x2_extracted.jpk-force-map",
+    "fmt-jpk-fd_2020.02.07-16.29.05.036.jpk-qi-data",
+])
+def test_open_jpk_map_lazy_metadata(name):
+    jpkfile = data_path / name
+    ds_lazy = load_jpk(jpkfile)
+    ds_eager = load_jpk(jpkfile, lazy_metadata=False)
+    assert len(ds_lazy) == len(ds_eager)
+    for dl, de in zip(ds_lazy, ds_eager):
+        md_lazy = dl["metadata"].as_dict()
+        md_eager = de["metadata"].as_dict()
+        assert md_lazy == md_eager
+
+
+def test_open_jpk_map_lazy_metadata_not_evaluated():
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    dataset = load_jpk(jpkfile)
+    md = dataset[1]["metadata"]
+    raw = dict.__getitem__(md, "position x")
+    assert isinstance(raw, LazyMetaValue)
+    assert not isinstance(dict.__getitem__(md, "grid shape x"),
+                          LazyMetaValue)
+    assert md["grid index x"] == 9
+    assert md["curve id"] == "2013.05.27-11.53.34-00048:9"
+
+
+def test_open_jpk_map_lazy_metadata_missing_key():
+    """Lazy keys of the reference curve might not exist in other curves"""
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    jpkr = JPKReader(jpkfile)
+    md_ref = dict(jpkr.get_metadata(index=0))
+    md_ref["duration intermediate"] = 1.
+    md = get_lazy_metadata(jpkr, 1, md_ref)
+    assert "duration intermediate" in md
+    # same behavior as for non-lazy metadata
+    with pytest.raises(MetaDataMissingError):
+        md["duration intermediate"]
+    assert "duration intermediate" not in md
+    md2 = get_lazy_metadata(jpkr, 1, md_ref)
+    assert md2.get("duration intermediate") is None
+    md3 = get_lazy_metadata(jpkr, 1, md_ref)
+    md_dict = md3.as_dict()
+    assert "duration intermediate" not in md_dict
+    assert md_dict["grid index x"] == 9
+
+
+def test_open_jpk_map_workers():
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    progress = []
+    ds_par = afmformats.load_data(jpkfile, workers=3,
+                                  callback=progress.append)
+    ds_ser = afmformats.load_data(jpkfile)
+    assert len(ds_par) == 4
+    assert np.allclose(progress, [.25, .5, .75, 1])
+    for dp, ds in zip(ds_par, ds_ser):
+        assert dp.metadata["enum"] == ds.metadata["enum"]
+        for col in ds.columns:
+            assert np.all(dp[col] == ds[col])
+
+
+@pytest.mark.parametrize("meta_override", [None, {"spring constant": 2}])
+def test_open_jpk_map_single_reader(meta_override):
+    """The reader created during detection is reused by the loader"""
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    ref = afmformats.load_data(jpkfile, meta_override=meta_override)
+    with mock.patch("afmformats.formats.fmt_jpk.JPKReader",
+                    side_effect=JPKReader) as reader:
+        data = afmformats.load_data(jpkfile, meta_override=meta_override)
+        assert reader.call_count == 1
+    assert len(data) == len(ref) == 4
+    for fd0, fd1 in zip(ref, data):
+        assert fd0.metadata.as_dict() == fd1.metadata.as_dict()
+        assert np.all(fd0["force"] == fd1["force"])
+
+
+def test_open_jpk_map_stored(tmp_path):
+    """Uncompressed .dat members are read from a memory map"""
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    path = tmp_path / "stored.jpk-force-map"
+    with zipfile.ZipFile(jpkfile) as arc, zipfile.ZipFile(path, "w") as arcs:
+        for info in arc.infolist():
+            # also test extra fields in the local header
+            info.extra = b"\xca\xfe\x02\x00ab"
+            arcs.writestr(info, arc.read(info.filename),
+                          compress_type=zipfile.ZIP_STORED)
+    jpkr = JPKReader(path)
+    dat = "index/1/segments/0/channels/vDeflection.dat"
+    with jpkr._stored_member(dat) as buf:
+        assert isinstance(buf, memoryview)
+        with jpkr._archive() as arc:
+            assert buf.tobytes() == arc.read(dat)
+    with JPKReader(jpkfile)._stored_member(dat) as buf:
+        assert buf is None
+
+    ref = afmformats.load_data(jpkfile)
+    data = afmformats.load_data(path)
+    assert len(data) == len(ref) == 4
+    for fd0, fd1 in zip(ref, data):
+        for col in ["force", "height (measured)", "height (piezo)"]:
+            assert np.array_equal(fd0[col], fd1[col])
+
+
+@pytest.mark.skipif(not pathlib.Path("/proc/self/fd").exists(),
+                    reason="requires /proc/self/fd")
+def test_open_jpk_map_stored_close(tmp_path):
+    """The memory map of a member is closed after reading it"""
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    path = tmp_path / "stored.jpk-force-map"
+    with zipfile.ZipFile(jpkfile) as arc, zipfile.ZipFile(path, "w") as arcs:
+        for info in arc.infolist():
+            arcs.writestr(info, arc.read(info.filename),
+                          compress_type=zipfile.ZIP_STORED)
+    dat = "index/1/segments/0/channels/vDeflection.dat"
+    with JPKReader(path)._stored_member(dat) as buf:
+        pass
+    with pytest.raises(ValueError, match="released"):
+        buf.tobytes()
+    # open file descriptors do not accumulate with the number of readers
+    paths = []
+    for ii in range(50):
+        paths.append(tmp_path / f"stored_{ii}.jpk-force-map")
+        paths[-1].write_bytes(path.read_bytes())
+    num_fds = len(list(pathlib.Path("/proc/self/fd").iterdir()))
+    groups = [afmformats.load_data(pp) for pp in paths]
+    for group in groups:
+        group[0]["force"]
+    assert len(list(pathlib.Path("/proc/self/fd").iterdir())) \
+        <= num_fds + ArchiveCache.max_archives
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_open_jpk_map_float32(workers):
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    ref = afmformats.load_data(jpkfile)
+    data = afmformats.load_data(jpkfile, dtype="float32", workers=workers)
+    for fd0, fd1 in zip(ref, data):
+        assert fd1["segment"].dtype == np.uint8
+        for col in ["force", "height (measured)", "height (piezo)", "time"]:
+            assert fd1[col].dtype == np.float32
+            assert np.allclose(fd0[col], fd1[col], rtol=1e-6, atol=0)
+        assert fd1.appr["force"].dtype == np.float32
+
+
+def test_segment_files_index():
+    jpkfile = data_path / "fmt-jpk-fd_map2x2_extracted.jpk-force-map"
+    jpkr = JPKReader(jpkfile)
+    segfiles = jpkr._segment_files
+    assert len(segfiles) == 8
+    assert "index/3/segments/1/" in segfiles
+    # same result as a scan through the entire file list
+    for p_seg in segfiles:
+        assert segfiles[p_seg] == [ff for ff in jpkr.files if ff.count(p_seg)]
+    assert ("index/2/segments/0/channels/vDeflection.dat"
+            in segfiles["index/2/segments/0/"])
+
+
 if __name__ == "__main__":
     # Run all tests
     _loc = locals()
@@ -1,4 +1,5 @@
 """Test .tab format functionalities"""
+import io
 import pathlib
 import tempfile
 
@@ -95,6 +96,42 @@ def test_save_open_with_metadata():
         assert np.allclose(fdat[col], fdat2[col], atol=0)
 
 
+def test_open_unknown_column():
+    tf = tempfile.mktemp(suffix=".tab", prefix="afmformats_test_tab_")
+    with open(tf, "w") as fd:
+        fd.write("# afmformats 0.18.7\r\n")
+        fd.write("#\r\n")
+        fd.write("# force\tunknown\tsegment\r\n")
+        for ii in range(10):
+            fd.write("{}\t{}\t{}\r\n".format(ii * 1e-9, 5, int(ii > 4)))
+    dd = afmformats.formats.fmt_tab.load_tab(tf)[0]
+    assert sorted(dd["data"].keys()) == ["force", "segment"]
+    assert dd["data"]["segment"].dtype == np.uint8
+    assert np.sum(dd["data"]["segment"]) == 5
+    assert np.allclose(dd["data"]["force"], np.arange(10) * 1e-9)
+
+
+def test_save_byte_identical():
+    """The chunked export must produce the same output as row-wise"""
+    jpkfile = data_path / "fmt-jpk-fd_spot3-0192.jpk-force"
+    fdat = afmformats.load_data(jpkfile, modality="force-distance")[0]
+    tip = fdat["height (piezo)"] * np.pi
+    tip[10] = np.nan
+    tip[11] = -0.
+    tip[12] = np.inf
+    fdat["tip position"] = tip
+    fd = io.StringIO()
+    fdat._export_tab(fd, chunk_size=999)
+    lines = fd.getvalue().split("\r\n")
+    assert lines[2] == "# " + "\t".join(fdat.columns)
+    for ii in range(len(fdat)):
+        ref = "\t".join(["{:.8g}".format(fdat[cc][ii])
+                         for cc in fdat.columns])
+        assert lines[ii + 3] == ref
+    assert lines[-1] == ""
+    assert len(lines) == len(fdat) + 4
+
+
 if __name__ == "__main__":
     # Run all tests
     _loc = locals()
@@ -0,0 +1,113 @@
+import gc
+import weakref
+
+import numpy as np
+
+from afmformats.lazy_loader import LazyData, LazyDataCache, as_lazy_data
+
+
+def make_lazy_data(cache, size=100, counter=None):
+    def func(column):
+        if counter is not None:
+            counter.append(column)
+        return np.zeros(size)
+
+    ld = LazyData(cache=cache)
+    for column in ["force", "time"]:
+        ld.set_lazy_loader(column=column, func=func,
+                           kwargs={"column": column})
+    return ld
+
+
+def test_cache_hit_miss():
+    cache = LazyDataCache()
+    calls = []
+    ld = make_lazy_data(cache, counter=calls)
+    ld["force"]
+    ld["force"]
+    ld["time"]
+    assert calls == ["force", "time"]
+    stats = cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["entries"] == 2
+    assert stats["size"] == 2 * 100 * 8
+
+
+def test_cache_evict_bytes():
+    cache = LazyDataCache(max_bytes=2 * 100 * 8)
+    ld1 = make_lazy_data(cache)
+    ld2 = make_lazy_data(cache)
+    ld1["force"]
+    ld1["time"]
+    ld1["force"]  # "time" is now the least recently used entry
+    ld2["force"]
+    assert cache.size == 2 * 100 * 8
+    assert (id(ld1), "force") in cache
+    assert (id(ld1), "time") not in cache
+    assert (id(ld2), "force") in cache
+    assert cache.evictions == 1
+
+
+def test_cache_too_large():
+    cache = LazyDataCache(max_bytes=10)
+    ld = make_lazy_data(cache)
+    assert ld["force"].size == 100
+    assert len(cache) == 0
+
+
+def test_cache_weak_owner():
+    cache = LazyDataCache()
+    ld = make_lazy_data(cache)
+    ld["force"]
+    ld["time"]
+    assert len(cache) == 2
+    del ld
+    gc.collect()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_set_lazy_loader_invalidates():
+    cache = LazyDataCache()
+    ld = make_lazy_data(cache)
+    assert np.all(ld["force"] == 0)
+    ld.set_lazy_loader(column="force", func=np.ones, kwargs={"shape": 10})
+    assert np.all(ld["force"] == 1)
+
+
+def test_as_lazy_data_dtype():
+    data = {"force": np.arange(10, dtype=float),
+            "segment": np.zeros(10, dtype=np.uint8)}
+    ld = as_lazy_data(data, dtype="float32")
+    assert sorted(ld.keys()) == ["force", "segment"]
+    assert ld["force"].dtype == np.float32
+    assert np.all(ld["force"] == data["force"])
+    # only floating point data are converted
+    assert ld["segment"].dtype == np.uint8
+    # set the dtype of existing LazyData
+    ld2 = make_lazy_data(LazyDataCache())
+    assert as_lazy_data(ld2, dtype="float32") is ld2
+    assert ld2["force"].dtype == np.float32
+    assert as_lazy_data(ld2, dtype=None) is ld2
+    assert ld2["force"].dtype == np.float64
+
+
+def test_as_lazy_data_dtype_dict_eager():
+    force = np.arange(10, dtype=float)
+    force_ref = weakref.ref(force)
+    ld = as_lazy_data({"force": force}, dtype="float32")
+    del force
+    gc.collect()
+    # the float64 source array is not referenced anymore
+    assert force_ref() is None
+    assert ld["force"].dtype == np.float32
+    assert np.all(ld["force"] == np.arange(10))
+
+
+def test_lazy_data_dtype():
+    cache = LazyDataCache()
+    ld = LazyData(cache=cache, dtype=np.float32)
+    ld.set_lazy_loader(column="force", func=np.ones, kwargs={"shape": 10})
+    assert ld["force"].dtype == np.float32
+    assert cache.size == 10 * 4
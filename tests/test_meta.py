@@ -90,6 +90,22 @@ def test_lazy_metadata_deepcopy():
     assert value4.value == 3
 
 
+def test_lazy_metadata_missing_ids():
+    def missing():
+        raise am.MetaDataMissingError("not available")
+
+    md = am.MetaData({"date": "2020-04-01",
+                      "time": "21:56:30",
+                      "enum": 2,
+                      "session id": am.LazyMetaValue(missing),
+                      "curve id": am.LazyMetaValue(missing)})
+    # the ids are computed as if they had never been set
+    assert md["curve id"] == "2020-04-01_21:56:30_2"
+    assert "curve id" not in md
+    assert "session id" not in md
+    assert md["session id"] == "2020-04-01_21:56:30"
+
+
 def test_values_with_lazy_meta():
     md = am.MetaData({"enum": 2,
                       "z range": am.LazyMetaValue(np.abs, -3)})